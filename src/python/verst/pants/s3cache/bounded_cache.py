@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from pants.cache.artifact_cache import UnreadableArtifact
+from pants.cache.local_artifact_cache import LocalArtifactCache
+from pants.util.dirutil import safe_delete, safe_mkdir
+
+
+class BoundedLocalArtifactCache(LocalArtifactCache):
+  """A local artifact cache that keeps at most max_bytes of artifacts, evicting the least recent.
+
+  The size and last use of every artifact is recorded in a sqlite index under index_root, which
+  is shared by all the caches stored beneath it, so the byte budget covers every task, and picking
+  what to evict is one indexed query rather than a walk of the tree. sqlite's locking makes the
+  index safe to share between concurrent pants processes on the host. Storing and evicting hold
+  its write lock while they move and delete files, so neither can race another process over the
+  same artifact.
+  """
+
+  def __init__(self, artifact_root, cache_root, index_root, compression, max_bytes,
+               max_entries_per_target=None, permissions=None, dereference=True):
+    """
+    :param str artifact_root: The path under which cacheable products will be read/written.
+    :param str cache_root: The locally cached files are stored under this directory.
+    :param str index_root: Directory holding the index; the budget is shared by every cache that
+                           uses it.
+    :param int compression: The gzip compression level for created artifacts.
+    :param int max_bytes: Total size of the artifacts to keep under index_root.
+    :param int max_entries_per_target: The maximum number of old cache files to leave behind on a
+                                       cache miss.
+    :param str permissions: File permissions to use when creating artifact files.
+    :param bool dereference: Dereference symlinks when creating the cache tarball.
+    """
+    super(BoundedLocalArtifactCache, self).__init__(
+      artifact_root, cache_root, compression, max_entries_per_target=max_entries_per_target,
+      permissions=permissions, dereference=dereference)
+    self._index_root = os.path.realpath(os.path.expanduser(index_root))
+    self._max_bytes = max_bytes
+
+  def use_cached_files(self, cache_key, results_dir=None):
+    result = super(BoundedLocalArtifactCache, self).use_cached_files(cache_key, results_dir)
+    if result is True:
+      self._record_use(self._cache_file_for_key(cache_key))
+    elif isinstance(result, UnreadableArtifact):  # The unreadable artifact was deleted.
+      self._forget_if_missing(self._cache_file_for_key(cache_key))
+    return result
+
+  def store_and_use_artifact(self, cache_key, src, results_dir=None):
+    try:
+      return super(BoundedLocalArtifactCache, self).store_and_use_artifact(cache_key, src,
+                                                                            results_dir)
+    except Exception:
+      # An artifact that fails to extract is deleted.
+      self._forget_if_missing(self._cache_file_for_key(cache_key))
+      raise
+
+  def delete(self, cache_key):
+    path = self._cache_file_for_key(cache_key)
+    with self._index() as index:
+      index.execute('DELETE FROM artifacts WHERE path = ?', (path,))
+    super(BoundedLocalArtifactCache, self).delete(cache_key)
+
+  def _store_tarball(self, cache_key, src):
+    dest = self._cache_file_for_key(cache_key)
+    with self._write_lock() as index:
+      # Indexed before it exists, so a crash can leave a stale entry but never an untracked file.
+      self._index_use(index, dest, os.path.getsize(src))
+      target_dir = os.path.dirname(dest)
+      stored = os.listdir(target_dir) if os.path.isdir(target_dir) else []
+      # Prunes the target's artifacts down to max_entries_per_target.
+      super(BoundedLocalArtifactCache, self)._store_tarball(cache_key, src)
+      pruned = [os.path.join(target_dir, name) for name in stored
+                if not os.path.exists(os.path.join(target_dir, name))]
+      index.executemany('DELETE FROM artifacts WHERE path = ?', [(path,) for path in pruned])
+      self._evict(index, keep=dest)
+    return dest
+
+  def _record_use(self, path):
+    with self._write_lock() as index:
+      if os.path.exists(path):  # Unless another process has evicted it since it was read.
+        self._index_use(index, path, os.path.getsize(path))
+
+  def _forget_if_missing(self, path):
+    with self._write_lock() as index:
+      if not os.path.exists(path):
+        index.execute('DELETE FROM artifacts WHERE path = ?', (path,))
+
+  def _index_use(self, index, path, size):
+    index.execute('INSERT OR REPLACE INTO artifacts (path, size, last_used) VALUES (?, ?, ?)',
+                  (path, size, time.time()))
+
+  def _evict(self, index, keep):
+    """Deletes the least recently used artifacts, other than keep, until the rest fit the budget.
+
+    Entries whose artifacts were deleted behind the index's back are dropped first, rather than
+    counting towards the budget.
+    """
+    total = index.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+    if total <= self._max_bytes:
+      return
+    entries = index.execute('SELECT path, size FROM artifacts WHERE path != ? ORDER BY last_used',
+                            (keep,)).fetchall()
+    missing = set(path for path, _ in entries if not os.path.exists(path))
+    total -= sum(size for path, size in entries if path in missing)
+    victims = []
+    for path, size in entries:
+      if total <= self._max_bytes:
+        break
+      if path not in missing:
+        victims.append(path)
+        total -= size
+    index.executemany('DELETE FROM artifacts WHERE path = ?',
+                      [(path,) for path in missing.union(victims)])
+    for path in victims:
+      safe_delete(path)
+
+  @contextmanager
+  def _write_lock(self):
+    """Yields the index inside a transaction that holds its write lock."""
+    with self._index() as index:
+      index.execute('BEGIN IMMEDIATE')
+      try:
+        yield index
+        index.execute('COMMIT')
+      except Exception:
+        index.execute('ROLLBACK')
+        raise
+
+  @contextmanager
+  def _index(self):
+    # Caches are pickled into pants' worker processes, so a connection is opened per operation
+    # rather than held on the instance.
+    safe_mkdir(self._index_root)
+    index = sqlite3.connect(os.path.join(self._index_root, 'index.sqlite'), timeout=60,
+                            isolation_level=None)
+    try:
+      index.execute('CREATE TABLE IF NOT EXISTS artifacts '
+                    '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+      index.execute('CREATE INDEX IF NOT EXISTS artifacts_by_last_used ON artifacts (last_used)')
+      yield index
+    finally:
+      index.close()
@@ -1,12 +1,170 @@
 import os
 
+from pants.base.build_environment import get_pants_cachedir
 from pants.base.deprecated import deprecated_conditional
-from pants.cache.cache_setup import CacheFactory
+from pants.cache.cache_setup import CacheFactory, CacheSetup
 from pants.cache.local_artifact_cache import (LocalArtifactCache,
                                               TempLocalArtifactCache)
 from pants.cache.pinger import BestUrlSelector
 from pants.cache.restful_artifact_cache import RESTfulArtifactCache
-from verst.pants.s3cache.s3cache import S3ArtifactCache
+from pants.goal.run_tracker import RunTracker
+from pants.task.task import TaskBase
+from verst.pants.s3cache.bounded_cache import BoundedLocalArtifactCache
+from verst.pants.s3cache.compression import (check_available,
+                                             CODECS,
+                                             GZIP)
+from verst.pants.s3cache.daemon import (DaemonArtifactCache,
+                                        DEFAULT_DAEMON_TIMEOUT)
+from verst.pants.s3cache.failover import FailoverArtifactCache, rank_s3_urls
+from verst.pants.s3cache import metrics
+from verst.pants.s3cache.s3cache import (DEFAULT_DOWNLOAD_PART_SIZE_BYTES,
+                                         DEFAULT_MAX_POOL_CONNECTIONS,
+                                         DEFAULT_MULTIPART_PART_SIZE_BYTES,
+                                         DEFAULT_MULTIPART_THRESHOLD_BYTES,
+                                         MIN_MULTIPART_PART_SIZE_BYTES,
+                                         S3ArtifactCache)
+from verst.pants.s3cache.seeding import do_check_artifact_cache
+from verst.pants.s3cache.timeouts import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from verst.pants.s3cache.write_behind import DEFAULT_MAX_IN_FLIGHT_BYTES
+
+_original_register_options = CacheSetup.register_options.__func__
+
+
+def register_options(cls, register):
+  _original_register_options(cls, register)
+  register('--s3-download-part-size', advanced=True, type=int,
+           default=DEFAULT_DOWNLOAD_PART_SIZE_BYTES,
+           help='Size in bytes of each byte range requested when downloading an S3 artifact '
+                'in parallel.')
+  register('--s3-download-concurrency', advanced=True, type=int, default=1,
+           help='Number of byte ranges of a single S3 artifact to download in parallel. '
+                'Artifacts larger than --s3-download-part-size are split into ranges and '
+                'reassembled in order. 1 downloads each artifact with a single GET.')
+  register('--s3-multipart-threshold', advanced=True, type=int,
+           default=DEFAULT_MULTIPART_THRESHOLD_BYTES,
+           help='S3 artifacts of at least this many bytes are uploaded with a multipart upload. '
+                'Smaller artifacts are uploaded with a single PUT.')
+  register('--s3-multipart-part-size', advanced=True, type=int,
+           default=DEFAULT_MULTIPART_PART_SIZE_BYTES,
+           help='Size in bytes of each part of a multipart S3 upload. Must be at least 5MB.')
+  register('--s3-upload-concurrency', advanced=True, type=int, default=4,
+           help='Number of parts of a single S3 artifact to upload in parallel.')
+  register('--s3-upload-retries', advanced=True, type=int, default=2,
+           help='Number of times to retry a failed part of a multipart S3 upload.')
+  register('--s3-write-behind', advanced=True, type=bool, default=False,
+           help='Upload artifacts to S3 in the background instead of blocking the task that '
+                'produced them. Pending uploads are finished before pants exits, and any that '
+                'failed are summarized in a warning.')
+  register('--s3-write-behind-workers', advanced=True, type=int, default=2,
+           help='Number of background threads uploading write-behind artifacts, per process.')
+  register('--s3-write-behind-max-bytes', advanced=True, type=int,
+           default=DEFAULT_MAX_IN_FLIGHT_BYTES,
+           help='Inserts block while this many bytes of write-behind artifacts are waiting to '
+                'be uploaded.')
+  register('--s3-bulk-lookup', advanced=True, type=bool, default=False,
+           help='Check whether artifacts exist in S3 by listing each target\'s prefix once per '
+                'run instead of sending a HEAD request per key. Tasks list the prefixes of all '
+                'of their targets up front, in parallel, and only fetch the artifacts found. '
+                'The listings are remembered for the rest of the run, so later lookups and '
+                'misses need no requests.')
+  register('--s3-lookup-concurrency', advanced=True, type=int, default=16,
+           help='Number of S3 prefixes listed in parallel by bulk lookups.')
+  register('--s3-negative-cache-ttl', advanced=True, type=int, default=0,
+           help='Remember S3 cache misses on disk under the workdir for this many seconds, so '
+                'later runs on this machine don\'t ask S3 about them again. A successful insert '
+                'forgets the miss. 0 disables the negative cache.')
+  register('--s3-negative-cache-max-entries', advanced=True, type=int, default=10000,
+           help='Approximate number of S3 cache misses to remember; the oldest are evicted '
+                'first.')
+  register('--s3-circuit-breaker-threshold', advanced=True, type=int, default=3,
+           help='After this many network failures talking to S3 within '
+                '--s3-circuit-breaker-window seconds, skip the S3 cache for '
+                '--s3-circuit-breaker-cooldown seconds, then probe it again. Shared by all pants '
+                'processes using the same workdir. 0 disables the circuit breaker, and with it '
+                'failing over between replicated buckets: only the fastest is used.')
+  register('--s3-circuit-breaker-window', advanced=True, type=int, default=60,
+           help='Seconds over which S3 network failures are counted.')
+  register('--s3-circuit-breaker-cooldown', advanced=True, type=int, default=120,
+           help='Seconds to skip the S3 cache for after it has been found unreachable.')
+  register('--s3-max-pool-connections', advanced=True, type=int,
+           default=DEFAULT_MAX_POOL_CONNECTIONS,
+           help='Maximum number of connections to S3 kept open per process and region. '
+                'Parallel downloads, uploads, lookups and write-behind threads all share this '
+                'pool, whatever their timeouts, so it should be at least as large as their '
+                'combined concurrency.')
+  register('--s3-content-addressed', advanced=True, type=bool, default=False,
+           help='Store each distinct S3 artifact once, under the digest of its contents, and '
+                'make cache keys small pointers to it. Inserting an artifact whose contents are '
+                'already stored uploads only the pointer. Pointers are always followed when '
+                'reading, so buckets can mix both layouts.')
+  register('--s3-stream-extract', advanced=True, type=bool, default=False,
+           help='Decompress and extract artifacts downloaded from S3 while they download, '
+                'instead of writing each tarball to disk first. When a local cache is '
+                'configured, the tarball is written to it alongside.')
+  register('--s3-hedge-percentile', advanced=True, type=float, default=0,
+           help='If S3 hasn\'t started answering a GET for an artifact within this percentile '
+                'of recently observed GET latencies, send a second GET and use whichever '
+                'answers first. Lower values cut tail latency at the cost of more requests. 0 '
+                'disables hedging.')
+  register('--s3-connect-timeout-floor', advanced=True, type=float,
+           default=DEFAULT_CONNECT_TIMEOUT,
+           help='Shortest timeout, in seconds, for connecting to S3. Connect timeouts adapt to a '
+                'few times the latency observed for small requests, within the floor and '
+                'ceiling, so a dead network is detected quickly.')
+  register('--s3-connect-timeout-ceiling', advanced=True, type=float,
+           default=DEFAULT_CONNECT_TIMEOUT,
+           help='Longest timeout, in seconds, for connecting to S3.')
+  register('--s3-read-timeout-floor', advanced=True, type=float, default=DEFAULT_READ_TIMEOUT,
+           help='Shortest timeout, in seconds, for reading from S3. Read timeouts adapt to the '
+                'observed latency, plus the time to transfer the request\'s payload at the '
+                'observed throughput, within the floor and ceiling.')
+  register('--s3-read-timeout-ceiling', advanced=True, type=float, default=DEFAULT_READ_TIMEOUT,
+           help='Longest timeout, in seconds, for reading from S3. Raise it to let large '
+                'uploads and downloads over slow links succeed.')
+  register('--s3-sharded-keys', advanced=True, type=bool, default=False,
+           help='Store artifacts under a hash of their target id, so that requests are spread '
+                'over many S3 partitions rather than concentrating on the few that hold similarly '
+                'named targets. Run the s3-cache-migrate goal to copy existing artifacts over.')
+  register('--s3-codec', advanced=True, choices=CODECS, default=GZIP,
+           help='Compression to store artifacts in S3 with. zstd and lz4 compress and decompress '
+                'several times faster than gzip; artifacts are transcoded to them as they are '
+                'uploaded, and stored in the local cache as plain tarballs when downloaded. '
+                'Artifacts in every codec are read, so the setting can differ between machines. '
+                'Needs the zstandard or lz4 package.')
+  register('--s3-codec-level', advanced=True, type=int, default=None,
+           help='Compression level for --s3-codec zstd (1-22, default 3) or lz4 (0-16, default '
+                '0). gzip artifacts are uploaded at the local cache\'s --compression-level.')
+  register('--s3-compression-threads', advanced=True, type=int, default=1,
+           help='Compress artifacts for S3 on this many threads, streaming the compressed bytes '
+                'into the upload instead of first writing a tarball to disk on one core. gzip '
+                'is compressed in independent blocks, like pigz. Not used with '
+                '--s3-write-behind or --s3-content-addressed.')
+  register('--s3-seed-incremental', advanced=True, type=bool, default=False,
+           help='When an incremental task, like compile.zinc, misses the S3 cache for a target, '
+                'extract the most recent artifact the task uploaded for the target as its '
+                'previous build, so it is compiled incrementally from there rather than from '
+                'scratch. Costs a LIST and a few HEADs per miss, and a download when there is an '
+                'earlier artifact; the target is still reported as a miss. Only applies to tasks '
+                'that cache the results of incremental builds, like compile.zinc with '
+                '--incremental-caching: other tasks would not upload the seeded builds.')
+  register('--s3-daemon-socket', advanced=True, default=None,
+           help='Fetch S3 artifacts through the s3-cache-daemon listening on this unix socket, '
+                'so that the pants processes on a host share its downloads and its store. '
+                'Inserts go straight to S3, as does everything else while the daemon is down.')
+  register('--s3-daemon-timeout', advanced=True, type=float, default=DEFAULT_DAEMON_TIMEOUT,
+           help='Seconds to wait for the S3 cache daemon to answer, downloads included.')
+  register('--s3-legacy-key-fallback', advanced=True, type=bool, default=True,
+           help='With --s3-sharded-keys, look up artifacts missing from the sharded layout under '
+                'their old keys too. Turn it off once the cache has been migrated, to save a '
+                'request per miss.')
+  register('--s3-local-cache-max-bytes', advanced=True, type=int, default=0,
+           help='When no local cache is configured in front of S3, keep up to this many bytes '
+                'of artifacts downloaded from or uploaded to S3 under --s3-local-cache-dir, '
+                'evicting the least recently used. Shared by every task and pants process on the '
+                'host. 0 keeps nothing.')
+  register('--s3-local-cache-dir', advanced=True, default=None,
+           help='Where to keep artifacts for --s3-local-cache-max-bytes. Defaults to s3cache '
+                'under the pants cache directory.')
 
 
 def _is_s3(string_spec):
@@ -19,13 +177,50 @@ def is_remote(_self, string_spec):
           _is_s3(string_spec))
 
 
+def s3_cache_kwargs(options):
+  """Returns the S3ArtifactCache constructor arguments configured by the cache options."""
+  return dict(
+    download_part_size=options.s3_download_part_size,
+    download_concurrency=options.s3_download_concurrency,
+    multipart_threshold=options.s3_multipart_threshold,
+    multipart_part_size=options.s3_multipart_part_size,
+    upload_concurrency=options.s3_upload_concurrency,
+    upload_retries=options.s3_upload_retries,
+    write_behind=options.s3_write_behind,
+    write_behind_workers=options.s3_write_behind_workers,
+    write_behind_max_bytes=options.s3_write_behind_max_bytes,
+    bulk_lookup=options.s3_bulk_lookup,
+    lookup_concurrency=options.s3_lookup_concurrency,
+    negative_cache_ttl=options.s3_negative_cache_ttl,
+    negative_cache_max_entries=options.s3_negative_cache_max_entries,
+    circuit_breaker_threshold=options.s3_circuit_breaker_threshold,
+    circuit_breaker_window=options.s3_circuit_breaker_window,
+    circuit_breaker_cooldown=options.s3_circuit_breaker_cooldown,
+    max_pool_connections=options.s3_max_pool_connections,
+    content_addressed=options.s3_content_addressed,
+    stream_extract=options.s3_stream_extract,
+    hedge_percentile=options.s3_hedge_percentile,
+    connect_timeout_floor=options.s3_connect_timeout_floor,
+    connect_timeout_ceiling=options.s3_connect_timeout_ceiling,
+    read_timeout_floor=options.s3_read_timeout_floor,
+    read_timeout_ceiling=options.s3_read_timeout_ceiling,
+    sharded_keys=options.s3_sharded_keys,
+    legacy_key_fallback=options.s3_legacy_key_fallback,
+    codec=options.s3_codec,
+    codec_level=options.s3_codec_level,
+    compression_threads=options.s3_compression_threads,
+    seed_incremental=options.s3_seed_incremental)
+
+
 def _do_create_artifact_cache(self, spec, action):
   """Returns an artifact cache for the specified spec.
   spec can be:
     - a path to a file-based cache root.
     - a URL of a RESTful cache root.
     - a URL of a S3 cache.
-    - a bar-separated list of URLs, where we'll pick the one with the best ping times.
+    - a bar-separated list of URLs, where we'll pick the one with the best ping times. For S3
+      URLs the others are failed over to when the best one's circuit breaker opens, so only with
+      a circuit breaker.
     - A list or tuple of two specs, local, then remote, each as described above
   """
   compression = self._options.compression_level
@@ -40,6 +235,10 @@ def _do_create_artifact_cache(self, spec, action):
     '==0 disables compression, and can prevent detection of corrupted artifacts.'
   )
 
+  if self._options.s3_multipart_part_size < MIN_MULTIPART_PART_SIZE_BYTES:
+    raise ValueError('s3_multipart_part_size must be at least {}: {}'.format(
+      MIN_MULTIPART_PART_SIZE_BYTES, self._options.s3_multipart_part_size))
+
   artifact_root = self._options.pants_workdir
 
   def create_local_cache(parent_path):
@@ -51,14 +250,49 @@ def _do_create_artifact_cache(self, spec, action):
                               permissions=self._options.write_permissions,
                               dereference=self._options.dereference_symlinks)
 
+  def create_bounded_local_cache():
+    index_root = (self._options.s3_local_cache_dir or
+                  os.path.join(get_pants_cachedir(), 's3cache'))
+    path = os.path.join(index_root, self._stable_name)
+    self._log.debug('{0} {1} bounded local artifact cache at {2}'
+                    .format(self._stable_name, action, path))
+    return BoundedLocalArtifactCache(artifact_root, path, index_root, compression,
+                                     self._options.s3_local_cache_max_bytes,
+                                     self._options.max_entries_per_target,
+                                     permissions=self._options.write_permissions,
+                                     dereference=self._options.dereference_symlinks)
+
+  def create_s3_cache(url, local_cache):
+    check_available(self._options.s3_codec)
+    return S3ArtifactCache(artifact_root, url, local_cache, metrics_dir=metrics.run_spool_dir(),
+                           task_name=self._stable_name, **s3_cache_kwargs(self._options))
+
   def create_remote_cache(remote_spec, local_cache):
     urls = remote_spec.split('|')
     if len(urls) == 0:
       return None
 
+    if not local_cache and _is_s3(urls[0]) and self._options.s3_local_cache_max_bytes > 0:
+      local_cache = create_bounded_local_cache()
     local_cache = local_cache or TempLocalArtifactCache(artifact_root, compression)
     if _is_s3(urls[0]):
-      return S3ArtifactCache(artifact_root, urls[0], local_cache)
+      if len(urls) > 1:
+        ranked = rank_s3_urls(urls)
+        self._log.debug('S3 artifact cache probe times: {}'.format(
+          ', '.join('{}: {:.6f} secs'.format(*p) for p in ranked)))
+        urls = [url for url, _ in ranked]
+        if len(urls) == 0:
+          return None
+      caches = [create_s3_cache(url, local_cache) for url in urls]
+      if len(caches) > 1 and self._options.s3_circuit_breaker_threshold > 0:
+        cache = FailoverArtifactCache(artifact_root, caches)
+      else:
+        cache = caches[0]
+      if self._options.s3_daemon_socket:
+        # The daemon fetches from the best URL; the others are still failed over to without it.
+        return DaemonArtifactCache(artifact_root, self._options.s3_daemon_socket, urls[0], cache,
+                                   local_cache, timeout=self._options.s3_daemon_timeout)
+      return cache
 
     urls = self.get_available_urls(urls)
     if len(urls) > 0:
@@ -74,5 +308,9 @@ def _do_create_artifact_cache(self, spec, action):
 
 
 def patch():
+  CacheSetup.register_options = classmethod(register_options)
   CacheFactory.is_remote = is_remote
   CacheFactory._do_create_artifact_cache = _do_create_artifact_cache
+  TaskBase.do_check_artifact_cache = do_check_artifact_cache
+  RunTracker.start = metrics.start
+  RunTracker.store_stats = metrics.store_stats
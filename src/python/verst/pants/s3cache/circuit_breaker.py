@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from pants.util.dirutil import safe_delete, safe_mkdir_for
+
+logger = logging.getLogger(__name__)
+
+# Recent network failure times per marker path. Kept at module level because caches are pickled
+# into pants' worker processes for every call.
+_failures = {}
+_failures_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+  """Stops talking to a remote cache for a while after repeated network failures.
+
+  The open state is a marker file whose mtime is when the circuit opened, so every pants process
+  and pool worker on the host sharing the workdir fails fast together, and only the process that
+  opens the circuit warns about it. Once cooldown seconds have passed, a single request is let
+  through as a probe, claimed with a second marker file, while the rest keep failing fast: a
+  success closes the circuit and a network failure restarts the cooldown. A probe that never
+  reports back is given up on after another cooldown.
+  """
+
+  def __init__(self, name, marker_path, threshold, window, cooldown):
+    """
+    :param str name: What is being protected, for messages.
+    :param str marker_path: File marking the circuit as open.
+    :param int threshold: Number of network failures within window seconds that opens the circuit.
+    :param int window: Seconds over which network failures are counted.
+    :param int cooldown: Seconds to fail fast before probing again.
+    """
+    self._name = name
+    self._marker_path = marker_path
+    self._probe_path = marker_path + '.probe'
+    self._threshold = threshold
+    self._window = window
+    self._cooldown = cooldown
+
+  def allow(self, claim=True):
+    """Returns whether a request may be sent.
+
+    While the circuit is open that is only once the cooldown has passed, and for the caller that
+    claims the probe: the thread that holds it is let through until it records the outcome.
+
+    :param bool claim: Whether to claim the probe, or only to check that it could be claimed.
+    """
+    opened = self._opened_at()
+    if opened is None:
+      return True
+    if time.time() - opened < self._cooldown:
+      return False
+    return self._probing() if claim else self._probe_holder() in (None, _thread_id())
+
+  def record_failure(self):
+    now = time.time()
+    if self._opened_at() is not None:
+      # A probe failed: stay open for another cooldown.
+      logger.debug('{0} is still unreachable'.format(self._name))
+      self._touch_marker()
+      self._release_probe()
+      return
+
+    with _failures_lock:
+      failures = _failures.setdefault(self._marker_path, deque())
+      failures.append(now)
+      while failures and now - failures[0] > self._window:
+        failures.popleft()
+      if len(failures) < self._threshold:
+        return
+      failures.clear()
+
+    safe_mkdir_for(self._marker_path)
+    try:
+      os.close(os.open(self._marker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+      return  # Another process opened the circuit first, and has warned about it.
+    logger.warn('{0} failed {1} times in {2}s with network errors; skipping it for the next {3}s.'
+                .format(self._name, self._threshold, self._window, self._cooldown))
+
+  def record_success(self):
+    if self._opened_at() is not None:
+      safe_delete(self._marker_path)
+      safe_delete(self._probe_path)
+      logger.info('{0} is reachable again.'.format(self._name))
+    with _failures_lock:
+      _failures.pop(self._marker_path, None)
+
+  def _probing(self):
+    """Returns whether this thread holds the probe, claiming it if nobody else does."""
+    holder = self._probe_holder()
+    if holder == _thread_id():
+      return True
+    if holder is not None:
+      try:
+        if time.time() - os.stat(self._probe_path).st_mtime < self._cooldown:
+          return False
+      except OSError:
+        pass  # Released since it was read.
+      # Its holder never reported back.
+      safe_delete(self._probe_path)
+    try:
+      fd = os.open(self._probe_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+      return False  # Claimed by another caller first.
+    try:
+      os.write(fd, _thread_id().encode('utf-8'))
+    finally:
+      os.close(fd)
+    logger.debug('Probing {0}'.format(self._name))
+    return True
+
+  def _probe_holder(self):
+    try:
+      with open(self._probe_path, 'rb') as infile:
+        return infile.read().decode('utf-8')
+    except (IOError, OSError):
+      return None
+
+  def _release_probe(self):
+    if self._probe_holder() == _thread_id():
+      safe_delete(self._probe_path)
+
+  def _opened_at(self):
+    try:
+      return os.stat(self._marker_path).st_mtime
+    except OSError:
+      return None
+
+  def _touch_marker(self):
+    try:
+      os.utime(self._marker_path, None)
+    except OSError:
+      pass  # Closed by a successful probe elsewhere.
+
+
+def _thread_id():
+  return '{0}:{1}'.format(os.getpid(), threading.current_thread().ident)
@@ -0,0 +1,248 @@
+import struct
+import zlib
+from collections import deque
+from itertools import chain
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.cache.artifact import ArtifactError
+
+# NB: zstandard and lz4 are optional, and only imported when their codec is used.
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+CODECS = (GZIP, ZSTD, LZ4)
+
+# Every codec's stream starts with its magic number, so objects are read back correctly whatever
+# codec the writer was configured with. A tarball starts with a file name, which never does.
+_MAGIC = ((GZIP, b'\x1f\x8b'), (ZSTD, b'\x28\xb5\x2f\xfd'), (LZ4, b'\x04\x22\x4d\x18'))
+_REQUIREMENTS = {ZSTD: 'zstandard', LZ4: 'lz4'}
+
+# Fed to a gzip decompressor after the last chunk: it only lands in unused_data if the stream had
+# already ended, which is how truncation is told apart from a complete stream on python 2.
+_SENTINEL = b'\0'
+
+_COPY_SIZE_BYTES = 4 * 1024 * 1024
+# Uncompressed bytes deflated together by each thread of a ParallelGzipCompressor.
+DEFAULT_PARALLEL_BLOCK_BYTES = 1024 * 1024
+# A gzip member header: deflate, no flags, no modification time, unknown OS.
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def sniff(data):
+  """Returns the codec whose stream data starts, or None if it isn't compressed."""
+  for codec, magic in _MAGIC:
+    if data.startswith(magic):
+      return codec
+  return None
+
+
+def check_available(codec):
+  """Raises ValueError unless codec is known and the module implementing it can be imported."""
+  if codec not in CODECS:
+    raise ValueError('Unknown codec {0}: expected one of {1}'.format(codec, ', '.join(CODECS)))
+  requirement = _REQUIREMENTS.get(codec)
+  if requirement:
+    try:
+      __import__(requirement)
+    except ImportError:
+      raise ValueError('The {0} codec requires the {1} package.'.format(codec, requirement))
+
+
+class _GzipDecompressor(object):
+  def __init__(self):
+    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+  def decompress(self, data):
+    # Without a max_length decompress returns everything it can, so there is nothing to flush.
+    return self._decompressor.decompress(data)
+
+  def finish(self):
+    self._decompressor.decompress(_SENTINEL)
+    return self._decompressor.unused_data.endswith(_SENTINEL)
+
+
+class _ZstdDecompressor(object):
+  def __init__(self):
+    import zstandard
+    self._error = zstandard.ZstdError
+    self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+  def decompress(self, data):
+    return self._decompressor.decompress(data)
+
+  def finish(self):
+    if hasattr(self._decompressor, 'eof'):
+      return self._decompressor.eof
+    # Older versions have no eof, but refuse any more input once the frame has ended.
+    try:
+      self._decompressor.decompress(b'')
+    except self._error:
+      return True
+    return False
+
+
+class _Lz4Decompressor(object):
+  def __init__(self):
+    import lz4.frame
+    self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+  def decompress(self, data):
+    return self._decompressor.decompress(data)
+
+  def finish(self):
+    return self._decompressor.eof
+
+
+def decompressor(codec):
+  """Returns a decompressor for codec.
+
+  It has `decompress(data)`, returning the bytes it could decompress so far, and `finish()`,
+  returning whether the stream ended. Both raise on corrupt input.
+  """
+  return {GZIP: _GzipDecompressor, ZSTD: _ZstdDecompressor, LZ4: _Lz4Decompressor}[codec]()
+
+
+class _Lz4Compressor(object):
+  def __init__(self, level):
+    import lz4.frame
+    self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level,
+                                                    content_checksum=True)
+    self._header = self._compressor.begin()
+
+  def compress(self, data):
+    header, self._header = self._header, b''
+    return header + self._compressor.compress(data)
+
+  def flush(self):
+    header, self._header = self._header, b''
+    return header + self._compressor.flush()
+
+
+def _deflate_block(data, level, last):
+  deflater = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  # A sync flush ends the block on a byte boundary without ending the deflate stream.
+  return deflater.compress(data) + deflater.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipCompressor(object):
+  """A gzip compressor that deflates blocks of its input on several threads at once.
+
+  As in pigz, each block is deflated on its own and ended on a byte boundary, so the blocks
+  concatenate into a single gzip member that every gzip reader accepts. The output is slightly
+  larger than serial gzip's, since a block can't refer back into the one before. zlib releases
+  the GIL while it deflates, so the threads do run in parallel.
+  """
+
+  def __init__(self, level, threads, block_size=DEFAULT_PARALLEL_BLOCK_BYTES):
+    """
+    :param int level: The gzip compression level.
+    :param int threads: Number of blocks to deflate at once.
+    :param int block_size: Size in bytes of the uncompressed blocks.
+    """
+    self._level = level
+    self._block_size = block_size
+    self._pool = ThreadPoolExecutor(max_workers=threads)
+    # Bounds the input held in memory while compress() is called faster than the threads keep up.
+    self._max_pending = 2 * threads
+    self._pending = deque()
+    self._buffer = bytearray()
+    self._crc = 0
+    self._size = 0
+    self._output = [_GZIP_HEADER]
+
+  def compress(self, data):
+    """Returns the compressed output that is ready, which may lag behind the input."""
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+    self._buffer += data
+    while len(self._buffer) >= self._block_size:
+      self._submit(bytes(self._buffer[:self._block_size]), last=False)
+      del self._buffer[:self._block_size]
+    return self._collect(wait=False)
+
+  def flush(self):
+    """Returns the rest of the compressed output, including the gzip trailer."""
+    self._submit(bytes(self._buffer), last=True)
+    self._buffer = bytearray()
+    output = self._collect(wait=True)
+    self._pool.shutdown()
+    return output + struct.pack(b'<II', self._crc & 0xffffffff, self._size & 0xffffffff)
+
+  def _submit(self, block, last):
+    self._pending.append(self._pool.submit(_deflate_block, block, self._level, last))
+
+  def _collect(self, wait):
+    while self._pending and (wait or self._pending[0].done() or
+                             len(self._pending) > self._max_pending):
+      self._output.append(self._pending.popleft().result())
+    output, self._output = b''.join(self._output), []
+    return output
+
+
+def compressor(codec, level=None, threads=1):
+  """Returns a compressor for codec, with `compress(data)` and `flush()` like zlib's.
+
+  :param int level: The codec's compression level, or None for its default.
+  :param int threads: Number of threads to compress on; lz4 is fast enough to always use one.
+  """
+  if codec == GZIP:
+    level = 6 if level is None else level
+    if threads > 1:
+      return ParallelGzipCompressor(level, threads)
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  if codec == ZSTD:
+    import zstandard
+    return zstandard.ZstdCompressor(level=3 if level is None else level, write_checksum=True,
+                                    threads=threads if threads > 1 else 0).compressobj()
+  return _Lz4Compressor(0 if level is None else level)
+
+
+def _decoding(codec, fn, *args):
+  try:
+    return fn(*args)
+  except Exception as e:
+    raise ArtifactError('Corrupt {0} stream: {1}'.format(codec, str(e)))
+
+
+def decode(chunks):
+  """Yields the bytes of the artifact arriving as chunks in a form tarfile reads.
+
+  Gzipped artifacts, which pants' local caches store, are passed through as they are. Other
+  codecs are decompressed to a plain tarball.
+
+  :raises ArtifactError: If the artifact is corrupt or truncated.
+  """
+  chunks = iter(chunks)
+  first_chunk = next(chunks, b'')
+  codec = sniff(first_chunk)
+  if codec in (None, GZIP):
+    for chunk in chain([first_chunk], chunks):
+      yield chunk
+    return
+
+  decoder = decompressor(codec)
+  # Only the decompressor's errors are the artifact's fault; the download's propagate as they are.
+  for chunk in chain([first_chunk], chunks):
+    data = _decoding(codec, decoder.decompress, chunk)
+    if data:
+      yield data
+  complete = _decoding(codec, decoder.finish)
+  if not complete:
+    raise ArtifactError('Truncated {0} stream'.format(codec))
+
+
+def transcode(src, dest, codec, level=None):
+  """Writes the gzipped tarball at src to dest, compressed with codec instead.
+
+  :param int level: The codec's compression level, or None for its default.
+  """
+  gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  encoder = compressor(codec, level)
+  with open(src, 'rb') as infile, open(dest, 'wb') as outfile:
+    while True:
+      chunk = infile.read(_COPY_SIZE_BYTES)
+      if not chunk:
+        break
+      outfile.write(encoder.compress(gunzip.decompress(chunk)))
+    outfile.write(encoder.flush())
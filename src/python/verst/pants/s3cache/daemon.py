@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+import socket
+import threading
+from collections import Counter
+from hashlib import sha1
+
+from concurrent.futures import Future
+from pants.base.build_environment import get_pants_cachedir
+from pants.cache.artifact_cache import ArtifactCache, UnreadableArtifact
+from pants.cache.cache_setup import CacheSetup
+from pants.cache.local_artifact_cache import LocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.task.task import Task
+from pants.util.dirutil import safe_delete, safe_mkdir
+from six.moves import socketserver
+from verst.pants.s3cache.bounded_cache import BoundedLocalArtifactCache
+from verst.pants.s3cache.metrics import run_spool_dir
+from verst.pants.s3cache.s3cache import READ_SIZE_BYTES, S3ArtifactCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(get_pants_cachedir(), 's3cache-daemon.sock')
+DEFAULT_STORE = os.path.join(get_pants_cachedir(), 's3cache-daemon')
+# Long enough for the daemon to download a large artifact from S3.
+DEFAULT_DAEMON_TIMEOUT = 300
+
+# The store only keeps tarballs downloaded whole; it never creates any.
+_STORE_COMPRESSION = 1
+
+
+class ArtifactDaemon(object):
+  """Fetches S3 artifacts into a store shared by every pants process on the host.
+
+  Concurrent fetches of the same artifact wait for a single download, rather than each making
+  their own, and later fetches are served from the store without going to S3 at all.
+  """
+
+  def __init__(self, store_root, max_bytes=0, cache_kwargs=None):
+    """
+    :param str store_root: Directory to keep the downloaded artifacts under.
+    :param int max_bytes: Keep at most this many bytes of artifacts, evicting the least recently
+                          used; 0 keeps everything.
+    :param dict cache_kwargs: Arguments for the S3ArtifactCache of each S3 URL.
+    """
+    self._store_root = os.path.realpath(os.path.expanduser(store_root))
+    self._max_bytes = max_bytes
+    self._cache_kwargs = cache_kwargs or {}
+    self._lock = threading.Lock()
+    self._caches = {}
+    self._in_flight = {}
+    self._stats = Counter()
+
+  def fetch(self, s3_url, cache_key):
+    """Returns the path of cache_key's artifact in the store, or None if S3 doesn't have it."""
+    flight = (s3_url, cache_key)
+    with self._lock:
+      self._stats['fetches'] += 1
+      future = self._in_flight.get(flight)
+      leader = future is None
+      if leader:
+        future = self._in_flight[flight] = Future()
+    if leader:
+      try:
+        future.set_result(self._download(s3_url, cache_key))
+      except Exception as e:
+        future.set_exception(e)
+      finally:
+        with self._lock:
+          del self._in_flight[flight]
+    return future.result()
+
+  def has(self, s3_url, cache_key):
+    return self._cache(s3_url).has(cache_key)
+
+  def forget(self, s3_url, cache_key):
+    """Drops the store's copy of cache_key's artifact, leaving S3's alone."""
+    self._cache(s3_url)._localcache.delete(cache_key)
+
+  def stats(self):
+    """Returns how many fetches the daemon served, and how many of them went to S3."""
+    with self._lock:
+      return {name: self._stats[name] for name in ('fetches', 'downloads')}
+
+  def _download(self, s3_url, cache_key):
+    cache = self._cache(s3_url)
+    store = cache._localcache
+    path = store._cache_file_for_key(cache_key)
+    if store.has(cache_key):
+      if isinstance(store, BoundedLocalArtifactCache):
+        # Served from the store without being read through it, so not otherwise counted as a use.
+        store._record_use(path)
+    else:
+      with self._lock:
+        self._stats['downloads'] += 1
+      if not cache.prefetch(cache_key):
+        return None
+    return path
+
+  def _cache(self, s3_url):
+    with self._lock:
+      cache = self._caches.get(s3_url)
+      if cache is None:
+        cache_root = os.path.join(self._store_root, sha1(s3_url.encode('utf-8')).hexdigest()[:12])
+        if self._max_bytes > 0:
+          store = BoundedLocalArtifactCache(self._store_root, cache_root, self._store_root,
+                                            _STORE_COMPRESSION, self._max_bytes)
+        else:
+          store = LocalArtifactCache(self._store_root, cache_root, _STORE_COMPRESSION)
+        cache = self._caches[s3_url] = S3ArtifactCache(self._store_root, s3_url, store,
+                                                       **self._cache_kwargs)
+      return cache
+
+  def handle(self, request):
+    """Answers a request decoded from a client."""
+    cache_key = CacheKey(request['id'], request['hash'])
+    op = request['op']
+    if op == 'fetch':
+      return {'path': self.fetch(request['url'], cache_key)}
+    if op == 'has':
+      return {'has': self.has(request['url'], cache_key)}
+    if op == 'forget':
+      self.forget(request['url'], cache_key)
+      return {}
+    raise ValueError('Unknown request {0}'.format(op))
+
+  def server(self, socket_path):
+    """Returns a server answering requests on the unix socket at socket_path."""
+    safe_mkdir(os.path.dirname(os.path.abspath(socket_path)))
+    safe_delete(socket_path)
+    # The store is only as trustworthy as the processes allowed to fill it, so the socket is
+    # bound with no permissions for other users: setting them afterwards would leave a window.
+    umask = os.umask(0o177)
+    try:
+      server = _Server(socket_path, _Handler)
+    finally:
+      os.umask(umask)
+    server.artifact_daemon = self
+    return server
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+  """Answers each line of JSON the client sends with a line of JSON."""
+
+  def handle(self):
+    for line in iter(self.rfile.readline, b''):
+      try:
+        response = self.server.artifact_daemon.handle(json.loads(line.decode('utf-8')))
+      except Exception as e:
+        logger.warn('Failed to answer {0}: {1}'.format(line.strip(), str(e)))
+        response = {'error': str(e)}
+      self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+      self.wfile.flush()
+
+
+class DaemonArtifactCache(ArtifactCache):
+  """An artifact cache that fetches S3 artifacts through an ArtifactDaemon on the host.
+
+  Inserts go straight to S3, and so does everything else while the daemon can't be reached.
+  """
+
+  def __init__(self, artifact_root, socket_path, s3_url, remote, local,
+               timeout=DEFAULT_DAEMON_TIMEOUT):
+    """
+    :param artifact_root: The path under which cacheable products will be read/written
+    :param str socket_path: The unix socket the daemon listens on.
+    :param str s3_url: URL of the S3 cache for the daemon to fetch from.
+    :param remote: The S3ArtifactCache (or FailoverArtifactCache) for s3_url, used for inserts
+                   and whenever the daemon is unavailable.
+    :param BaseLocalArtifactCache local: The local cache in front of remote.
+    :param float timeout: Seconds to wait for the daemon to answer.
+    """
+    super(DaemonArtifactCache, self).__init__(artifact_root)
+    self._socket_path = socket_path
+    self._s3_url = s3_url
+    self._remote = remote
+    self._localcache = local
+    self._timeout = timeout
+
+  def try_insert(self, cache_key, paths):
+    return self._remote.try_insert(cache_key, paths)
+
+  def has(self, cache_key):
+    if self._localcache.has(cache_key):
+      return True
+    response = self._request('has', cache_key)
+    if response is None:
+      return self._remote.has(cache_key)
+    return response['has']
+
+  @property
+  def bulk_lookup(self):
+    return self._remote.bulk_lookup
+
+  def has_all(self, cache_keys):
+    # Listing is done here rather than by the daemon, as it has nothing to share between clients.
+    return self._remote.has_all(cache_keys)
+
+  def use_cached_files(self, cache_key, results_dir=None):
+    if self._localcache.has(cache_key):
+      return self._localcache.use_cached_files(cache_key, results_dir)
+    response = self._request('fetch', cache_key)
+    if response is None:
+      return self._remote.use_cached_files(cache_key, results_dir)
+    if response['path'] is None:
+      return False
+    try:
+      with open(response['path'], 'rb') as infile:
+        try:
+          return self._localcache.store_and_use_artifact(
+            cache_key, iter(lambda: infile.read(READ_SIZE_BYTES), b''), results_dir)
+        except Exception as e:
+          logger.warn('Failed to use {0} from the S3 cache daemon: {1}'.format(cache_key, str(e)))
+          self._request('forget', cache_key)
+          return UnreadableArtifact(cache_key, e)
+    except (IOError, OSError):
+      # Evicted since the daemon answered.
+      return self._remote.use_cached_files(cache_key, results_dir)
+
+  def prefetch(self, cache_key):
+    """Has the daemon download cache_key's artifact into its store, returning whether it's there.
+    """
+    response = self._request('fetch', cache_key)
+    if response is None:
+      return self._remote.prefetch(cache_key)
+    return response['path'] is not None
+
+  def seed_key(self, cache_key):
+    return self._remote.seed_key(cache_key)
+
+  def delete(self, cache_key):
+    self._request('forget', cache_key)
+    self._remote.delete(cache_key)
+
+  def _request(self, op, cache_key):
+    """Returns the daemon's answer to op for cache_key, or None if it couldn't give one."""
+    request = {'op': op, 'url': self._s3_url, 'id': cache_key.id, 'hash': cache_key.hash}
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      client.settimeout(self._timeout)
+      client.connect(self._socket_path)
+      client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+      response = json.loads(client.makefile('rb').readline().decode('utf-8'))
+    except (socket.error, ValueError) as e:
+      logger.debug('S3 cache daemon unavailable for {0} {1}: {2}'.format(op, cache_key, str(e)))
+      return None
+    finally:
+      client.close()
+    if 'error' in response:
+      logger.debug('S3 cache daemon failed {0} {1}: {2}'.format(op, cache_key, response['error']))
+      return None
+    return response
+
+
+class S3CacheDaemon(Task):
+  """Serves S3 artifacts to the pants processes on this host from a shared store.
+
+  Pants processes configured with `--cache-s3-daemon-socket` fetch S3 artifacts through the
+  daemon: concurrent fetches of an artifact share a single download, and each artifact is
+  downloaded to the host once. Artifacts are fetched with the `cache` scope's S3 options. Runs
+  until interrupted.
+  """
+
+  @classmethod
+  def register_options(cls, register):
+    super(S3CacheDaemon, cls).register_options(register)
+    register('--socket', default=DEFAULT_SOCKET,
+             help='Unix socket to listen on.')
+    register('--store', default=DEFAULT_STORE,
+             help='Directory to keep downloaded artifacts under.')
+    register('--max-bytes', type=int, default=0,
+             help='Keep at most this many bytes of artifacts in the store, evicting the least '
+                  'recently used. 0 keeps everything.')
+
+  def execute(self):
+    # Imported here: cache_setup imports this module to create clients.
+    from verst.pants.s3cache.cache_setup import s3_cache_kwargs
+
+    options = self.get_options()
+    # The daemon's requests to S3 are reported in its own run's metrics.
+    cache_kwargs = dict(s3_cache_kwargs(CacheSetup.scoped_instance(self).get_options()),
+                        metrics_dir=run_spool_dir())
+    daemon = ArtifactDaemon(options.store, options.max_bytes, cache_kwargs)
+    server = daemon.server(options.socket)
+    self.context.log.info('Serving S3 artifacts from {0} on {1}'.format(options.store,
+                                                                       options.socket))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      safe_delete(options.socket)
+      self.context.log.info('Served {fetches} fetches with {downloads} downloads.'.format(
+        **daemon.stats()))
@@ -0,0 +1,99 @@
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.cache.artifact_cache import ArtifactCache
+from six.moves.urllib.parse import urlparse
+from verst.pants.s3cache.s3cache import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+
+# Buckets created before regions had names report these locations.
+_LEGACY_LOCATIONS = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}
+
+
+def _bucket_region(bucket):
+  location = get_s3_client().get_bucket_location(Bucket=bucket).get('LocationConstraint')
+  return _LEGACY_LOCATIONS.get(location, location)
+
+
+def _probe(s3_url):
+  """Returns the seconds a HEAD of s3_url's bucket took, or None if it failed.
+
+  The HEAD is sent to the bucket's own region, so replicas far from the default region aren't
+  timed with a redirect.
+  """
+  bucket = urlparse(s3_url).netloc
+  try:
+    client = get_s3_client(region_name=_bucket_region(bucket))
+    start = time.time()
+    client.head_bucket(Bucket=bucket)
+  except Exception as e:
+    logger.debug('Failed to probe {0}: {1}'.format(s3_url, str(e)))
+    return None
+  return time.time() - start
+
+
+def rank_s3_urls(s3_urls):
+  """Returns the reachable s3_urls, fastest first, and their probe times in seconds.
+
+  :param list s3_urls: URLs of the form s3://bucket/path.
+  :rtype: list of (str, float)
+  """
+  with ThreadPoolExecutor(max_workers=len(s3_urls)) as pool:
+    times = list(pool.map(_probe, s3_urls))
+  return sorted(((url, elapsed) for url, elapsed in zip(s3_urls, times) if elapsed is not None),
+                key=lambda url_and_time: url_and_time[1])
+
+
+class FailoverArtifactCache(ArtifactCache):
+  """Sends each request to the first available of several equivalent S3 artifact caches.
+
+  The caches are in order of preference. One counts as unavailable while its circuit breaker is
+  open, so after repeated network errors requests move on to the next, and they move back once
+  the preferred cache answers a probe again. If none are available the first is used, which
+  fails fast. Caches without a circuit breaker are always available, so are never failed over
+  from.
+  """
+
+  def __init__(self, artifact_root, caches):
+    """
+    :param artifact_root: The path under which cacheable products will be read/written
+    :param list caches: S3ArtifactCaches over replicas of the same artifacts, best first.
+    """
+    super(FailoverArtifactCache, self).__init__(artifact_root)
+    self._caches = caches
+
+  def _select(self):
+    for cache in self._caches:
+      if cache.available():
+        return cache
+    return self._caches[0]
+
+  def try_insert(self, cache_key, paths):
+    return self._select().try_insert(cache_key, paths)
+
+  def has(self, cache_key):
+    return self._select().has(cache_key)
+
+  @property
+  def bulk_lookup(self):
+    return self._select().bulk_lookup
+
+  def has_all(self, cache_keys):
+    return self._select().has_all(cache_keys)
+
+  def use_cached_files(self, cache_key, results_dir=None):
+    return self._select().use_cached_files(cache_key, results_dir)
+
+  def prefetch(self, cache_key):
+    return self._select().prefetch(cache_key)
+
+  def seed_key(self, cache_key):
+    return self._select().seed_key(cache_key)
+
+  def delete(self, cache_key):
+    # Deleted everywhere, so that a corrupt artifact isn't served again after a failover.
+    for cache in self._caches:
+      cache.delete(cache_key)
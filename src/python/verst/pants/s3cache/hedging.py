@@ -0,0 +1,116 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from multiprocessing.util import Finalize
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Below this many observations, percentiles are too noisy to hedge on.
+_MIN_SAMPLES = 20
+
+
+class LatencyTracker(object):
+  """A sliding window of recently observed request latencies."""
+
+  def __init__(self, max_samples=1000):
+    self._lock = threading.Lock()
+    self._samples = deque(maxlen=max_samples)
+
+  def record(self, seconds):
+    with self._lock:
+      self._samples.append(seconds)
+
+  def percentile(self, percent):
+    """Returns the given percentile of the recent latencies, or None if there are too few."""
+    with self._lock:
+      samples = sorted(self._samples)
+    if len(samples) < _MIN_SAMPLES:
+      return None
+    return samples[max(0, int(math.ceil(percent / 100.0 * len(samples))) - 1)]
+
+  def clear(self):
+    with self._lock:
+      self._samples.clear()
+
+
+# Per process, like the S3 clients: caches are pickled into pants' worker processes.
+latencies = LatencyTracker()
+
+_stats = Counter()
+_stats_pid = None
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+  global _stats_pid
+  with _stats_lock:
+    if _stats_pid != os.getpid():
+      _stats.clear()
+      _stats_pid = os.getpid()
+      Finalize(None, _log_stats, exitpriority=10)
+    _stats[name] += 1
+
+
+def _log_stats():
+  stats = hedge_stats()
+  if stats['hedged']:
+    logger.info('Hedged {hedged} slow S3 GETs: the hedge won {won} and lost {lost}.'.format(
+      **stats))
+
+
+def hedge_stats():
+  """Returns how many requests this process hedged, and how many of the hedges won and lost."""
+  with _stats_lock:
+    stats = Counter(_stats) if _stats_pid == os.getpid() else Counter()
+  return {name: stats[name] for name in ('hedged', 'won', 'lost')}
+
+
+def hedged(request, latencies, percent, discard):
+  """Calls request, calling it a second time if the first is slower than usual to return.
+
+  If the first call hasn't returned after the given percentile of latencies, a second is made,
+  and the result of whichever succeeds first is returned. The other is abandoned: Python threads
+  can't be interrupted, so discard is called with its result, if it succeeds, to release it.
+
+  :param request: A function of no arguments.
+  :param LatencyTracker latencies: Latencies of similar requests; this one's is recorded in it
+                                   if it succeeds.
+  :param float percent: The percentile of latencies to wait for before hedging.
+  :param discard: A function of the abandoned request's result.
+  """
+  def timed_request():
+    start = time.time()
+    result = request()
+    latencies.record(time.time() - start)
+    return result
+
+  threshold = latencies.percentile(percent)
+  if threshold is None:
+    return timed_request()
+
+  pool = ThreadPoolExecutor(max_workers=2)
+  try:
+    first = pool.submit(timed_request)
+    if wait([first], timeout=threshold).done:
+      return first.result()
+
+    _count('hedged')
+    second = pool.submit(timed_request)
+    pending = [first, second]
+    while True:
+      done = wait(pending, return_when=FIRST_COMPLETED).done
+      winner = first if first in done else second
+      pending.remove(winner)
+      if winner.exception() is None or not pending:
+        break
+    for loser in pending:
+      loser.add_done_callback(lambda future: future.exception() or discard(future.result()))
+    _count('won' if winner is second else 'lost')
+    return winner.result()
+  finally:
+    pool.shutdown(wait=False)
@@ -0,0 +1,81 @@
+import threading
+from collections import namedtuple
+
+
+class PrefixListings(object):
+  """A memo of the keys found under S3 prefixes that have been listed during this run.
+
+  Listing a target's `<path>/<id>/` prefix answers existence for every hash stored under it, so
+  later lookups for the same prefix don't go back to S3. Keys written or deleted by this process
+  are folded in as they happen.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._listings = {}
+
+  def get(self, bucket, prefix):
+    """Returns the set of keys under prefix, or None if it hasn't been listed."""
+    with self._lock:
+      keys = self._listings.get((bucket, prefix))
+      return None if keys is None else set(keys)
+
+  def put(self, bucket, prefix, keys):
+    with self._lock:
+      self._listings[(bucket, prefix)] = set(keys)
+
+  def add(self, bucket, prefix, key):
+    with self._lock:
+      keys = self._listings.get((bucket, prefix))
+      if keys is not None:
+        keys.add(key)
+
+  def discard(self, bucket, prefix, key):
+    with self._lock:
+      keys = self._listings.get((bucket, prefix))
+      if keys is not None:
+        keys.discard(key)
+
+  def clear(self):
+    with self._lock:
+      self._listings.clear()
+
+
+# Caches are pickled into pants' worker processes for every call, so anything memoized on an
+# instance would be lost between calls; the memo lives at module level instead.
+listings = PrefixListings()
+
+
+Head = namedtuple('Head', ['size', 'etag'])
+
+
+class ObjectHeads(object):
+  """A memo of what HEAD (or GET) requests made during this run found at S3 keys.
+
+  Keys written or deleted by this process are updated as that happens.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._heads = {}
+
+  def get(self, bucket, key):
+    """Returns the key's Head, False if it was missing, or None if it hasn't been looked up."""
+    with self._lock:
+      return self._heads.get((bucket, key))
+
+  def put(self, bucket, key, head):
+    """Records the key's Head, or False if it is missing."""
+    with self._lock:
+      self._heads[(bucket, key)] = head
+
+  def discard(self, bucket, key):
+    with self._lock:
+      self._heads.pop((bucket, key), None)
+
+  def clear(self):
+    with self._lock:
+      self._heads.clear()
+
+
+heads = ObjectHeads()
@@ -0,0 +1,27 @@
+from itertools import repeat
+
+from pants.task.task import TaskBase
+
+_original_do_check_artifact_cache = TaskBase.do_check_artifact_cache
+
+
+def do_check_artifact_cache(self, vts, post_process_cached_vts=None):
+  """Checks the artifact cache as pants does, skipping the misses a bulk lookup finds first.
+
+  Pants looks each artifact up in its worker processes, which were forked when the run started
+  and so can't see listings made since. With `bulk_lookup`, the read cache lists every target's
+  prefix here instead, and only the keys that may be hits are sent to the workers.
+  """
+  read_cache = self._cache_factory.get_read_cache() if vts else None
+  if not getattr(read_cache, 'bulk_lookup', False):
+    return _original_do_check_artifact_cache(self, vts,
+                                             post_process_cached_vts=post_process_cached_vts)
+  found = read_cache.has_all([vt.cache_key for vt in vts])
+  cached_vts, uncached_vts, uncached_causes = _original_do_check_artifact_cache(
+    self, [vt for vt in vts if found[vt.cache_key] is not False],
+    post_process_cached_vts=post_process_cached_vts)
+  for vt in vts:
+    if found[vt.cache_key] is False:
+      uncached_vts.extend(vt.versioned_targets)
+      uncached_causes.extend(repeat(False, len(vt.versioned_targets)))
+  return cached_vts, uncached_vts, uncached_causes
@@ -0,0 +1,304 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+from pants.goal.run_tracker import RunTracker
+from pants.util.dirutil import safe_mkdir
+
+logger = logging.getLogger(__name__)
+
+HAS = 'has'
+GET = 'GET'
+PUT = 'PUT'
+DELETE = 'DELETE'
+OPERATIONS = (HAS, GET, PUT, DELETE)
+
+# A successful PUT or DELETE is a hit; a miss is an artifact S3 doesn't have.
+HIT = 'hit'
+MISS = 'miss'
+NETWORK = 'network'
+UNKNOWN = 'unknown'
+OUTCOMES = (HIT, MISS, NETWORK, UNKNOWN)
+
+PERCENTILES = (50, 90, 99)
+
+# Latencies are counted in fixed buckets, each about 19% wider than the last, so that the
+# histograms of every process of a run add up exactly. The last bucket holds everything slower
+# than about 17 minutes.
+_BUCKETS_PER_DOUBLING = 4
+_BUCKETS = 20 * _BUCKETS_PER_DOUBLING + 1
+
+# Where, under a run's info dir, its processes spool their metrics.
+SPOOL_DIR = 's3cache-metrics'
+# Where, under a run's info dir, the run's metrics are written.
+METRICS_FILE = 's3cache_metrics.json'
+
+
+def _bucket(seconds):
+  millis = seconds * 1000.0
+  if millis <= 1:
+    return 0
+  return min(_BUCKETS - 1, int(math.ceil(_BUCKETS_PER_DOUBLING * math.log(millis, 2))))
+
+
+def _bucket_bound_millis(bucket):
+  return 2.0 ** (float(bucket) / _BUCKETS_PER_DOUBLING)
+
+
+def _empty_operation():
+  return {'count': 0, 'outcomes': {outcome: 0 for outcome in OUTCOMES}, 'bytes': 0,
+          'seconds': 0.0, 'max_seconds': 0.0, 'latency_buckets': [0] * _BUCKETS}
+
+
+class OperationMetrics(object):
+  """Counts, outcomes, bytes moved and latency histograms of cache operations."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._operations = {}
+
+  def record(self, op, outcome, seconds, size=0):
+    """Records an operation that took seconds and moved size bytes."""
+    with self._lock:
+      stats = self._operations.setdefault(op, _empty_operation())
+      stats['count'] += 1
+      stats['outcomes'][outcome] += 1
+      stats['bytes'] += size
+      stats['seconds'] += seconds
+      stats['max_seconds'] = max(stats['max_seconds'], seconds)
+      stats['latency_buckets'][_bucket(seconds)] += 1
+
+  def merge(self, snapshot):
+    """Adds in the operations of another collector's snapshot."""
+    with self._lock:
+      for op, other in snapshot.items():
+        stats = self._operations.setdefault(op, _empty_operation())
+        stats['count'] += other['count']
+        for outcome, count in other['outcomes'].items():
+          stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + count
+        stats['bytes'] += other['bytes']
+        stats['seconds'] += other['seconds']
+        stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+        for bucket, count in enumerate(other['latency_buckets'][:_BUCKETS]):
+          stats['latency_buckets'][bucket] += count
+
+  def snapshot(self):
+    """Returns the operations recorded so far, as a dict that serializes to JSON."""
+    with self._lock:
+      return json.loads(json.dumps(self._operations))
+
+  def summary(self):
+    """Returns, per operation, its count, outcomes, hit rate, bytes and latency percentiles."""
+    summary = {}
+    for op, stats in self.snapshot().items():
+      latency = {'p{0}'.format(percent): _percentile_millis(stats, percent)
+                 for percent in PERCENTILES}
+      latency['max'] = stats['max_seconds'] * 1000
+      summary[op] = dict(stats['outcomes'], count=stats['count'], bytes=stats['bytes'],
+                         seconds=stats['seconds'], latency_ms=latency,
+                         hit_rate=float(stats['outcomes'][HIT]) / stats['count'])
+    return summary
+
+  def clear(self):
+    with self._lock:
+      self._operations.clear()
+
+
+def _percentile_millis(stats, percent):
+  """Returns the upper bound of the latency bucket holding the given percentile, in ms."""
+  rank = max(1, int(math.ceil(percent / 100.0 * stats['count'])))
+  max_millis = stats['max_seconds'] * 1000
+  seen = 0
+  for bucket, count in enumerate(stats['latency_buckets']):
+    seen += count
+    if seen >= rank:
+      return max_millis if bucket == _BUCKETS - 1 else min(max_millis,
+                                                            _bucket_bound_millis(bucket))
+  return max_millis
+
+
+class Measurement(object):
+  """The outcome and size of an operation being measured."""
+
+  def __init__(self):
+    self.outcome = None
+    self.size = 0
+
+  def note(self, outcome):
+    """Notes an outcome of a request made by the operation; failures outrank misses."""
+    if self.outcome is None or outcome != MISS:
+      self.outcome = outcome
+
+  def found(self, found):
+    """Makes the operation a hit or miss, unless a request failed, and returns found."""
+    if self.outcome is None:
+      self.outcome = HIT if found else MISS
+    return found
+
+
+# Per process, like the S3 clients: caches are pickled into pants' worker processes. Each run
+# spools to its own directory, so a worker that outlives a run starts afresh for the next.
+# Operations are counted in memory, and spooled when the process exits: pants' workers exit
+# before the run's stats are stored, and the process that stores them spools in `collect`.
+_collectors = {}
+_collectors_pid = None
+_collectors_lock = threading.Lock()
+_current = threading.local()
+
+
+def _collector(spool_dir):
+  global _collectors_pid
+  with _collectors_lock:
+    if _collectors_pid != os.getpid():
+      # A forked worker would otherwise spool its parent's operations as its own.
+      _collectors.clear()
+      _collectors_pid = os.getpid()
+    collector = _collectors.get(spool_dir)
+    if collector is None:
+      collector = _collectors[spool_dir] = OperationMetrics()
+      if spool_dir:
+        Finalize(None, _spool, args=(spool_dir, collector), exitpriority=10)
+    return collector
+
+
+def record(op, outcome, seconds, size=0, spool_dir=None):
+  """Records an operation in this process' metrics for spool_dir.
+
+  :param str spool_dir: Directory the run's processes spool their metrics to when they exit, for
+                        `collect`; None keeps them in memory.
+  """
+  _collector(spool_dir).record(op, outcome, seconds, size)
+
+
+def flush(spool_dir):
+  """Spools this process' metrics for spool_dir now, rather than when it exits."""
+  with _collectors_lock:
+    collector = _collectors.get(spool_dir) if _collectors_pid == os.getpid() else None
+  if collector is not None:
+    _spool(spool_dir, collector)
+
+
+def _spool(spool_dir, collector):
+  path = os.path.join(spool_dir, '{0}.json'.format(os.getpid()))
+  tmp = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+  try:
+    safe_mkdir(spool_dir)
+    with open(tmp, 'w') as outfile:
+      json.dump(collector.snapshot(), outfile)
+    # Renamed into place, so collect never reads half a file.
+    os.rename(tmp, path)
+  except (IOError, OSError) as e:
+    logger.debug('Failed to spool S3 cache metrics to {0}: {1}'.format(spool_dir, str(e)))
+
+
+def collect(spool_dir):
+  """Returns an OperationMetrics holding what every process spooled to spool_dir.
+
+  This process' metrics are spooled first, so they are included.
+  """
+  flush(spool_dir)
+  metrics = OperationMetrics()
+  try:
+    names = os.listdir(spool_dir)
+  except OSError:
+    return metrics
+  for name in names:
+    if name.endswith('.json'):
+      try:
+        with open(os.path.join(spool_dir, name), 'r') as infile:
+          metrics.merge(json.load(infile))
+      except (IOError, ValueError) as e:
+        logger.debug('Skipping unreadable S3 cache metrics {0}: {1}'.format(name, str(e)))
+  return metrics
+
+
+@contextmanager
+def measure(op, spool_dir=None):
+  """Records the operation made in the block, which is given its Measurement.
+
+  Requests the block makes `note` their outcomes on the current measurement of their thread. An
+  operation with nothing noted or found is recorded as unknown.
+  """
+  measurement = Measurement()
+  outer = getattr(_current, 'measurement', None)
+  _current.measurement = measurement
+  start = time.time()
+  try:
+    yield measurement
+  finally:
+    _current.measurement = outer
+    record(op, measurement.outcome or UNKNOWN, time.time() - start, measurement.size, spool_dir)
+
+
+def note(outcome):
+  """Notes a request's outcome on the operation being measured on this thread, if any."""
+  measurement = getattr(_current, 'measurement', None)
+  if measurement is not None:
+    measurement.note(outcome)
+
+
+def add_bytes(size):
+  """Adds size bytes to those moved by the operation being measured on this thread, if any."""
+  measurement = getattr(_current, 'measurement', None)
+  if measurement is not None:
+    measurement.size += size
+
+
+def counted(chunks):
+  """Yields chunks, adding their bytes to the operation being measured when it was called."""
+  measurement = getattr(_current, 'measurement', None)
+  for chunk in chunks:
+    if measurement is not None:
+      measurement.size += len(chunk)
+    yield chunk
+
+
+_run_spool_dir = None
+
+
+def run_spool_dir():
+  """Returns the directory this run's S3 caches spool their metrics to, or None outside a run."""
+  return _run_spool_dir
+
+
+def report(run_tracker):
+  """Writes the run's S3 cache metrics to its info dir, and adds them to the run tracker's stats.
+
+  Each operation's total time is a cumulative timing labelled `s3cache:<op>`, and the path of
+  the JSON file is the run info's `s3cache_metrics`. Returns the summary written, if any.
+  """
+  summary = collect(os.path.join(run_tracker.run_info_dir, SPOOL_DIR)).summary()
+  if not summary:
+    return None
+  path = os.path.join(run_tracker.run_info_dir, METRICS_FILE)
+  with open(path, 'w') as outfile:
+    json.dump(summary, outfile, indent=2, sort_keys=True)
+  for op, stats in summary.items():
+    run_tracker.cumulative_timings.add_timing('s3cache:{0}'.format(op), stats['seconds'])
+  run_tracker.run_info.add_info('s3cache_metrics', path)
+  return summary
+
+
+_original_start = RunTracker.start
+_original_store_stats = RunTracker.store_stats
+
+
+def start(self, report):
+  """Starts tracking the run as pants does, and has its S3 caches spool their metrics to it."""
+  global _run_spool_dir
+  _run_spool_dir = os.path.join(self.run_info_dir, SPOOL_DIR)
+  _original_start(self, report)
+
+
+def store_stats(self):
+  """Reports the S3 cache metrics of the run, then stores its stats as pants does."""
+  try:
+    report(self)
+  except Exception as e:
+    logger.warn('Failed to report S3 cache metrics: {0}'.format(str(e)))
+  _original_store_stats(self)
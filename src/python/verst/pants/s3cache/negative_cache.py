@@ -0,0 +1,72 @@
+import errno
+import hashlib
+import os
+import time
+
+from pants.util.dirutil import safe_delete, safe_mkdir
+
+# Entries are spread over this many subdirectories so that eviction only ever lists one of them.
+_SHARDS = 256
+
+
+class NegativeLookupCache(object):
+  """Remembers on disk which S3 keys were recently found to be missing.
+
+  Each miss is an empty file whose mtime records when the key was checked; it counts as a miss
+  for ttl seconds after that. Every operation is a single stat, create or unlink, so concurrent
+  pants processes sharing the directory need no locking. Each shard keeps at most its share of
+  max_entries, dropping the least recently recorded misses first.
+  """
+
+  def __init__(self, root, ttl, max_entries):
+    """
+    :param str root: Directory to store the entries under.
+    :param int ttl: Seconds a recorded miss is trusted for.
+    :param int max_entries: Approximate upper bound on the number of entries kept.
+    """
+    self._root = root
+    self._ttl = ttl
+    self._max_entries_per_shard = max(1, max_entries // _SHARDS)
+
+  def is_missing(self, bucket, key):
+    """Returns True if key was recorded as missing from bucket within the last ttl seconds."""
+    try:
+      recorded = os.stat(self._entry_path(bucket, key)).st_mtime
+    except OSError:
+      return False
+    return time.time() - recorded < self._ttl
+
+  def record_missing(self, bucket, key):
+    path = self._entry_path(bucket, key)
+    shard = os.path.dirname(path)
+    safe_mkdir(shard)
+    with open(path, 'a'):
+      os.utime(path, None)
+    self._evict(shard)
+
+  def clear(self, bucket, key):
+    safe_delete(self._entry_path(bucket, key))
+
+  def _evict(self, shard):
+    now = time.time()
+    entries = []
+    for name in os.listdir(shard):
+      path = os.path.join(shard, name)
+      try:
+        recorded = os.stat(path).st_mtime
+      except OSError as e:
+        if e.errno == errno.ENOENT:
+          continue  # Evicted or cleared by someone else.
+        raise
+      if now - recorded >= self._ttl:
+        safe_delete(path)
+      else:
+        entries.append((recorded, path))
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - self._max_entries_per_shard)]:
+      safe_delete(path)
+
+  def _entry_path(self, bucket, key):
+    digest = hashlib.sha1('{0}/{1}'.format(bucket, key).encode('utf-8')).hexdigest()
+    shard = '{0:02x}'.format(int(digest[:8], 16) % _SHARDS)
+    return os.path.join(self._root, shard, digest)
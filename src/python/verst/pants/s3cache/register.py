@@ -1,6 +1,10 @@
 from .cache_setup import patch
+from .daemon import S3CacheDaemon
+from .remote_gc import S3CacheGarbageCollect, S3CacheMigrate
+from .warmup import S3CacheWarmup
 
 from pants.build_graph.build_file_aliases import BuildFileAliases
+from pants.goal.task_registrar import TaskRegistrar as task
 
 
 def build_file_aliases():
@@ -10,6 +14,10 @@ def build_file_aliases():
 
 def register_goals():
   patch()
+  task(name='s3-cache-daemon', action=S3CacheDaemon).install()
+  task(name='s3-cache-gc', action=S3CacheGarbageCollect).install()
+  task(name='s3-cache-migrate', action=S3CacheMigrate).install()
+  task(name='s3-cache-warmup', action=S3CacheWarmup).install()
 
 
 def global_subsystems():
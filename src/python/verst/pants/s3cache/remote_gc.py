@@ -0,0 +1,267 @@
+import calendar
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.base.exceptions import TaskError
+from pants.task.task import Task
+from six.moves.urllib.parse import urlparse
+from verst.pants.s3cache.s3cache import (BLOB_REFRESH_SECONDS,
+                                         BLOBS_DIR,
+                                         get_s3_client,
+                                         parse_blob_pointer,
+                                         shard_dir,
+                                         SHARDS_DIR)
+
+logger = logging.getLogger(__name__)
+
+# DeleteObjects accepts at most this many keys per request.
+_DELETE_BATCH_SIZE = 1000
+# Pointer objects are about 100 bytes; anything larger is an artifact and isn't read.
+_MAX_POINTER_BYTES = 128
+
+
+def _timestamp(last_modified):
+  return calendar.timegm(last_modified.utctimetuple()) + last_modified.microsecond / 1000000.0
+
+
+class _RemoteCache(object):
+  """Walks the S3 artifact cache rooted at an s3:// URL."""
+
+  def __init__(self, s3_url, concurrency=16):
+    """
+    :param str s3_url: URL of the form s3://bucket/path/to/store/artifacts
+    :param int concurrency: Number of requests to make in parallel.
+    """
+    url = urlparse(s3_url)
+    self._bucket = url.netloc
+    self._root = url.path.lstrip('/') + '/'
+    self._concurrency = concurrency
+
+  def _unsharded_prefixes(self):
+    """Returns the `<path>/<cache_key.id>/` prefix of every target in the unsharded layout."""
+    special = set(self._root + name + '/' for name in (BLOBS_DIR, SHARDS_DIR))
+    return [prefix for prefix in self._child_prefixes(self._root) if prefix not in special]
+
+  def _sharded_prefixes(self, pool):
+    """Returns the `<path>/_shards/<hash>/<cache_key.id>/` prefix of every sharded target."""
+    shards = self._child_prefixes(self._root + SHARDS_DIR + '/')
+    return [prefix for prefixes in pool.map(self._child_prefixes, shards) for prefix in prefixes]
+
+  def _child_prefixes(self, prefix):
+    paginator = self._client().get_paginator('list_objects_v2')
+    prefixes = []
+    for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix, Delimiter='/'):
+      prefixes.extend(entry['Prefix'] for entry in page.get('CommonPrefixes', []))
+    return prefixes
+
+  def _list(self, prefix):
+    paginator = self._client().get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+      objects.extend(page.get('Contents', []))
+    return objects
+
+  def _delete(self, keys):
+    response = self._client().delete_objects(
+      Bucket=self._bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    for error in response.get('Errors', []):
+      logger.warn('Failed to delete {0}: {1}'.format(error['Key'], error.get('Message')))
+
+  def _delete_all(self, pool, keys):
+    batches = [keys[i:i + _DELETE_BATCH_SIZE] for i in range(0, len(keys), _DELETE_BATCH_SIZE)]
+    list(pool.map(self._delete, batches))
+
+  def _client(self):
+    return get_s3_client(max_pool_connections=self._concurrency)
+
+
+class RemoteCacheCollector(_RemoteCache):
+  """Deletes stale artifacts from the S3 artifact cache rooted at an s3:// URL.
+
+  Artifacts live under one `<cache_key.id>/` prefix per target, directly under the cache's path
+  or under a shard directory. For each target the newest keep_per_target artifacts are kept, as
+  is anything written in the last keep_within seconds; the rest are deleted. Blobs of the
+  content-addressed layout are deleted once no remaining pointer refers to them and they are
+  older than both keep_within and BLOB_REFRESH_SECONDS, which leaves inserts that have uploaded
+  or rewritten a blob but not yet its pointer alone.
+  """
+
+  def __init__(self, s3_url, keep_per_target, keep_within, concurrency=16):
+    """
+    :param str s3_url: URL of the form s3://bucket/path/to/store/artifacts
+    :param int keep_per_target: Number of artifacts to keep for each target id.
+    :param int keep_within: Seconds for which artifacts are kept regardless.
+    :param int concurrency: Number of requests to make in parallel.
+    """
+    super(RemoteCacheCollector, self).__init__(s3_url, concurrency)
+    self._keep_per_target = keep_per_target
+    self._keep_within = keep_within
+
+  def collect(self, dry_run=False, now=None):
+    """Deletes the stale artifacts, or only finds them if dry_run.
+
+    :returns: The number of objects and of bytes that were (or would be) freed.
+    :rtype: tuple of (int, int)
+    """
+    now = now or time.time()
+    cutoff = now - self._keep_within
+    blob_cutoff = min(cutoff, now - BLOB_REFRESH_SECONDS)
+    with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+      target_prefixes = self._unsharded_prefixes() + self._sharded_prefixes(pool)
+      listed = list(pool.map(self._list, target_prefixes))
+
+      doomed = []
+      kept = []
+      for objects in listed:
+        stale = self._stale(objects, cutoff)
+        stale_keys = set(entry['Key'] for entry in stale)
+        doomed.extend(stale)
+        kept.extend(entry for entry in objects if entry['Key'] not in stale_keys)
+
+      # Blobs only go once every pointer to them is gone, including those deleted above.
+      pointers = [entry['Key'] for entry in kept if entry['Size'] <= _MAX_POINTER_BYTES]
+      referenced = set(pool.map(self._read_pointer, pointers))
+      blobs = [entry for entry in self._list(self._root + BLOBS_DIR + '/')
+               if entry['Key'].rsplit('/', 1)[-1] not in referenced and
+               _timestamp(entry['LastModified']) < blob_cutoff]
+      # An insert may have rewritten a blob to reuse it since the pointers were listed.
+      still_stale = pool.map(lambda entry: self._modified_before(entry['Key'], blob_cutoff), blobs)
+      doomed.extend(entry for entry, stale in zip(blobs, still_stale) if stale)
+
+      freed = sum(entry['Size'] for entry in doomed)
+      if not dry_run:
+        self._delete_all(pool, [entry['Key'] for entry in doomed])
+    return len(doomed), freed
+
+  def _stale(self, objects, cutoff):
+    newest_first = sorted(objects, key=lambda entry: entry['LastModified'], reverse=True)
+    return [entry for entry in newest_first[self._keep_per_target:]
+            if _timestamp(entry['LastModified']) < cutoff]
+
+  def _modified_before(self, key, cutoff):
+    """Returns whether the object at key exists and was last modified before cutoff."""
+    return any(entry['Key'] == key and _timestamp(entry['LastModified']) < cutoff
+               for entry in self._list(key))
+
+  def _read_pointer(self, key):
+    body = self._client().get_object(Bucket=self._bucket, Key=key)['Body'].read()
+    return parse_blob_pointer(body)
+
+
+class LayoutMigrator(_RemoteCache):
+  """Copies the artifacts of an S3 artifact cache from the unsharded key layout to the sharded.
+
+  Targets are copied in parallel. Each target's artifacts are copied oldest first, so that their
+  copies' modification times keep the order garbage collection goes by. Artifacts already in the
+  sharded layout are left alone, so an interrupted migration can be rerun.
+  """
+
+  def migrate(self, delete_unsharded=False, dry_run=False):
+    """Copies the artifacts, or only finds them if dry_run.
+
+    :param bool delete_unsharded: Delete each target's unsharded artifacts once it is copied.
+    :returns: The number of objects and of bytes that were (or would be) copied.
+    :rtype: tuple of (int, int)
+    """
+    with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+      migrated = list(pool.map(lambda prefix: self._migrate_target(prefix, dry_run),
+                               self._unsharded_prefixes()))
+      if delete_unsharded and not dry_run:
+        self._delete_all(pool, [entry['Key'] for objects in migrated for entry in objects])
+    copied = [entry for objects in migrated for entry in objects if entry['Copied']]
+    return len(copied), sum(entry['Size'] for entry in copied)
+
+  def _migrate_target(self, prefix, dry_run):
+    """Copies the artifacts under prefix that aren't in the sharded layout yet.
+
+    :returns: Every artifact under prefix, marked with whether it was (or would be) copied.
+    """
+    target_id = prefix[len(self._root):-1]
+    sharded_prefix = '{0}{1}/{2}/'.format(self._root, shard_dir(target_id), target_id)
+    present = set(entry['Key'][len(sharded_prefix):] for entry in self._list(sharded_prefix))
+    objects = sorted(self._list(prefix), key=lambda entry: entry['LastModified'])
+    for entry in objects:
+      name = entry['Key'][len(prefix):]
+      entry['Copied'] = name not in present
+      if entry['Copied'] and not dry_run:
+        self._client().copy_object(Bucket=self._bucket, Key=sharded_prefix + name,
+                                   CopySource={'Bucket': self._bucket, 'Key': entry['Key']})
+    return objects
+
+
+class _CacheUrls(object):
+  """Mixes in an option for the s3:// cache roots to operate on."""
+
+  @classmethod
+  def register_options(cls, register):
+    super(_CacheUrls, cls).register_options(register)
+    register('--urls', type=list, default=[],
+             help='s3:// cache roots to operate on. Defaults to the S3 URLs in the cache '
+                  'scope\'s --read-from and --write-to.')
+
+  def _s3_urls(self):
+    urls = self.get_options().urls
+    if not urls:
+      cache_options = self.context.options.for_scope('cache')
+      specs = (cache_options.read_from or []) + (cache_options.write_to or [])
+      urls = [url for spec in specs for url in spec.split('|') if url.startswith('s3://')]
+    return sorted(set(urls))
+
+
+class S3CacheGarbageCollect(_CacheUrls, Task):
+  """Deletes old artifacts from S3 artifact caches, keeping the newest few of every target."""
+
+  @classmethod
+  def register_options(cls, register):
+    super(S3CacheGarbageCollect, cls).register_options(register)
+    register('--keep-per-target', type=int, default=5,
+             help='Number of artifacts to keep for each target. Every task caching a target '
+                  'stores its artifacts under the same prefix, so leave room for all of them.')
+    register('--keep-within', type=int, default=7 * 24 * 60 * 60,
+             help='Keep every artifact written within this many seconds.')
+    register('--concurrency', type=int, default=16,
+             help='Number of S3 requests to make in parallel.')
+    register('--dry-run', type=bool, default=False,
+             help='Only report how much would be deleted.')
+
+  def execute(self):
+    urls = self._s3_urls()
+    if not urls:
+      raise TaskError('No S3 artifact caches to collect: set --urls.')
+
+    options = self.get_options()
+    for url in urls:
+      collector = RemoteCacheCollector(url, options.keep_per_target, options.keep_within,
+                                       options.concurrency)
+      count, freed = collector.collect(dry_run=options.dry_run)
+      self.context.log.info('{0} {1} objects ({2} bytes) from {3}'.format(
+        'Would delete' if options.dry_run else 'Deleted', count, freed, url))
+
+
+class S3CacheMigrate(_CacheUrls, Task):
+  """Copies artifacts in S3 artifact caches to the layout used with --cache-s3-sharded-keys."""
+
+  @classmethod
+  def register_options(cls, register):
+    super(S3CacheMigrate, cls).register_options(register)
+    register('--concurrency', type=int, default=16,
+             help='Number of targets to copy in parallel.')
+    register('--delete-unsharded', type=bool, default=False,
+             help='Delete the artifacts under their old keys once they are copied. Only do this '
+                  'once nothing reads the cache without --cache-s3-sharded-keys.')
+    register('--dry-run', type=bool, default=False,
+             help='Only report how much would be copied.')
+
+  def execute(self):
+    urls = self._s3_urls()
+    if not urls:
+      raise TaskError('No S3 artifact caches to migrate: set --urls.')
+
+    options = self.get_options()
+    for url in urls:
+      migrator = LayoutMigrator(url, options.concurrency)
+      count, copied = migrator.migrate(delete_unsharded=options.delete_unsharded,
+                                       dry_run=options.dry_run)
+      self.context.log.info('{0} {1} objects ({2} bytes) in {3}'.format(
+        'Would copy' if options.dry_run else 'Copied', count, copied, url))
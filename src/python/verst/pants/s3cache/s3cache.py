@@ -1,31 +1,68 @@
+import calendar
+import hashlib
 import logging
 import os
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain
 
-import boto3
-from botocore import exceptions
-from botocore.config import Config
-from botocore.vendored.requests import ConnectionError, Timeout
-from botocore.vendored.requests.packages.urllib3.exceptions import ClosedPoolError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pants.cache.artifact import ArtifactError
 from pants.cache.artifact_cache import (ArtifactCache,
                                         NonfatalArtifactCacheError,
                                         UnreadableArtifact)
+from pants.cache.local_artifact_cache import TempLocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import open_tar
+from pants.util.dirutil import safe_delete, safe_mkdir
 from pyjavaproperties import Properties
 from six.moves.urllib.parse import urlparse
+from verst.pants.s3cache.circuit_breaker import CircuitBreaker
+from verst.pants.s3cache.compression import (compressor,
+                                             decode,
+                                             GZIP,
+                                             LZ4,
+                                             transcode,
+                                             ZSTD)
+from verst.pants.s3cache.hedging import hedged, latencies
+from verst.pants.s3cache.listings import Head, heads, listings
+from verst.pants.s3cache import metrics, timeouts
+from verst.pants.s3cache.negative_cache import NegativeLookupCache
+from verst.pants.s3cache.streaming import extract_stream
+from verst.pants.s3cache.timeouts import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT,
+                                          TimeoutPolicy)
+from verst.pants.s3cache.write_behind import (DEFAULT_MAX_IN_FLIGHT_BYTES,
+                                              get_uploader, spool)
 
-# Yeah, I know it's gross but it spams the logs without it:
-boto3.set_stream_logger(name='boto3.resources', level=logging.WARN)
-boto3.set_stream_logger(name='botocore', level=logging.WARN)
+# NB: boto3 and botocore are only imported once S3 is actually used; importing them costs more
+# than the rest of the plugin, and every pants run loads this module whether it caches or not.
 
 logger = logging.getLogger(__name__)
 CONFIG_FILE = os.path.expanduser('~/.pants/.s3credentials')
 
-_NETWORK_ERRORS = [
-  ConnectionError, Timeout, ClosedPoolError,
-  exceptions.EndpointConnectionError, exceptions.ChecksumError
-]
 
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+
+def connect_to_s3(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                  connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                  region_name=None):
+  """Returns a new low-level S3 client.
+
+  Unlike boto3 resources and sessions, clients are safe to share between threads.
+
+  :param str region_name: Region to send requests to; None uses the configured default.
+  """
+  import boto3
+  from botocore.config import Config
+
+  # Yeah, I know it's gross but it spams the logs without it:
+  boto3.set_stream_logger(name='boto3.resources', level=logging.WARN)
+  boto3.set_stream_logger(name='botocore', level=logging.WARN)
 
-def connect_to_s3():
   boto_kwargs = {}
   try:
     with open(CONFIG_FILE, 'r') as f:
@@ -44,12 +81,77 @@ def connect_to_s3():
   except IOError:
     logger.debug('Could not load {0}, using ENV vars'.format(CONFIG_FILE))
 
-  config = Config(connect_timeout=4, read_timeout=4)
-  return boto3.resource('s3', config=config, **boto_kwargs)
+  config = Config(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                  max_pool_connections=max_pool_connections)
+  return boto3.session.Session(**boto_kwargs).client('s3', region_name=region_name,
+                                                     config=config)
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+class _RequestTimeouts(threading.local):
+  """The timeouts each thread last got each client with, by the client's settings."""
+
+  def __init__(self):
+    self.by_client = {}
+
+
+_request_timeouts = _RequestTimeouts()
+
+
+def get_s3_client(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                  connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                  region_name=None):
+  """Returns this process' S3 client for the given pool size and region, connecting on first use.
+
+  The requests the calling thread sends through the client, until it next gets it, are sent with
+  the given timeouts. Timeouts are applied per request so that they share one client, and the
+  process keeps at most max_pool_connections connections open to each region.
+
+  Connections aren't shared with forked pants workers: a process that didn't create the client
+  creates its own.
+  """
+  global _clients_pid
+  settings = (max_pool_connections, region_name)
+  with _clients_lock:
+    if _clients_pid != os.getpid():
+      _clients.clear()
+      _clients_pid = os.getpid()
+    client = _clients.get(settings)
+  if client is None:
+    # Connecting is slow, so it's done without holding up the threads using other clients.
+    connected = connect_to_s3(max_pool_connections, region_name=region_name)
+    _send_with_request_timeouts(connected, settings)
+    with _clients_lock:
+      client = _clients.setdefault(settings, connected)
+  _request_timeouts.by_client[settings] = (connect_timeout, read_timeout)
+  return client
+
+
+def _send_with_request_timeouts(client, settings):
+  """Has client send each request with the timeouts its thread last got the client with."""
+  session = client._endpoint.http_session
+  send = session.send
+
+  def send_with_request_timeouts(request, **kwargs):
+    timeouts = _request_timeouts.by_client.get(settings)
+    if timeouts:
+      kwargs['timeout'] = timeouts
+    return send(request, **kwargs)
+  session.send = send_with_request_timeouts
 
-s3 = connect_to_s3()
 
 READ_SIZE_BYTES = 4 * 1024 * 1024
+DEFAULT_DOWNLOAD_PART_SIZE_BYTES = 16 * 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD_BYTES = 64 * 1024 * 1024
+DEFAULT_MULTIPART_PART_SIZE_BYTES = 16 * 1024 * 1024
+# S3 rejects multipart uploads whose parts (other than the last) are smaller than this.
+MIN_MULTIPART_PART_SIZE_BYTES = 5 * 1024 * 1024
+# S3 rejects single copies of bigger objects.
+MAX_COPY_BYTES = 5 * 1024 * 1024 * 1024
 
 
 def iter_content(body):
@@ -60,18 +162,137 @@ def iter_content(body):
     yield chunk
 
 
+# Body of a pointer object in the content-addressed layout; followed by the blob's name, its hex
+# digest and extension. Compressed streams start with their codec's magic number, so a pointer
+# can't be mistaken for an artifact.
+_BLOB_POINTER_PREFIX = b'verst-s3cache-blob sha256:'
+# Blobs are named by their digest, with an extension for the codec they are stored in.
+_BLOB_EXTENSIONS = {GZIP: 'tgz', ZSTD: 'tar.zst', LZ4: 'tar.lz4'}
+# An insert reusing a blob last written longer ago than this rewrites it, and garbage collection
+# only deletes blobs older than this.
+BLOB_REFRESH_SECONDS = 60 * 60
+# Blobs live in this directory under the cache's path, beside the target id prefixes.
+BLOBS_DIR = '_blobs'
+# Target id prefixes of the sharded layout live in subdirectories of this one.
+SHARDS_DIR = '_shards'
+# Number of a target's newest artifacts `seed_key` checks for one cached by the same task.
+_SEED_CANDIDATES = 4
+
+
+def shard_dir(target_id):
+  """Returns the directory, relative to the cache's path, of target_id's sharded prefix.
+
+  Target ids share long common prefixes (`src.java.com.example...`), so S3, which partitions a
+  bucket by key range, serves most of them from a handful of partitions. A hash of the id in
+  front of it spreads them evenly over 256.
+  """
+  return '{0}/{1}'.format(SHARDS_DIR, hashlib.sha1(target_id.encode('utf-8')).hexdigest()[:2])
+
+
+def parse_blob_pointer(data):
+  """Returns the name of the blob data points to if it is (the start of) a pointer object, else
+  None.
+
+  Pointers written before blobs were named by their codec hold just the digest of a `.tgz` blob.
+  """
+  if not data.startswith(_BLOB_POINTER_PREFIX):
+    return None
+  name = data[len(_BLOB_POINTER_PREFIX):].strip().decode('ascii')
+  return name if '.' in name else '{0}.{1}'.format(name, _BLOB_EXTENSIONS[GZIP])
+
+
+def content_digest(tarfile):
+  """Returns the sha256 hex digest of the uncompressed contents of the artifact at tarfile.
+
+  Digesting the tar stream rather than the file ignores the gzip header, which records when and
+  under what temporary name the artifact was compressed, and the compression level.
+  """
+  digest = hashlib.sha256()
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  with open(tarfile, 'rb') as infile:
+    for chunk in iter_content(infile):
+      try:
+        digest.update(decompressor.decompress(chunk))
+      except zlib.error:
+        # Not gzipped (compression level 0): digest the raw bytes.
+        return _file_digest(tarfile)
+  return digest.hexdigest()
+
+
+def _file_digest(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as infile:
+    for chunk in iter_content(infile):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+class DigestMismatchError(NonfatalArtifactCacheError):
+  """The bytes downloaded for an artifact don't match the digest it was uploaded with."""
+
+
+def _verified(chunks, get_result, key):
+  """Returns chunks, checked as they are consumed against the object's recorded sha256.
+
+  Objects without one (pointers, artifacts uploaded before digests were recorded, and multipart
+  uploads too big to copy) are returned unchecked.
+
+  :param get_result: The response of the GET (or first ranged GET) of the object.
+  """
+  expected = get_result.get('Metadata', {}).get('sha256')
+  if not expected:
+    return chunks
+  return _check_digest(chunks, expected, key)
+
+
+def _check_digest(chunks, expected, key):
+  digest = hashlib.sha256()
+  for chunk in chunks:
+    digest.update(chunk)
+    yield chunk
+  if digest.hexdigest() != expected:
+    raise DigestMismatchError('Downloaded {0} with sha256 {1}, expected {2}'.format(
+      key, digest.hexdigest(), expected))
+
+
+def _byte_range(start, end):
+  """Returns an HTTP Range header value for the half-open interval [start, end)."""
+  return 'bytes={0}-{1}'.format(start, end - 1)
+
+
+def _content_range_size(get_result):
+  """Returns the full object size from the Content-Range of a ranged GET response."""
+  return int(get_result['ContentRange'].rsplit('/', 1)[1])
+
+
 def _not_found_error(e):
+  from botocore import exceptions
+
   if not isinstance(e, exceptions.ClientError):
     return False
   return e.response['Error']['Code'] in ('404', 'NoSuchKey')
 
 
+def _precondition_failed(e):
+  from botocore import exceptions
+
+  return (isinstance(e, exceptions.ClientError) and
+          e.response['Error']['Code'] in ('412', 'PreconditionFailed'))
+
+
 def _network_error(e):
-  return any(isinstance(e, cls) for cls in _NETWORK_ERRORS)
+  from botocore import exceptions
+  from botocore.vendored.requests import ConnectionError, Timeout
+  from botocore.vendored.requests.packages.urllib3.exceptions import ClosedPoolError
+
+  return isinstance(e, (ConnectionError, Timeout, ClosedPoolError,
+                        exceptions.EndpointConnectionError, exceptions.ChecksumError))
 
 _NOT_FOUND = 0
 _NETWORK = 1
 _UNKNOWN = 2
+_METRIC_OUTCOMES = {_NOT_FOUND: metrics.MISS, _NETWORK: metrics.NETWORK,
+                    _UNKNOWN: metrics.UNKNOWN}
 
 
 def _log_and_classify_error(e, verb, cache_key):
@@ -85,14 +306,208 @@ def _log_and_classify_error(e, verb, cache_key):
   return _UNKNOWN
 
 
+class _StreamingUpload(object):
+  """A file whose contents are uploaded to an S3 key as they are written.
+
+  Once multipart_threshold bytes have been written, a multipart upload is started and parts are
+  uploaded as they fill, upload_concurrency at a time; writes block while that many are in
+  flight. Smaller artifacts are uploaded with a single PUT when the file is closed. The sha256 of
+  the bytes is recorded in the object's metadata either way: when the upload starts if it is
+  given, and otherwise computed as the bytes are written, and recorded once a multipart upload is
+  complete by copying the object onto itself.
+  """
+
+  def __init__(self, cache, key, digest=None):
+    """
+    :param str digest: The sha256 hex digest of the bytes that will be written, if known.
+    """
+    self._cache = cache
+    self._key = key
+    self._buffer = bytearray()
+    self._upload_id = None
+    self._pool = None
+    self._parts = []
+    self._size = 0
+    self._known_digest = digest
+    self._digest = None if digest else hashlib.sha256()
+
+  def write(self, data):
+    self._size += len(data)
+    if self._digest:
+      self._digest.update(data)
+    self._buffer += data
+    if self._upload_id is None and len(self._buffer) < self._cache._multipart_threshold:
+      return
+    part_size = self._cache._multipart_part_size
+    while len(self._buffer) >= part_size:
+      self._submit(bytes(self._buffer[:part_size]))
+      del self._buffer[:part_size]
+
+  def close(self):
+    if self._upload_id is None:
+      self._cache._put_object(self._key, bytes(self._buffer), digest=self._hexdigest())
+      return
+    if self._buffer:
+      self._submit(bytes(self._buffer))
+    etags = [part.result() for part in self._parts]
+    self._pool.shutdown()
+    # S3 can take a while to assemble a large object.
+    response = self._cache._client(self._size).complete_multipart_upload(
+      Bucket=self._cache._bucket, Key=self._key, UploadId=self._upload_id,
+      MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag}
+                                 for number, etag in enumerate(etags, 1)]})
+    metrics.add_bytes(self._size)
+    if not self._known_digest:
+      self._cache._record_digest(self._key, response['ETag'], self._size, self._hexdigest())
+
+  def abort(self):
+    if self._upload_id is None:
+      return
+    for part in self._parts:
+      part.cancel()
+    self._pool.shutdown(wait=False)
+    self._cache._abort_multipart_upload(self._key, self._upload_id)
+
+  def _hexdigest(self):
+    return self._known_digest or self._digest.hexdigest()
+
+  def _submit(self, body):
+    if self._upload_id is None:
+      self._upload_id = self._cache._create_multipart_upload(self._key, self._known_digest)
+      self._pool = ThreadPoolExecutor(max_workers=self._cache._upload_concurrency)
+    in_flight = [part for part in self._parts if not part.done()]
+    if len(in_flight) >= self._cache._upload_concurrency:
+      wait(in_flight, return_when=FIRST_COMPLETED)
+    for part in self._parts:
+      if part.done() and part.exception():
+        raise part.exception()
+    number = len(self._parts) + 1
+    self._parts.append(self._pool.submit(self._cache._put_part, self._key, self._upload_id,
+                                         number, body))
+
+
+class _CompressingWriter(object):
+  """A file that compresses what is written to it into an upload, and optionally a local copy."""
+
+  def __init__(self, compressor, upload, local_copy=None, local_compressed=True):
+    """
+    :param compressor: Compresses the written bytes, like a zlib compressobj.
+    :param upload: File to write the compressed bytes to.
+    :param local_copy: File to also write the bytes to, if any.
+    :param bool local_compressed: Whether local_copy gets the compressed or the written bytes.
+    """
+    self._compressor = compressor
+    self._upload = upload
+    self._local_copy = local_copy
+    self._local_compressed = local_compressed
+
+  def write(self, data):
+    if self._local_copy and not self._local_compressed:
+      self._local_copy.write(data)
+    self._emit(self._compressor.compress(data))
+
+  def finish(self):
+    """Writes the rest of the compressed bytes, and closes the upload."""
+    self._emit(self._compressor.flush())
+    self._upload.close()
+
+  def _emit(self, data):
+    if data:
+      if self._local_copy and self._local_compressed:
+        self._local_copy.write(data)
+      self._upload.write(data)
+
+
 class S3ArtifactCache(ArtifactCache):
   """An artifact cache that stores the artifacts on S3."""
 
-  def __init__(self, artifact_root, s3_url, local):
+  def __init__(self, artifact_root, s3_url, local,
+               download_part_size=DEFAULT_DOWNLOAD_PART_SIZE_BYTES, download_concurrency=1,
+               multipart_threshold=DEFAULT_MULTIPART_THRESHOLD_BYTES,
+               multipart_part_size=DEFAULT_MULTIPART_PART_SIZE_BYTES,
+               upload_concurrency=4, upload_retries=2,
+               write_behind=False, write_behind_workers=2,
+               write_behind_max_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES,
+               bulk_lookup=False, lookup_concurrency=16,
+               negative_cache_ttl=0, negative_cache_max_entries=10000,
+               circuit_breaker_threshold=3, circuit_breaker_window=60,
+               circuit_breaker_cooldown=120,
+               max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+               content_addressed=False, stream_extract=False, hedge_percentile=0,
+               connect_timeout_floor=DEFAULT_CONNECT_TIMEOUT,
+               connect_timeout_ceiling=DEFAULT_CONNECT_TIMEOUT,
+               read_timeout_floor=DEFAULT_READ_TIMEOUT,
+               read_timeout_ceiling=DEFAULT_READ_TIMEOUT,
+               sharded_keys=False, legacy_key_fallback=True, codec=GZIP, codec_level=None,
+               compression_threads=1, seed_incremental=False,
+               metrics_dir=None, task_name=None):
     """
     :param artifact_root: The path under which cacheable products will be read/written
     :param s3_url: URL of the form s3://bucket/path/to/store/artifacts
     :param BaseLocalArtifactCache local: local cache instance for storing and creating artifacts
+    :param int download_part_size: Size in bytes of each byte range fetched by a ranged download.
+    :param int download_concurrency: Number of byte ranges of one artifact to fetch in parallel;
+                                     1 downloads each artifact with a single GET.
+    :param int multipart_threshold: Artifacts of at least this many bytes are uploaded with a
+                                    multipart upload; smaller ones with a single PUT.
+    :param int multipart_part_size: Size in bytes of each part of a multipart upload.
+    :param int upload_concurrency: Number of parts of one artifact to upload in parallel.
+    :param int upload_retries: Number of times to retry a failed part before giving up.
+    :param bool write_behind: Return from inserts as soon as the artifact is created, and upload
+                              it on a background thread that is flushed at exit.
+    :param int write_behind_workers: Number of background upload threads per process.
+    :param int write_behind_max_bytes: Inserts block while this many bytes are waiting to upload.
+    :param bool bulk_lookup: Answer `has` by listing the target's prefix once per run, rather
+                             than with a HEAD per key, and have tasks look their targets up
+                             with `has_all` before fetching the hits.
+    :param int lookup_concurrency: Number of prefixes `has_all` lists in parallel.
+    :param int negative_cache_ttl: Seconds to remember on disk that a key was missing, so later
+                                   runs don't ask S3 again; 0 disables the negative cache.
+    :param int negative_cache_max_entries: Approximate number of misses to remember.
+    :param int circuit_breaker_threshold: Stop sending requests after this many network failures
+                                          within circuit_breaker_window seconds; 0 never stops.
+    :param int circuit_breaker_window: Seconds over which network failures are counted.
+    :param int circuit_breaker_cooldown: Seconds to skip the remote cache for before trying it
+                                         again.
+    :param int max_pool_connections: Size of the S3 client's connection pool, shared by every
+                                     thread of the process.
+    :param bool content_addressed: Store artifact bytes once per content digest, with each cache
+                                   key holding a small pointer to its blob. Pointers are
+                                   followed when reading whether or not this is set.
+    :param bool stream_extract: Extract downloaded artifacts as their bytes arrive, rather than
+                                after writing the whole tarball to disk. The tarball is still
+                                kept if the local cache is persistent.
+    :param float hedge_percentile: Send a second GET for an artifact if the first hasn't
+                                   responded within this percentile of recent GET latencies,
+                                   and use whichever responds first; 0 never hedges.
+    :param float connect_timeout_floor: Shortest connect timeout to adapt down to, in seconds.
+    :param float connect_timeout_ceiling: Longest connect timeout to adapt up to, in seconds.
+    :param float read_timeout_floor: Shortest read timeout to adapt down to, in seconds.
+    :param float read_timeout_ceiling: Longest read timeout to adapt up to, in seconds; large
+                                       transfers are allowed up to this long at the measured
+                                       throughput.
+    :param bool sharded_keys: Store artifacts under `<path>/_shards/<hash>/<id>/` rather than
+                              `<path>/<id>/`, spreading requests over more S3 partitions.
+    :param bool legacy_key_fallback: With sharded_keys, also look artifacts up under the
+                                     unsharded key, until the `s3-cache-migrate` goal has copied
+                                     them over.
+    :param str codec: Compression to store artifacts in S3 with: gzip, which is what the local
+                      cache creates, or zstd or lz4, which artifacts are transcoded to as they're
+                      uploaded. Artifacts in any of them are read back.
+    :param int codec_level: The codec's compression level, or None for its default. Ignored for
+                            gzip, which is compressed at the local cache's level.
+    :param int compression_threads: Compress artifacts on this many threads, uploading them as
+                                    they are compressed rather than having the local cache
+                                    create a tarball first; 1 leaves it to the local cache. Not
+                                    used with write_behind or content_addressed, which upload
+                                    from a finished tarball.
+    :param bool seed_incremental: Have `seed_key` find the most recent artifact of a missed
+                                  target, for incremental tasks to start building from.
+    :param str metrics_dir: Directory to spool the metrics of the operations made on S3 to, for
+                            the run tracker to collect; None keeps them in memory.
+    :param str task_name: Stable name of the task the cache belongs to, recorded on each
+                          artifact it uploads so `seed_key` only seeds from the task's own
+                          artifacts; None disables seeding.
     """
     super(S3ArtifactCache, self).__init__(artifact_root)
     url = urlparse(s3_url)
@@ -102,66 +517,786 @@ class S3ArtifactCache(ArtifactCache):
       self._path = self._path[1:]
     self._localcache = local
     self._bucket = url.netloc
+    self._download_part_size = download_part_size
+    self._download_concurrency = download_concurrency
+    self._multipart_threshold = multipart_threshold
+    self._multipart_part_size = multipart_part_size
+    self._upload_concurrency = upload_concurrency
+    self._upload_retries = upload_retries
+    self._write_behind = write_behind
+    self._write_behind_workers = write_behind_workers
+    self._write_behind_max_bytes = write_behind_max_bytes
+    self._bulk_lookup = bulk_lookup
+    self._lookup_concurrency = lookup_concurrency
+    self._negative_cache = None
+    if negative_cache_ttl > 0:
+      self._negative_cache = NegativeLookupCache(
+        os.path.join(artifact_root, 's3cache', 'misses'), negative_cache_ttl,
+        negative_cache_max_entries)
+    self._max_pool_connections = max_pool_connections
+    self._content_addressed = content_addressed
+    self._stream_extract = stream_extract
+    self._hedge_percentile = hedge_percentile
+    self._timeouts = TimeoutPolicy(connect_timeout_floor, connect_timeout_ceiling,
+                                   read_timeout_floor, read_timeout_ceiling)
+    self._sharded_keys = sharded_keys
+    self._legacy_key_fallback = legacy_key_fallback
+    self._codec = codec
+    self._codec_level = codec_level
+    self._compression_threads = compression_threads
+    self._seed_incremental = seed_incremental
+    self._metrics_dir = metrics_dir
+    self._task_name = task_name
+    self._breaker = None
+    if circuit_breaker_threshold > 0:
+      self._breaker = CircuitBreaker(
+        'S3 artifact cache {0}'.format(s3_url),
+        os.path.join(artifact_root, 's3cache', 'circuit-open-{0}'.format(self._bucket)),
+        circuit_breaker_threshold, circuit_breaker_window, circuit_breaker_cooldown)
 
   def try_insert(self, cache_key, paths):
     logger.debug('Insert {0}'.format(cache_key))
+    # Write-behind needs a tarball to spool, and content addressing needs the artifact's digest
+    # before it knows where to upload it.
+    streaming = (self._compression_threads > 1 and not self._write_behind and
+                 not self._content_addressed)
+    if streaming and self._remote_allowed('PUT', cache_key):
+      self._stream_insert(cache_key, paths)
+      return
     # Delegate creation of artifacts to the local cache
     with self._localcache.insert_paths(cache_key, paths) as tarfile:
-      with open(tarfile, 'rb') as infile:
-        # Upload artifact to the remote cache.
+      if self._write_behind:
+        self._queue_upload(cache_key, tarfile)
+      else:
+        self._upload(cache_key, tarfile)
+
+  def _queue_upload(self, cache_key, tarfile):
+    """Hands a copy of the artifact at tarfile to the write-behind uploader."""
+    try:
+      spooled_file = spool(tarfile, os.path.join(self.artifact_root, 's3cache', 'write-behind'))
+    except Exception as e:
+      raise NonfatalArtifactCacheError(
+        'Failed to queue PUT (core error) {0}: {1}'.format(cache_key, str(e)))
+    uploader = get_uploader(self._write_behind_workers, self._write_behind_max_bytes)
+    uploader.submit(cache_key, spooled_file, lambda path: self._upload(cache_key, path))
+
+  def _upload(self, cache_key, tarfile):
+    """Uploads the artifact at tarfile to the remote cache."""
+    with self._measured(metrics.PUT) as measurement:
+      if not self._remote_allowed('PUT', cache_key):
+        return
+      with self._putting(cache_key):
+        if self._content_addressed:
+          self._put_blob_and_pointer(cache_key, tarfile)
+        else:
+          self._put_artifact(self._path_for_key(cache_key), tarfile)
+      measurement.found(True)
+
+  def _stream_insert(self, cache_key, paths):
+    """Tars and compresses paths on compression_threads threads, uploading the artifact as it is
+    compressed.
+
+    A persistent local cache is written a copy along the way, which it stores once the upload
+    succeeds.
+    """
+    level = self._localcache._compression if self._codec == GZIP else self._codec_level
+    with self._measured(metrics.PUT) as measurement:
+      with self._putting(cache_key), self._local_copy(cache_key) as local_copy:
+        upload = _StreamingUpload(self, self._path_for_key(cache_key))
         try:
-          response = self._get_object(cache_key).put(Body=infile)
-          response_status = response['ResponseMetadata']['HTTPStatusCode']
-          if response_status < 200 or response_status >= 300:
-            raise NonfatalArtifactCacheError('Failed to PUT (http error) {0}: {1}'.format(
-              cache_key, response_status))
-        except Exception as e:
-          raise NonfatalArtifactCacheError(
-            'Failed to PUT (core error) {0}: {1}'.format(cache_key, str(e)))
+          # Pants' local caches read plain tarballs, but not the other codecs.
+          writer = _CompressingWriter(compressor(self._codec, level, self._compression_threads),
+                                      upload, local_copy, local_compressed=self._codec == GZIP)
+          with open_tar(writer, 'w|', dereference=self._localcache._dereference,
+                        errorlevel=2) as tarout:
+            for path in paths:
+              tarout.add(path, os.path.relpath(path, self.artifact_root))
+          writer.finish()
+        except Exception:
+          upload.abort()
+          raise
+      measurement.found(True)
+
+  @contextmanager
+  def _local_copy(self, cache_key):
+    """Yields a file for a copy of an artifact being inserted, which the local cache stores if
+    the block succeeds; or None if the local cache wouldn't keep it."""
+    if isinstance(self._localcache, TempLocalArtifactCache):
+      yield None
+      return
+    with self._localcache._tmpfile(cache_key, 'write') as tmp:
+      yield tmp
+      tmp.close()
+      self._localcache._store_tarball(cache_key, tmp.name)
+
+  @contextmanager
+  def _putting(self, cache_key):
+    """Records the outcome of uploading cache_key's artifact in the block."""
+    try:
+      yield
+    except Exception as e:
+      self._record_outcome(_NETWORK if _network_error(e) else _UNKNOWN)
+      raise NonfatalArtifactCacheError(
+        'Failed to PUT (core error) {0}: {1}'.format(cache_key, str(e)))
+    self._record_outcome()
+    path = self._path_for_key(cache_key)
+    listings.add(self._bucket, self._prefix_for_key(cache_key), path)
+    heads.discard(self._bucket, path)
+    if self._negative_cache:
+      self._negative_cache.clear(self._bucket, self._path_for_key(cache_key))
+
+  def _put_blob_and_pointer(self, cache_key, tarfile):
+    """Uploads tarfile under its content digest, unless it is already there, and points the
+    cache key at it."""
+    blob_name = '{0}.{1}'.format(content_digest(tarfile), _BLOB_EXTENSIONS[self._codec])
+    blob_key = self._blob_key(blob_name)
+    if self._refresh_blob(blob_key):
+      logger.debug('Reusing blob {0} for {1}'.format(blob_name, cache_key))
+    else:
+      self._put_artifact(blob_key, tarfile)
+    heads.discard(self._bucket, blob_key)
+    pointer = _BLOB_POINTER_PREFIX + blob_name.encode('ascii')
+    self._client().put_object(Bucket=self._bucket, Key=self._path_for_key(cache_key),
+                              Body=pointer, Metadata=self._task_metadata())
+    metrics.add_bytes(len(pointer))
+
+  def _refresh_blob(self, key):
+    """Returns whether the blob at key exists, first copying it onto itself if it was last written
+    over BLOB_REFRESH_SECONDS ago.
+
+    No pointer may refer to a blob that is about to be reused, so garbage collection could be
+    deleting it; once it is rewritten, garbage collection leaves it alone for long enough for the
+    new pointer to be written.
+    """
+    try:
+      with self._timed():
+        response = self._client().head_object(Bucket=self._bucket, Key=key)
+    except Exception as e:
+      if not _not_found_error(e):
+        raise
+      return False
+    age = time.time() - calendar.timegm(response['LastModified'].utctimetuple())
+    if age < BLOB_REFRESH_SECONDS:
+      return True
+    if response['ContentLength'] > MAX_COPY_BYTES:
+      return False  # Uploaded again instead.
+    self._client().copy_object(Bucket=self._bucket, Key=key,
+                               CopySource={'Bucket': self._bucket, 'Key': key},
+                               CopySourceIfMatch=response['ETag'], MetadataDirective='REPLACE',
+                               Metadata=response.get('Metadata', {}))
+    return True
+
+  def _head(self, key):
+    """Returns the Head of key, or False if it's missing, making a HEAD request unless the key
+    was already looked up this run."""
+    head = heads.get(self._bucket, key)
+    if head is None:
+      try:
+        with self._timed():
+          response = self._client().head_object(Bucket=self._bucket, Key=key)
+        head = Head(response['ContentLength'], response['ETag'])
+      except Exception as e:
+        if not _not_found_error(e):
+          raise
+        head = False
+      heads.put(self._bucket, key, head)
+    return head
+
+  def _put_artifact(self, key, tarfile):
+    """Uploads the gzipped artifact at tarfile to key, in the configured codec."""
+    if self._codec == GZIP:
+      self._put_file(key, tarfile)
+      return
+    encoded = '{0}.{1}'.format(tarfile, self._codec)
+    try:
+      transcode(tarfile, encoded, self._codec, self._codec_level)
+      self._put_file(key, encoded)
+    finally:
+      safe_delete(encoded)
+
+  def _put_file(self, key, tarfile):
+    """Uploads tarfile, with a multipart upload if it is at least multipart_threshold bytes.
+
+    The file is digested before the upload starts, so that a multipart upload is created with the
+    digest in its metadata rather than copied once complete to add it. If any part still fails
+    after its retries, a multipart upload is aborted so that S3 doesn't keep (and bill for) the
+    parts that did make it.
+    """
+    upload = _StreamingUpload(self, key, digest=_file_digest(tarfile))
+    try:
+      with open(tarfile, 'rb') as infile:
+        for chunk in iter_content(infile):
+          upload.write(chunk)
+      upload.close()
+    except Exception:
+      upload.abort()
+      raise
+
+  def _put_object(self, key, body, size=None, digest=None):
+    """Uploads body, a file or bytes, to key with a single PUT.
+
+    :param str digest: The sha256 hex digest of body, recorded for downloads to verify.
+    """
+    size = len(body) if size is None else size
+    with self._timed(size):
+      response = self._client(size).put_object(Bucket=self._bucket, Key=key, Body=body,
+                                               Metadata=self._metadata(digest))
+    response_status = response['ResponseMetadata']['HTTPStatusCode']
+    if response_status < 200 or response_status >= 300:
+      raise NonfatalArtifactCacheError('Failed to PUT (http error) {0}: {1}'.format(
+        key, response_status))
+    metrics.add_bytes(size)
+
+  def _create_multipart_upload(self, key, digest=None):
+    return self._client().create_multipart_upload(Bucket=self._bucket, Key=key,
+                                                  Metadata=self._metadata(digest))['UploadId']
+
+  def _record_digest(self, key, etag, size, digest):
+    """Records digest in the metadata of the multipart upload at key, which has the given ETag.
+
+    A streamed multipart upload's metadata is fixed before its content is known, so the object is
+    copied onto itself with the digest added. The copy is skipped if the object has been
+    overwritten since, and objects too big for a single copy are left unverified.
+    """
+    if size > MAX_COPY_BYTES:
+      logger.debug('Not recording the digest of {0}: too big to copy'.format(key))
+      return
+    try:
+      # The copy is made within S3, which keeps the connection alive while it works, so it isn't
+      # given the timeouts of a transfer of size bytes.
+      self._client().copy_object(Bucket=self._bucket, Key=key,
+                                 CopySource={'Bucket': self._bucket, 'Key': key},
+                                 CopySourceIfMatch=etag, MetadataDirective='REPLACE',
+                                 Metadata=self._metadata(digest))
+    except Exception as e:
+      # The upload itself succeeded; downloads of it just go unverified.
+      logger.warn('Failed to record the digest of {0}, so downloads of it will not be verified: '
+                  '{1}'.format(key, str(e)))
+
+  def _metadata(self, digest):
+    metadata = self._task_metadata()
+    metadata['codec'] = self._codec
+    if digest:
+      metadata['sha256'] = digest
+    return metadata
+
+  def _task_metadata(self):
+    return {'task': self._task_name} if self._task_name else {}
+
+  def _abort_multipart_upload(self, key, upload_id):
+    try:
+      self._client().abort_multipart_upload(Bucket=self._bucket, Key=key, UploadId=upload_id)
+    except Exception as e:
+      logger.debug('Failed to abort multipart upload of {0}: {1}'.format(key, str(e)))
+
+  def _put_part(self, key, upload_id, number, body):
+    """Uploads body as part number of the multipart upload, retrying if it fails."""
+    attempt = 0
+    while True:
+      try:
+        with self._timed(len(body)):
+          response = self._client(len(body)).upload_part(
+            Bucket=self._bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body)
+        return response['ETag']
+      except Exception as e:
+        if attempt >= self._upload_retries:
+          raise
+        attempt += 1
+        logger.debug('Retrying part {0} of {1} ({2}/{3}): {4}'.format(
+          number, key, attempt, self._upload_retries, str(e)))
 
   def has(self, cache_key):
     logger.debug('Has {0}'.format(cache_key))
     if self._localcache.has(cache_key):
       return True
+    with self._measured(metrics.HAS) as measurement:
+      return measurement.found(self._has_remote(cache_key))
+
+  def _has_remote(self, cache_key):
+    if self._known_missing(cache_key):
+      return False
+    if self._bulk_lookup:
+      listed = self._listed(cache_key)
+      if listed is False:
+        self._record_missing(cache_key)
+      return bool(listed)
+    if not self._remote_allowed('HEAD', cache_key):
+      return False
     try:
-      self._get_object(cache_key).load()
+      found = any(self._head(self._path_for_key(cache_key, sharded))
+                  for sharded in self._read_layouts())
+    except Exception as e:
+      self._classify_error(e, 'HEAD', cache_key)
+      return False
+    self._record_outcome()
+    if not found:
+      logger.debug('Not Found During HEAD {0}'.format(cache_key))
+      self._record_missing(cache_key)
+    return found
+
+  def available(self):
+    """Returns False while S3 is being skipped after repeated network failures."""
+    return self._breaker is None or self._breaker.allow(claim=False)
+
+  def _remote_allowed(self, verb, cache_key):
+    """Returns False if requests are being skipped after repeated network failures."""
+    if self._breaker and not self._breaker.allow():
+      logger.debug('Skipped {0} (circuit open) {1}'.format(verb, cache_key))
+      metrics.note(metrics.NETWORK)
+      return False
+    return True
+
+  def _classify_error(self, e, verb, cache_key):
+    result = _log_and_classify_error(e, verb, cache_key)
+    self._record_outcome(result)
+    return result
+
+  def _record_outcome(self, result=None):
+    """Tells the circuit breaker whether a request reached S3, and the metrics how it failed.
+
+    :param result: The classification of the request's error, or None if it succeeded.
+    """
+    if result is not None:
+      metrics.note(_METRIC_OUTCOMES[result])
+    if self._breaker:
+      if result == _NETWORK:
+        self._breaker.record_failure()
+      else:
+        self._breaker.record_success()
+
+  def _known_missing(self, cache_key):
+    """Returns True if the negative cache recently saw cache_key missing from S3."""
+    if self._negative_cache and self._negative_cache.is_missing(
+        self._bucket, self._path_for_key(cache_key)):
+      logger.debug('Not Found During negative cache lookup {0}'.format(cache_key))
       return True
+    return False
+
+  def _record_missing(self, cache_key):
+    if self._negative_cache:
+      try:
+        self._negative_cache.record_missing(self._bucket, self._path_for_key(cache_key))
+      except (IOError, OSError) as e:
+        logger.debug('Failed to record miss {0}: {1}'.format(cache_key, str(e)))
+
+  @property
+  def bulk_lookup(self):
+    """Whether many keys should be looked up at once with `has_all`."""
+    return self._bulk_lookup
+
+  def has_all(self, cache_keys):
+    """Returns a dict of whether each of cache_keys is in the cache, or None if it's unknown.
+
+    The prefixes of keys not yet known are listed in parallel, and the listings are memoized
+    so that later `has` and `use_cached_files` calls for them are answered without a request.
+    A key is unknown if listing one of its prefixes failed.
+    """
+    unlisted = {}
+    for cache_key in cache_keys:
+      for sharded in self._read_layouts():
+        prefix = self._prefix_for_key(cache_key, sharded)
+        if listings.get(self._bucket, prefix) is None:
+          unlisted.setdefault(prefix, (cache_key, sharded))
+    with ThreadPoolExecutor(max_workers=self._lookup_concurrency) as pool:
+      list(pool.map(lambda lookup: self._listed_in(*lookup), unlisted.values()))
+    return {cache_key: self._localcache.has(cache_key) or self._listed(cache_key)
+            for cache_key in cache_keys}
+
+  def _listed(self, cache_key):
+    """Returns whether the memoized listings of cache_key's prefixes contain it.
+
+    The prefixes are listed first if need be. Returns None if a listing fails.
+    """
+    listed = False
+    for sharded in self._read_layouts():
+      found = self._listed_in(cache_key, sharded)
+      if found:
+        return True
+      if found is None:
+        listed = None
+    return listed
+
+  def _listed_in(self, cache_key, sharded):
+    prefix = self._prefix_for_key(cache_key, sharded)
+    keys = listings.get(self._bucket, prefix)
+    if keys is None:
+      if not self._remote_allowed('LIST', cache_key):
+        return None
+      try:
+        keys = self._list_prefix(prefix)
+      except Exception as e:
+        self._classify_error(e, 'LIST', cache_key)
+        return None
+      self._record_outcome()
+      listings.put(self._bucket, prefix, keys)
+    return self._path_for_key(cache_key, sharded) in keys
+
+  def _list_prefix(self, prefix):
+    return set(self._list_prefix_times(prefix))
+
+  def _list_prefix_times(self, prefix):
+    """Returns a dict of when each key under prefix was last modified."""
+    paginator = self._client().get_paginator('list_objects_v2')
+    times = {}
+    for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+      times.update((entry['Key'], entry['LastModified']) for entry in page.get('Contents', []))
+    return times
+
+  def seed_key(self, cache_key):
+    """Returns the key of the most recent other artifact this task cached for cache_key's target,
+    or None.
+
+    A miss for a small edit to a big target can then start from the target's last cached
+    results rather than from scratch: the artifact is read with `use_cached_files` under its own
+    key, so it is never reported as a hit for cache_key. Every task caches its targets under the
+    same prefix, so only artifacts recorded as uploaded by this cache's task are considered.
+    Returns None unless seed_incremental and task_name are set.
+    """
+    if (not self._seed_incremental or not self._task_name or
+        not self._remote_allowed('LIST', cache_key)):
+      return None
+    candidates = {}
+    try:
+      for sharded in self._read_layouts():
+        prefix = self._prefix_for_key(cache_key, sharded)
+        listed = self._list_prefix_times(prefix)
+        listings.put(self._bucket, prefix, listed)
+        for key, modified in listed.items():
+          name = key[len(prefix):]
+          if '/' not in name and name.endswith('.tgz'):
+            key_hash = name[:-len('.tgz')]
+            if key_hash not in candidates or candidates[key_hash][0] < modified:
+              candidates[key_hash] = (modified, key)
+      candidates.pop(cache_key.hash, None)
+      newest = sorted(candidates, key=candidates.get, reverse=True)
+      for key_hash in newest[:_SEED_CANDIDATES]:
+        if self._uploaded_by_task(candidates[key_hash][1]):
+          self._record_outcome()
+          return CacheKey(cache_key.id, key_hash)
     except Exception as e:
-      _log_and_classify_error(e, 'HEAD', cache_key)
+      self._classify_error(e, 'LIST', cache_key)
+      return None
+    self._record_outcome()
+    return None
+
+  def _uploaded_by_task(self, key):
+    """Returns whether the object at key was uploaded by this cache's task."""
+    try:
+      with self._timed():
+        response = self._client().head_object(Bucket=self._bucket, Key=key)
+    except Exception as e:
+      if not _not_found_error(e):
+        raise
       return False
+    return response.get('Metadata', {}).get('task') == self._task_name
 
   def use_cached_files(self, cache_key, results_dir=None):
     logger.debug('GET {0}'.format(cache_key))
     if self._localcache.has(cache_key):
       return self._localcache.use_cached_files(cache_key, results_dir)
+    with self._measured(metrics.GET) as measurement:
+      result = self._use_remote(cache_key, results_dir)
+      # An unreadable artifact has been noted as an unknown failure.
+      measurement.found(result is True)
+      return result
 
-    s3_object = self._get_object(cache_key)
-    try:
-      get_result = s3_object.get()
-    except Exception as e:
-      _log_and_classify_error(e, 'GET', cache_key)
+  def _use_remote(self, cache_key, results_dir):
+    content = self._fetch(cache_key)
+    if content is None:
       return False
 
-    # Delegate storage and extraction to local cache
+    def use(content):
+      if self._stream_extract:
+        return self._extract_streaming(cache_key, content, results_dir)
+      # Delegate storage and extraction to local cache
+      return self._localcache.store_and_use_artifact(cache_key, content, results_dir)
+
     try:
-      return self._localcache.store_and_use_artifact(
-        cache_key, iter_content(get_result['Body']), results_dir)
+      return self._consume(cache_key, content, use)
     except Exception as e:
-      result = _log_and_classify_error(e, 'GET', cache_key)
+      result = self._classify_error(e, 'GET', cache_key)
       if result == _UNKNOWN:
         return UnreadableArtifact(cache_key, e)
       return False
 
+  def prefetch(self, cache_key):
+    """Downloads the artifact for cache_key into the local cache, without extracting it.
+
+    Returns whether the local cache now holds the artifact. A TempLocalArtifactCache would not
+    keep it, so nothing is downloaded for one.
+    """
+    if isinstance(self._localcache, TempLocalArtifactCache):
+      return False
+    if self._localcache.has(cache_key):
+      return True
+    logger.debug('Prefetch {0}'.format(cache_key))
+    with self._measured(metrics.GET) as measurement:
+      return measurement.found(self._prefetch_remote(cache_key))
+
+  def _prefetch_remote(self, cache_key):
+    content = self._fetch(cache_key)
+    if content is None:
+      return False
+    def store(content):
+      with self._localcache._tmpfile(cache_key, 'read') as tmp:
+        for chunk in content:
+          tmp.write(chunk)
+        tmp.close()
+        self._localcache._store_tarball(cache_key, tmp.name)
+      return True
+
+    try:
+      return self._consume(cache_key, content, store)
+    except Exception as e:
+      self._classify_error(e, 'GET', cache_key)
+      return False
+
+  def _consume(self, cache_key, content, consume):
+    """Returns consume(content), downloading the content again if it arrives corrupted.
+
+    The digest is checked as the content streams, so a corrupted transfer fails as soon as its
+    last byte arrives, before the local cache keeps it. Decompressing as it streams often fails
+    sooner, so that is retried too. Only one retry is made: failing twice suggests the object
+    itself is bad, and the error is raised.
+    """
+    try:
+      return consume(content)
+    except (ArtifactError, DigestMismatchError) as e:
+      logger.warn('Retrying corrupted GET {0}: {1}'.format(cache_key, str(e)))
+    content = self._fetch(cache_key)
+    if content is None:
+      return False
+    return consume(content)
+
+  def _fetch(self, cache_key):
+    """Starts downloading the artifact for cache_key, returning its content or None on a miss."""
+    if self._known_missing(cache_key):
+      return None
+
+    # Only listings and HEADs that have already been paid for are consulted; a GET answers a
+    # miss as cheaply as either would.
+    if self._memoized_missing(cache_key):
+      logger.debug('Not Found During memoized lookup {0}'.format(cache_key))
+      return None
+
+    if not self._remote_allowed('GET', cache_key):
+      return None
+    try:
+      # Artifacts not in gzip are decompressed: pants' local caches can't read the other codecs.
+      content = decode(metrics.counted(self._get_content(cache_key)))
+    except Exception as e:
+      if self._classify_error(e, 'GET', cache_key) == _NOT_FOUND:
+        self._record_missing(cache_key)
+      return None
+    self._record_outcome()
+    return content
+
+  def _memoized_missing(self, cache_key):
+    """Returns True if memoized listings or HEADs show cache_key missing from every layout it's
+    read from."""
+    for sharded in self._read_layouts():
+      path = self._path_for_key(cache_key, sharded)
+      if heads.get(self._bucket, path) is False:
+        continue
+      keys = listings.get(self._bucket, self._prefix_for_key(cache_key, sharded))
+      if keys is None or path in keys:
+        return False
+    return True
+
+  def _extract_streaming(self, cache_key, content, results_dir):
+    """Extracts the artifact from content as it downloads, teeing it into the local cache.
+
+    Mirrors `store_and_use_artifact`: results_dir is cleared before extracting and again if the
+    artifact turns out to be unreadable, and the local cache only keeps artifacts that extracted.
+    """
+    if results_dir is not None:
+      safe_mkdir(results_dir, clean=True)
+    try:
+      if isinstance(self._localcache, TempLocalArtifactCache):
+        extract_stream(self.artifact_root, content)
+      else:
+        with self._localcache._tmpfile(cache_key, 'read') as tmp:
+          extract_stream(self.artifact_root, content, tee=tmp)
+          tmp.close()
+          self._localcache._store_tarball(cache_key, tmp.name)
+    except Exception:
+      if results_dir is not None:
+        safe_mkdir(results_dir, clean=True)
+      raise
+    return True
+
   def delete(self, cache_key):
     logger.debug("Delete {0}".format(cache_key))
     self._localcache.delete(cache_key)
+    with self._measured(metrics.DELETE) as measurement:
+      if not self._remote_allowed('DELETE', cache_key):
+        return
+      # The artifact may have been read from either layout.
+      for sharded in self._read_layouts():
+        path = self._path_for_key(cache_key, sharded)
+        try:
+          self._client().delete_object(Bucket=self._bucket, Key=path)
+          self._record_outcome()
+          listings.discard(self._bucket, self._prefix_for_key(cache_key, sharded), path)
+          heads.put(self._bucket, path, False)
+        except Exception as e:
+          self._classify_error(e, 'DELETE', cache_key)
+      measurement.found(True)
+
+  def _get_content(self, cache_key):
+    """Starts downloading the artifact for cache_key, returning an iterator over its bytes.
+
+    Follows the key to its blob if it holds a pointer. Raises if the first request fails, so
+    misses surface before any bytes are consumed.
+    """
+    paths = [self._path_for_key(cache_key, sharded) for sharded in self._read_layouts()]
+    # Keys already seen missing this run are skipped; the last is tried regardless, to raise.
+    paths = [path for path in paths[:-1] if heads.get(self._bucket, path) is not False] + paths[-1:]
+    for path in paths[:-1]:
+      try:
+        content = self._get_key_content(path)
+        break
+      except Exception as e:
+        if not _not_found_error(e):
+          raise
+        logger.debug('Not Found at {0}, trying the unsharded key'.format(path))
+    else:
+      content = self._get_key_content(paths[-1])
+    first_chunk = next(content, b'')
+    blob_name = parse_blob_pointer(first_chunk)
+    if blob_name:
+      return self._get_key_content(self._blob_key(blob_name))
+    return chain([first_chunk], content)
+
+  def _get_key_content(self, key):
+    first = self._first_get(key)
+    if self._download_concurrency <= 1:
+      return _verified(iter_content(first['Body']), first, key)
+    size = _content_range_size(first)
+    if size <= self._download_part_size:
+      return _verified(iter_content(first['Body']), first, key)
+    return _verified(self._iter_ranges(key, first, size), first, key)
+
+  def _first_get(self, key):
+    """Starts the GET that downloading key starts with, memoizing what it finds at key.
+
+    That is of the whole object, or of its first part if downloads are ranged: the response then
+    tells us how big the whole object is.
+    """
+    head = heads.get(self._bucket, key)
     try:
-      self._get_object(cache_key).delete()
+      if self._download_concurrency <= 1:
+        # A known size lets the read timeout allow for the transfer.
+        response = self._get_object(size=head.size if head else 0, Key=key)
+        size = response['ContentLength']
+      else:
+        response = self._get_object(Key=key, Range=_byte_range(0, self._download_part_size))
+        size = _content_range_size(response)
     except Exception as e:
-      _log_and_classify_error(e, 'DELETE', cache_key)
+      if _not_found_error(e):
+        heads.put(self._bucket, key, False)
+      raise
+    heads.put(self._bucket, key, Head(size, response.get('ETag')))
+    return response
+
+  def _get_object(self, size=0, **kwargs):
+    """Starts a GET, hedging it if enabled; returns once the response headers have arrived.
+
+    :param int size: The expected size of the response body, if known.
+    """
+    def request():
+      with self._timed():
+        return self._client(size).get_object(Bucket=self._bucket, **kwargs)
+    if self._hedge_percentile <= 0:
+      return request()
+    return hedged(request, latencies, self._hedge_percentile,
+                  discard=lambda response: response['Body'].close())
+
+  def _iter_ranges(self, key, first, size):
+    """Yields the object's bytes in order while the remaining ranges download in parallel.
+
+    At most download_concurrency parts are held in memory at a time. The ranges are only read
+    from the version of the object whose first part is the first response.
+    """
+    part_size = self._download_part_size
+    starts = iter(range(part_size, size, part_size))
+    pool = ThreadPoolExecutor(max_workers=self._download_concurrency)
+
+    pending = deque()
+
+    def submit_next():
+      start = next(starts, None)
+      if start is not None:
+        pending.append(pool.submit(self._get_range, key, start, min(start + part_size, size),
+                                   first.get('ETag')))
+
+    try:
+      for _ in range(self._download_concurrency):
+        submit_next()
+      for chunk in iter_content(first['Body']):
+        yield chunk
+      while pending:
+        part = pending.popleft().result()
+        submit_next()
+        yield part
+    finally:
+      for future in pending:
+        future.cancel()
+      pool.shutdown(wait=False)
+
+  def _get_range(self, key, start, end, etag=None):
+    conditions = {'IfMatch': etag} if etag else {}
+    try:
+      with self._timed(end - start):
+        get_result = self._client(end - start).get_object(
+          Bucket=self._bucket, Key=key, Range=_byte_range(start, end), **conditions)
+        part = get_result['Body'].read()
+    except Exception as e:
+      if _precondition_failed(e):
+        # Overwritten mid-download: the caller retries, like any other corrupted transfer.
+        raise ArtifactError('{0} changed while it downloaded'.format(key))
+      raise
+    if len(part) != end - start:
+      raise NonfatalArtifactCacheError('Short read of {0} {1}: got {2} bytes, expected {3}'.format(
+        key, _byte_range(start, end), len(part), end - start))
+    return part
+
+  def _measured(self, op):
+    """Records the operation on S3 made in the block in this run's metrics."""
+    return metrics.measure(op, self._metrics_dir)
+
+  def _client(self, size=0):
+    """Returns a client with timeouts suited to a request transferring size bytes."""
+    connect_timeout, read_timeout = self._timeouts.timeouts(size)
+    return get_s3_client(self._max_pool_connections, connect_timeout, read_timeout)
+
+  @contextmanager
+  def _timed(self, size=0):
+    """Measures the request made in the block, if it reached S3, for adapting timeouts."""
+    start = time.time()
+    try:
+      yield
+    except Exception as e:
+      if _not_found_error(e):
+        timeouts.record(time.time() - start)
+      raise
+    timeouts.record(time.time() - start, size)
+
+  def _blob_key(self, blob_name):
+    return '{0}/{1}/sha256/{2}'.format(self._path, BLOBS_DIR, blob_name)
+
+  def _read_layouts(self):
+    """Returns the layouts to look artifacts up in, as values of sharded, in order."""
+    if self._sharded_keys and self._legacy_key_fallback:
+      return [True, False]
+    return [self._sharded_keys]
 
-  def _get_object(self, cache_key):
-    return s3.Object(self._bucket, self._path_for_key(cache_key))
+  def _prefix_for_key(self, cache_key, sharded=None):
+    if sharded is None:
+      sharded = self._sharded_keys
+    if sharded:
+      return '{0}/{1}/{2}/'.format(self._path, shard_dir(cache_key.id), cache_key.id)
+    return '{0}/{1}/'.format(self._path, cache_key.id)
 
-  def _path_for_key(self, cache_key):
-    return '{0}/{1}/{2}.tgz'.format(self._path, cache_key.id, cache_key.hash)
+  def _path_for_key(self, cache_key, sharded=None):
+    return '{0}{1}.tgz'.format(self._prefix_for_key(cache_key, sharded), cache_key.hash)
@@ -0,0 +1,84 @@
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.cache.artifact_cache import NonfatalArtifactCacheError
+from pants.util.dirutil import safe_delete
+from verst.pants.s3cache import lookup
+
+logger = logging.getLogger(__name__)
+
+# Number of missed targets to look for earlier artifacts of at once.
+_SEED_CONCURRENCY = 8
+
+
+def do_check_artifact_cache(self, vts, post_process_cached_vts=None):
+  """Checks the artifact cache as `lookup` does, then seeds the incremental builds of the misses.
+
+  Seeded builds are incremental, and pants only caches those for tasks that set
+  `cache_incremental`; seeding the misses of other tasks would keep them out of the cache.
+  """
+  cached_vts, uncached_vts, uncached_causes = lookup.do_check_artifact_cache(
+    self, vts, post_process_cached_vts=post_process_cached_vts)
+  if uncached_vts and self.incremental and self.cache_incremental and self.cache_target_dirs:
+    seed_incremental_builds(self, uncached_vts)
+  return cached_vts, uncached_vts, uncached_causes
+
+
+def seed_incremental_builds(task, vts):
+  """Extracts the most recent S3 artifact of each target in vts as its previous build.
+
+  Pants clones the results_dir of a target's previous build into the results_dir of an
+  incremental build, but only has one if this workspace built the target before. A target with
+  an earlier artifact in S3 gets it extracted to where that build's results_dir would be, and is
+  pointed at it as its previous build. The targets stay invalid: they are built incrementally,
+  not reported as cache hits.
+
+  :param task: An incremental task that caches its target dirs, incremental builds included.
+  :param list vts: The task's VersionedTargets that missed the cache.
+  """
+  read_cache = task._cache_factory.get_read_cache()
+  if not hasattr(read_cache, 'seed_key'):
+    return
+  unbuilt = [vt for vt in vts if not _has_previous_build(task, vt)]
+  with ThreadPoolExecutor(max_workers=_SEED_CONCURRENCY) as pool:
+    seeded = list(pool.map(lambda vt: _seed(task, read_cache, vt), unbuilt))
+  if any(seeded):
+    task.context.log.info('Seeded incremental builds of {0} of {1} missed targets from earlier '
+                          'artifacts.'.format(sum(1 for seed in seeded if seed), len(vts)))
+
+
+def _has_previous_build(task, vt):
+  return bool(vt.previous_cache_key) and os.path.isdir(
+    vt._results_dir_path(task.workdir, vt.previous_cache_key, stable=False))
+
+
+def _seed(task, read_cache, vt):
+  try:
+    seed_key = read_cache.seed_key(vt.cache_key)
+    if seed_key is None:
+      return False
+    seed_dir = vt._results_dir_path(task.workdir, seed_key, stable=False)
+    # The artifact may be of another version of the task, whose results live elsewhere.
+    if (read_cache.use_cached_files(seed_key, seed_dir) is not True or
+            not os.path.isdir(seed_dir) or not os.listdir(seed_dir)):
+      return False
+  except NonfatalArtifactCacheError as e:
+    logger.warn('Failed to seed {0}: {1}'.format(vt.cache_key, str(e)))
+    return False
+  _localize_analysis(task, vt, seed_dir)
+  logger.debug('Seeding {0} from {1}'.format(vt.cache_key, seed_key))
+  vt.previous_cache_key = seed_key
+  return True
+
+
+def _localize_analysis(task, vt, results_dir):
+  # JVM compiles cache a portable zinc analysis, which has to be localized before zinc can compile
+  # incrementally from it; JvmCompile.check_artifact_cache does the same for its hits.
+  if not (hasattr(task, '_compile_context') and hasattr(task, '_analysis_tools')):
+    return
+  compile_context = task._compile_context(vt.target, results_dir)
+  if os.path.exists(compile_context.portable_analysis_file):
+    safe_delete(compile_context.analysis_file)
+    task._analysis_tools.localize(compile_context.portable_analysis_file,
+                                  compile_context.analysis_file)
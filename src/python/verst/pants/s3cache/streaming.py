@@ -0,0 +1,89 @@
+import errno
+import os
+import tarfile
+import zlib
+
+from pants.cache.artifact import ArtifactError
+from verst.pants.s3cache.compression import (decompressor,
+                                             GZIP,
+                                             sniff)
+
+
+class _Passthrough(object):
+  def decompress(self, data):
+    return data
+
+  def finish(self):
+    return True
+
+
+class StreamReader(object):
+  """A read-only file over the bytes of a tarball that arrives in chunks.
+
+  Gzipped tarballs are decompressed as they are read. zlib checks the gzip trailer's CRC and
+  length as the stream ends; `finish` additionally checks that it did end, so a truncated download
+  is reported rather than silently accepted.
+  """
+
+  def __init__(self, chunks, tee=None):
+    """
+    :param chunks: Iterator over the (possibly gzipped) tarball's bytes.
+    :param tee: File to also write the bytes to as they arrive, if any.
+    """
+    self._chunks = iter(chunks)
+    self._tee = tee
+    self._decompressor = None
+    self._buffer = b''
+    self._offset = 0
+    self._exhausted = False
+
+  def read(self, size=-1):
+    while not self._exhausted and (size < 0 or len(self._buffer) - self._offset < size):
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        self._exhausted = True
+        break
+      if self._decompressor is None:
+        self._decompressor = decompressor(GZIP) if sniff(chunk) == GZIP else _Passthrough()
+      if self._tee:
+        self._tee.write(chunk)
+      data = self._decompressor.decompress(chunk)
+      self._buffer = self._buffer[self._offset:] + data
+      self._offset = 0
+    end = len(self._buffer) if size < 0 else self._offset + size
+    data = self._buffer[self._offset:end]
+    self._offset += len(data)
+    return data
+
+  def finish(self):
+    """Reads whatever the caller left unread, raising ArtifactError unless the stream was whole."""
+    while self.read(1024 * 1024):
+      pass
+    if self._decompressor and not self._decompressor.finish():
+      raise ArtifactError('Truncated gzip stream')
+
+
+def extract_stream(artifact_root, chunks, tee=None):
+  """Extracts the tarball arriving as chunks under artifact_root as it is read.
+
+  :param str artifact_root: Directory to extract under.
+  :param chunks: Iterator over the bytes of the tarball, which may be gzipped.
+  :param tee: File to also write the tarball's bytes to, if any.
+  :raises ArtifactError: If the tarball is corrupt or truncated.
+  """
+  reader = StreamReader(chunks, tee)
+  try:
+    with tarfile.open(fileobj=reader, mode='r|', errorlevel=2) as tarin:
+      for tarinfo in tarin:
+        # As in TarballArtifact.extract, create directories up front and tolerate them appearing
+        # concurrently, since other artifacts may be extracted into the same tree in parallel.
+        directory = tarinfo.name if tarinfo.isdir() else os.path.dirname(tarinfo.name)
+        try:
+          os.makedirs(os.path.join(artifact_root, directory))
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+        tarin.extract(tarinfo, artifact_root)
+    reader.finish()
+  except (tarfile.TarError, zlib.error, EOFError) as e:
+    raise ArtifactError(str(e))
@@ -0,0 +1,94 @@
+import math
+import threading
+
+from verst.pants.s3cache.hedging import LatencyTracker
+
+DEFAULT_CONNECT_TIMEOUT = 4
+DEFAULT_READ_TIMEOUT = 4
+
+# Timeouts allow this many times the expected duration of a request.
+_SLACK = 4
+# Weight of each new throughput sample in the moving average.
+_THROUGHPUT_WEIGHT = 0.2
+
+
+class ThroughputTracker(object):
+  """An exponentially weighted moving average of observed transfer rates, in bytes per second."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._rate = None
+
+  def record(self, size, seconds):
+    rate = size / max(seconds, 0.001)
+    with self._lock:
+      if self._rate is None:
+        self._rate = rate
+      else:
+        self._rate += _THROUGHPUT_WEIGHT * (rate - self._rate)
+
+  def rate(self):
+    with self._lock:
+      return self._rate
+
+  def clear(self):
+    with self._lock:
+      self._rate = None
+
+
+# Per process, like the S3 clients: caches are pickled into pants' worker processes.
+latencies = LatencyTracker()
+throughput = ThroughputTracker()
+
+
+def record(seconds, size=0):
+  """Records a successful request that took seconds and transferred size bytes of payload."""
+  if size:
+    throughput.record(size, seconds)
+  else:
+    latencies.record(seconds)
+
+
+def _bounded(estimate, floor, ceiling):
+  """Rounds estimate up to a power of two within [floor, ceiling], so timeouts change in steps
+  rather than with every measurement."""
+  if estimate is None:
+    return ceiling
+  quantized = 2.0 ** math.ceil(math.log(max(estimate, 0.001), 2))
+  return min(ceiling, max(floor, quantized))
+
+
+class TimeoutPolicy(object):
+  """Chooses S3 timeouts for a request from the latencies and throughput seen so far.
+
+  The connect timeout is a few times the usual latency of small requests, so an unreachable
+  network is given up on quickly. The read timeout also allows for transferring the request's
+  payload at the measured throughput. Until there are measurements, the ceilings are used.
+  """
+
+  def __init__(self, connect_floor=DEFAULT_CONNECT_TIMEOUT,
+               connect_ceiling=DEFAULT_CONNECT_TIMEOUT,
+               read_floor=DEFAULT_READ_TIMEOUT, read_ceiling=DEFAULT_READ_TIMEOUT):
+    """
+    :param float connect_floor: Shortest connect timeout to use, in seconds.
+    :param float connect_ceiling: Longest connect timeout to use, in seconds.
+    :param float read_floor: Shortest read timeout to use, in seconds.
+    :param float read_ceiling: Longest read timeout to use, in seconds.
+    """
+    self._connect_floor = connect_floor
+    self._connect_ceiling = connect_ceiling
+    self._read_floor = read_floor
+    self._read_ceiling = read_ceiling
+
+  def timeouts(self, size=0):
+    """Returns the (connect, read) timeouts for a request transferring size bytes."""
+    latency = latencies.percentile(99)
+    connect = _bounded(latency and _SLACK * latency, self._connect_floor, self._connect_ceiling)
+
+    read_estimate = latency
+    if read_estimate is not None and size:
+      rate = throughput.rate()
+      read_estimate = None if rate is None else latency + size / rate
+    read = _bounded(read_estimate and _SLACK * read_estimate, self._read_floor,
+                    self._read_ceiling)
+    return connect, read
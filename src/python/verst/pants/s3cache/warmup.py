@@ -0,0 +1,73 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.base.exceptions import TaskError
+from pants.base.fingerprint_strategy import TaskIdentityFingerprintStrategy
+from pants.goal.goal import Goal
+from pants.task.task import Task
+
+# The JVM tasks that cache their results: compiling, then bundling the compiled classes.
+DEFAULT_TASKS = ('compile.zinc', 'bundle.consolidate-classpath', 'bundle.jvm')
+
+
+class S3CacheWarmup(Task):
+  """Downloads the S3 artifacts other tasks will need into the local cache before they run.
+
+  Tasks read the artifact cache target by target inside their invalidation loops, so its network
+  time adds to the build's. This computes the cache keys of the targets the given tasks would
+  find invalid and fetches them all in parallel up front, leaving the tasks local cache hits.
+  """
+
+  @classmethod
+  def register_options(cls, register):
+    super(S3CacheWarmup, cls).register_options(register)
+    register('--tasks', type=list, default=list(DEFAULT_TASKS),
+             help='Tasks to fetch artifacts for, as goal.task. Their cache keys are computed the '
+                  'way JVM compiles and bundles compute them: transitively, and with the resolved '
+                  'classpath for tasks that fingerprint it. Tasks that fingerprint targets '
+                  'differently just get no hits.')
+    register('--concurrency', type=int, default=16,
+             help='Number of artifacts to download in parallel.')
+
+  @classmethod
+  def prepare(cls, options, round_manager):
+    super(S3CacheWarmup, cls).prepare(options, round_manager)
+    # JVM compiles fingerprint the resolved jars of each target too.
+    round_manager.optional_data('compile_classpath')
+
+  def execute(self):
+    fetches = []
+    for scope in self.get_options().tasks:
+      task = self._create_task(scope)
+      cache = task._cache_factory.get_read_cache() if task.artifact_cache_reads_enabled() else None
+      if not hasattr(cache, 'prefetch'):
+        self.context.log.debug('{0} does not read from S3; not warming it up.'.format(scope))
+        continue
+      fetches.extend((cache, cache_key) for cache_key in self._invalid_cache_keys(task))
+
+    with ThreadPoolExecutor(max_workers=self.get_options().concurrency) as pool:
+      fetched = list(pool.map(lambda fetch: fetch[0].prefetch(fetch[1]), fetches))
+    self.context.log.info('Fetched {0} of {1} artifacts from S3.'.format(
+      sum(1 for hit in fetched if hit), len(fetches)))
+
+  def _create_task(self, scope):
+    goal_name, _, task_name = scope.partition('.')
+    try:
+      task_type = Goal.by_name(goal_name).task_type_by_name(task_name)
+    except KeyError:
+      raise TaskError('No task {0} to warm the S3 cache up for.'.format(scope))
+    workdir = os.path.join(self.context.options.for_global_scope().pants_workdir,
+                           goal_name, task_name)
+    return task_type(self.context, workdir)
+
+  def _invalid_cache_keys(self, task):
+    select = getattr(task, 'select', lambda target: True)
+    targets = self.context.targets(predicate=select)
+    # As `Task.invalidated` fingerprints targets when the task doesn't pass its own strategy.
+    fingerprint_strategy = TaskIdentityFingerprintStrategy(task)
+    classpath = self.context.products.get_data('compile_classpath')
+    if classpath is not None and hasattr(task, '_fingerprint_strategy'):
+      fingerprint_strategy = task._fingerprint_strategy(classpath.copy())
+    cache_manager = task.create_cache_manager(invalidate_dependents=True,
+                                              fingerprint_strategy=fingerprint_strategy)
+    return [vt.cache_key for vt in cache_manager.check(targets).invalid_vts]
@@ -0,0 +1,147 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.util import Finalize
+
+from concurrent.futures import ThreadPoolExecutor
+from pants.util.dirutil import safe_delete, safe_mkdir
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT_BYTES = 512 * 1024 * 1024
+# Spooled files this old were left by a process that died before uploading them. Their cache keys
+# aren't recorded, so they can't be uploaded, and are deleted.
+STALE_SPOOL_SECONDS = 24 * 60 * 60
+
+
+class WriteBehindUploader(object):
+  """Uploads spooled artifacts on a bounded pool of background threads.
+
+  Callers block in `submit` only while the bytes already queued or uploading exceed
+  max_in_flight_bytes. Everything still queued is uploaded by `flush`, which runs at process exit.
+  """
+
+  def __init__(self, workers, max_in_flight_bytes):
+    self._pool = ThreadPoolExecutor(max_workers=workers)
+    self._max_in_flight_bytes = max_in_flight_bytes
+    self._in_flight_bytes = 0
+    self._futures = []
+    self._submitted = 0
+    self._failures = []
+    self._condition = threading.Condition()
+
+  def submit(self, description, spooled_file, upload):
+    """Queues upload(spooled_file), deleting spooled_file once it has run.
+
+    :param description: What is being uploaded, used to report failures.
+    :param spooled_file: A file owned by the uploader from now on.
+    :param upload: A function of the file path that raises on failure.
+    """
+    size = os.path.getsize(spooled_file)
+    with self._condition:
+      # A single artifact larger than the cap is let through once nothing else is in flight.
+      while self._in_flight_bytes and self._in_flight_bytes + size > self._max_in_flight_bytes:
+        self._condition.wait()
+      self._in_flight_bytes += size
+      self._submitted += 1
+      self._futures.append(self._pool.submit(self._run, description, spooled_file, size, upload))
+
+  def _run(self, description, spooled_file, size, upload):
+    try:
+      upload(spooled_file)
+    except Exception as e:
+      with self._condition:
+        self._failures.append((description, e))
+    finally:
+      safe_delete(spooled_file)
+      with self._condition:
+        self._in_flight_bytes -= size
+        self._condition.notify_all()
+
+  def flush(self):
+    """Waits for every queued upload to finish and logs a summary of any that failed."""
+    with self._condition:
+      futures, self._futures = self._futures, []
+    for future in futures:
+      future.result()
+
+    with self._condition:
+      submitted, self._submitted = self._submitted, 0
+      failures, self._failures = self._failures, []
+    if failures:
+      logger.warn('{0} of {1} write-behind uploads to the S3 artifact cache failed:\n  {2}'.format(
+        len(failures), submitted,
+        '\n  '.join('{0}: {1}'.format(description, e) for description, e in failures)))
+    return failures
+
+
+_uploader = None
+_uploader_pid = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader(workers, max_in_flight_bytes):
+  """Returns this process' uploader, creating it with the given settings if needed.
+
+  Artifact caches are pickled into pants' worker processes, so the uploader is per process rather
+  than per cache. Registering the flush as a multiprocessing finalizer runs it when either the
+  pants process or a pool worker exits.
+  """
+  global _uploader, _uploader_pid
+  with _uploader_lock:
+    if _uploader is None or _uploader_pid != os.getpid():
+      _uploader = WriteBehindUploader(workers, max_in_flight_bytes)
+      _uploader_pid = os.getpid()
+      Finalize(None, _uploader.flush, exitpriority=10)
+    return _uploader
+
+
+def flush():
+  """Flushes this process' uploader, if it has one, returning the failed uploads."""
+  with _uploader_lock:
+    uploader = _uploader if _uploader_pid == os.getpid() else None
+  return uploader.flush() if uploader else []
+
+
+_cleaned_spool_dirs = set()
+_cleaned_spool_dirs_lock = threading.Lock()
+
+
+def spool(tarfile, spool_dir):
+  """Returns a private copy of tarfile under spool_dir, hard linked where possible.
+
+  The first spool of a process to spool_dir deletes the files crashed runs left there.
+  """
+  safe_mkdir(spool_dir)
+  with _cleaned_spool_dirs_lock:
+    if spool_dir not in _cleaned_spool_dirs:
+      _cleaned_spool_dirs.add(spool_dir)
+      remove_stale(spool_dir)
+  fd, spooled_file = tempfile.mkstemp(suffix='.tgz', dir=spool_dir)
+  os.close(fd)
+  try:
+    os.unlink(spooled_file)
+    os.link(tarfile, spooled_file)
+  except OSError:
+    shutil.copyfile(tarfile, spooled_file)
+  return spooled_file
+
+
+def remove_stale(spool_dir, max_age=STALE_SPOOL_SECONDS):
+  """Deletes the files under spool_dir last modified more than max_age seconds ago."""
+  cutoff = time.time() - max_age
+  try:
+    names = os.listdir(spool_dir)
+  except OSError:
+    return
+  for name in names:
+    path = os.path.join(spool_dir, name)
+    try:
+      if os.path.getmtime(path) < cutoff:
+        logger.debug('Deleting stale write-behind spool file {0}'.format(path))
+        safe_delete(path)
+    except OSError:
+      pass  # Uploaded and deleted by its owner since it was listed.
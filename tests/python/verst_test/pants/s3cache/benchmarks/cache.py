@@ -0,0 +1,311 @@
+# coding=utf-8
+
+"""Benchmarks inserting, looking up and restoring artifacts through the S3 artifact cache.
+
+Runs against moto, in process. Each scenario creates an S3 cache the way pants does, through the
+plugin's cache_setup with the cache options' defaults, for artifacts of one size and file count
+at one compression level. It inserts, looks up and restores --rounds artifacts per thread on that
+many threads at once, and reports insert and restore throughput in MB of artifact contents per
+second, plus the p50 and p99 latencies of each insert, `has` and restore. Run it with:
+
+  ./pants run tests/python/verst_test/pants/s3cache/benchmarks:cache
+  ./pants run tests/python/verst_test/pants/s3cache/benchmarks:cache -- --profile=full \\
+    --option=s3_download_concurrency=8
+
+The results are compared with a stored baseline, cache_baseline.json by default. The run fails if
+any scenario's throughput dropped, or its p50 latency rose, by more than --tolerance. Baselines
+only compare on the same kind of machine; record one with --save-baseline. The full profile
+reaches 1GB artifacts, which moto holds in memory: scenarios that would hold more than
+--max-bytes at once are skipped.
+"""
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import argparse
+import ast
+import json
+import logging
+import math
+import os
+import pkgutil
+import random
+import sys
+import time
+from argparse import Namespace
+from itertools import product
+
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+from pants.cache.cache_setup import CacheFactory, CacheSetup, CacheSpec
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import temporary_dir
+from pants.util.dirutil import safe_mkdir, safe_rmtree
+from verst.pants.s3cache import cache_setup
+from verst.pants.s3cache.listings import heads, listings
+
+_BUCKET = 'verst-benchmark-bucket'
+_BASELINE = 'cache_baseline.json'
+
+_PROFILES = {
+  'quick': {'sizes': ['64KB', '4MB', '32MB'], 'files': [1, 200], 'levels': [1, 6],
+            'concurrency': [1, 4]},
+  'full': {'sizes': ['4KB', '1MB', '64MB', '256MB', '1GB'], 'files': [1, 100, 2000],
+           'levels': [1, 6, 9], 'concurrency': [1, 4, 16]},
+}
+_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+# Compared with the baseline; higher is better for throughputs, lower for latencies. Each
+# scenario keeps its best sample of each, which is far steadier from run to run than any one.
+_THROUGHPUTS = ('insert_mb_per_s', 'restore_mb_per_s')
+_LATENCIES = ('insert_p50_ms', 'has_p50_ms', 'restore_p50_ms')
+# Latencies this close to the baseline are noise, however large the ratio.
+_LATENCY_SLACK_MS = 10
+
+
+def parse_size(size):
+  """Returns the bytes in a size like 64KB."""
+  return int(size[:-2]) * _UNITS[size[-2:].upper()]
+
+
+def _contents(rng, size):
+  # Half random and half repeated, so that every compression level has work to do.
+  block = bytes(bytearray(rng.getrandbits(8) for _ in range(min(size, 4096))))
+  random_half = os.urandom(size // 2)
+  repeated = (block * (size // (2 * len(block)) + 1))[:size - len(random_half)]
+  return random_half + repeated
+
+
+def _write_artifact(root, size, files, contents):
+  """Writes an artifact of size bytes split over files files under root; returns their paths."""
+  file_size = max(1, size // files)
+  safe_mkdir(root)
+  paths = []
+  for number in range(files):
+    path = os.path.join(root, 'file{0}.class'.format(number))
+    with open(path, 'wb') as outfile:
+      outfile.write(contents[:file_size])
+    paths.append(path)
+  return paths
+
+
+def cache_options(workdir, level, overrides):
+  """Returns the cache scope's option values: the registered defaults, with overrides."""
+  values = {}
+
+  def register(name, **kwargs):
+    values[name.lstrip('-').replace('-', '_')] = kwargs.get('default')
+
+  cache_setup.register_options(CacheSetup, register)
+  values.update(pants_workdir=workdir, compression_level=level, write_permissions=None)
+  values.update(overrides)
+  return Namespace(**values)
+
+
+def create_cache(workdir, level, overrides):
+  """Returns the artifact cache pants would create for an S3 URL under these options."""
+  cache_setup.patch()
+  factory = CacheFactory(cache_options(workdir, level, overrides),
+                         logging.getLogger(__name__), 'benchmark')
+  return factory._do_create_artifact_cache(
+    CacheSpec(local=None, remote='s3://{0}/artifacts'.format(_BUCKET)), 'will write to')
+
+
+def _forget():
+  """Forgets what this process memoized about S3, as a new pants run would."""
+  listings.clear()
+  heads.clear()
+
+
+def _timed_concurrently(concurrency, fn, items):
+  """Calls fn on each of items, concurrency at a time; returns the wall time and each call's."""
+  def timed(item):
+    start = time.time()
+    result = fn(item)
+    assert result, 'Failed on {0}'.format(item)
+    return time.time() - start
+
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    latencies = list(pool.map(timed, items))
+  return time.time() - start, latencies
+
+
+def _percentile_ms(latencies, percent):
+  latencies = sorted(latencies)
+  return 1000 * latencies[max(0, int(math.ceil(percent / 100 * len(latencies))) - 1)]
+
+
+def run_scenario(size, files, level, concurrency, rounds=3, overrides=None):
+  """Returns the throughputs and latencies of one scenario, as a dict."""
+  rng = random.Random(0)
+  contents = _contents(rng, max(1, parse_size(size) // files))
+  artifacts = concurrency * rounds
+  with mock_s3(), temporary_dir() as workdir:
+    boto3.client('s3').create_bucket(Bucket=_BUCKET)
+    _forget()
+    cache = create_cache(workdir, level, overrides or {})
+    # Each artifact has its own files, so that concurrent restores don't extract over each other.
+    work = [(CacheKey('target{0}'.format(number), 'hash{0}'.format(number)),
+             os.path.join(workdir, 'target{0}'.format(number)))
+            for number in range(artifacts)]
+    paths = {key: _write_artifact(root, parse_size(size), files, contents) for key, root in work}
+    total_mb = artifacts * parse_size(size) / (1024 * 1024)
+
+    insert_seconds, insert_latencies = _timed_concurrently(
+      concurrency, lambda key: cache.insert(key, paths[key], overwrite=True) is not False,
+      [key for key, _ in work])
+
+    _forget()
+    _, has_latencies = _timed_concurrently(concurrency, cache.has, [key for key, _ in work])
+
+    _forget()
+    for _, root in work:
+      safe_rmtree(root)
+    restore_seconds, restore_latencies = _timed_concurrently(
+      concurrency, lambda key: cache.use_cached_files(key) is True, [key for key, _ in work])
+    for artifact_paths in paths.values():
+      assert all(os.path.getsize(path) == len(contents) for path in artifact_paths)
+  _forget()
+
+  result = {
+    'insert_mb_per_s': total_mb / max(insert_seconds, 1e-6),
+    'restore_mb_per_s': total_mb / max(restore_seconds, 1e-6),
+  }
+  for op, latencies in (('insert', insert_latencies), ('has', has_latencies),
+                        ('restore', restore_latencies)):
+    for percent in (50, 99):
+      result['{0}_p{1}_ms'.format(op, percent)] = _percentile_ms(latencies, percent)
+  return {metric: round(value, 2) for metric, value in result.items()}
+
+
+def best_of(samples, scenario):
+  """Runs scenario, a function of no arguments, samples times, keeping the best of each metric."""
+  runs = [scenario() for _ in range(samples)]
+  return {metric: (max if metric in _THROUGHPUTS else min)(run[metric] for run in runs)
+          for metric in runs[0]}
+
+
+def scenario_id(size, files, level, concurrency, overrides=None):
+  """Names a scenario in results and baselines; option overrides make different scenarios."""
+  name = '{0}-{1}files-level{2}-x{3}'.format(size, files, level, concurrency)
+  for option, value in sorted((overrides or {}).items()):
+    name += '+{0}={1}'.format(option, value)
+  return name
+
+
+def regressions(results, baseline, tolerance):
+  """Returns a description of each metric in results that regressed from baseline."""
+  found = []
+  for name, metrics in sorted(results.items()):
+    expected = baseline.get(name)
+    if not expected:
+      continue
+    for metric in _THROUGHPUTS:
+      if metrics[metric] < expected[metric] * (1 - tolerance):
+        found.append('{0} {1}: {2:.1f}, baseline {3:.1f}'.format(
+          name, metric, metrics[metric], expected[metric]))
+    for metric in _LATENCIES:
+      slower = metrics[metric] > expected[metric] * (1 + tolerance)
+      if slower and metrics[metric] - expected[metric] > _LATENCY_SLACK_MS:
+        found.append('{0} {1}: {2:.1f}, baseline {3:.1f}'.format(
+          name, metric, metrics[metric], expected[metric]))
+  return found
+
+
+def _load_baseline(path):
+  if path:
+    if not os.path.exists(path):
+      return {}
+    with open(path, 'r') as infile:
+      return json.load(infile)
+  # Read as a resource, so the baseline is found inside the pex too.
+  try:
+    data = pkgutil.get_data('verst_test.pants.s3cache.benchmarks', _BASELINE)
+  except IOError:
+    return {}
+  return json.loads(data.decode('utf-8')) if data else {}
+
+
+def _parse_option(option):
+  name, _, value = option.partition('=')
+  try:
+    value = ast.literal_eval(value)
+  except (ValueError, SyntaxError):
+    pass
+  return name.replace('-', '_'), value
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--profile', choices=sorted(_PROFILES), default='quick')
+  parser.add_argument('--sizes', help='Comma separated artifact sizes, like 4KB,1MB,1GB.')
+  parser.add_argument('--files', help='Comma separated numbers of files per artifact.')
+  parser.add_argument('--levels', help='Comma separated compression levels.')
+  parser.add_argument('--concurrency', help='Comma separated numbers of concurrent operations.')
+  parser.add_argument('--rounds', type=int, default=3,
+                      help='Artifacts each thread inserts and restores per scenario.')
+  parser.add_argument('--samples', type=int, default=3,
+                      help='Run each scenario this many times and report the best of each metric.')
+  parser.add_argument('--option', action='append', default=[],
+                      help='A cache option to set, like s3_codec=zstd. Can be repeated.')
+  parser.add_argument('--max-bytes', type=parse_size, default='2GB',
+                      help='Skip scenarios that would hold more than this in moto at once.')
+  parser.add_argument('--baseline',
+                      help='Baseline to compare with. Defaults to the stored {0}.'.format(
+                        _BASELINE))
+  parser.add_argument('--save-baseline', metavar='PATH',
+                      help='Add the results to the baseline at PATH instead of comparing.')
+  parser.add_argument('--tolerance', type=float, default=0.5,
+                      help='Fraction a metric may regress from the baseline before failing.')
+  args = parser.parse_args()
+
+  profile = _PROFILES[args.profile]
+  sizes = args.sizes.split(',') if args.sizes else profile['sizes']
+  files = [int(n) for n in args.files.split(',')] if args.files else profile['files']
+  levels = [int(n) for n in args.levels.split(',')] if args.levels else profile['levels']
+  concurrency = ([int(n) for n in args.concurrency.split(',')] if args.concurrency
+                 else profile['concurrency'])
+  overrides = dict(_parse_option(option) for option in args.option)
+
+  print('{0:<40} {1:>10} {2:>11} {3:>15} {4:>12} {5:>16}'.format(
+    'scenario', 'insert MB/s', 'restore MB/s', 'insert p50/p99', 'has p50/p99',
+    'restore p50/p99'))
+  # The first scenario would otherwise pay for creating the S3 client and warming up moto.
+  run_scenario('4KB', 1, 1, 1, rounds=1, overrides=overrides)
+  results = {}
+  for size, file_count, level, threads in product(sizes, files, levels, concurrency):
+    name = scenario_id(size, file_count, level, threads, overrides)
+    if parse_size(size) * threads * args.rounds > args.max_bytes:
+      print('{0:<40} skipped: more than --max-bytes'.format(name))
+      continue
+    result = results[name] = best_of(args.samples, lambda: run_scenario(
+      size, file_count, level, threads, args.rounds, overrides))
+    print('{0:<40} {1:>10.1f} {2:>11.1f} {3:>15} {4:>12} {5:>16}'.format(
+      name, result['insert_mb_per_s'], result['restore_mb_per_s'],
+      '{0:.0f}/{1:.0f}ms'.format(result['insert_p50_ms'], result['insert_p99_ms']),
+      '{0:.0f}/{1:.0f}ms'.format(result['has_p50_ms'], result['has_p99_ms']),
+      '{0:.0f}/{1:.0f}ms'.format(result['restore_p50_ms'], result['restore_p99_ms'])))
+
+  if args.save_baseline:
+    baseline = _load_baseline(args.save_baseline)
+    baseline.update(results)
+    with open(args.save_baseline, 'w') as outfile:
+      json.dump(baseline, outfile, indent=2, separators=(',', ': '), sort_keys=True)
+      outfile.write('\n')
+    print('Saved {0} scenarios to {1}'.format(len(results), args.save_baseline))
+    return
+
+  baseline = _load_baseline(args.baseline)
+  compared = [scenario for scenario in results if scenario in baseline]
+  found = regressions(results, baseline, args.tolerance)
+  print('Compared {0} of {1} scenarios with the baseline.'.format(len(compared), len(results)))
+  for regression in found:
+    print('REGRESSION {0}'.format(regression))
+  if found:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,147 @@
+# coding=utf-8
+
+"""Compares the codecs S3 artifacts can be stored with.
+
+For each artifact, reports the compression ratio and the compression and decompression throughput
+of every codec at a few levels. By default it synthesizes two representative artifacts: a zinc
+compile output (thousands of small class files plus the text analysis) and a bundle (a few
+already-compressed jars plus scripts). Real artifacts, such as .tgz files from a local artifact
+cache, can be given instead. Run it with:
+
+  ./pants run tests/python/verst_test/pants/s3cache/benchmarks:compression -- --samples=3
+  ./pants run tests/python/verst_test/pants/s3cache/benchmarks:compression -- \\
+    .local_artifact_cache/compile.zinc/*/*.tgz
+"""
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import argparse
+import io
+import os
+import random
+import tarfile
+import time
+import zlib
+
+from verst.pants.s3cache import compression
+
+_LEVELS = {
+  compression.GZIP: [1, 6, 9],
+  compression.ZSTD: [1, 3, 9],
+  compression.LZ4: [0, 3, 9],
+}
+
+
+def _tarball(files):
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode='w') as tarout:
+    for name, content in files:
+      info = tarfile.TarInfo(name)
+      info.size = len(content)
+      tarout.addfile(info, io.BytesIO(content))
+  return buf.getvalue()
+
+
+def _class_file(rng, words):
+  # Constant pools are mostly identifiers shared between classes, around some opaque bytecode.
+  pool = b'\x01'.join(rng.choice(words) for _ in range(rng.randint(50, 400)))
+  code = bytes(bytearray(rng.getrandbits(8) for _ in range(rng.randint(200, 4000))))
+  return b'\xca\xfe\xba\xbe\x00\x00\x00\x34' + pool + code
+
+
+def zinc_artifact(rng):
+  words = [('com.example.' + '.'.join(rng.choice(['core', 'api', 'util', 'model', 'service'])
+                                      for _ in range(3)) +
+            '$' + str(i)).encode('ascii') for i in range(2000)]
+  files = [('classes/com/example/Class{0}.class'.format(i), _class_file(rng, words))
+           for i in range(3000)]
+  analysis = b'\n'.join(b'-> ' + rng.choice(words) + b' ' + rng.choice(words)
+                        for _ in range(50000))
+  files.append(('analysis.txt', analysis))
+  return _tarball(files)
+
+
+def bundle_artifact(rng):
+  # Jars are zips: their contents are already deflated, so they barely compress further.
+  files = [('libs/dep{0}.jar'.format(i),
+            zlib.compress(bytes(bytearray(rng.getrandbits(8) for _ in range(400000)))))
+           for i in range(8)]
+  files.append(('bin/run.sh', b'#!/bin/sh\nexec java -cp "libs/*" com.example.Main "$@"\n' * 20))
+  return _tarball(files)
+
+
+def _read_artifact(path):
+  """Returns the plain tarball at path, decompressing it whatever its codec."""
+  with open(path, 'rb') as infile:
+    data = infile.read()
+  codec = compression.sniff(data)
+  if codec is None:
+    return data
+  decompressor = compression.decompressor(codec)
+  return decompressor.decompress(data)
+
+
+def _best_of(samples, fn):
+  best = None
+  for _ in range(samples):
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def measure(data, codec, level, samples, threads=1):
+  """Returns (ratio, compress MB/s, decompress MB/s) of codec at level on the tarball data."""
+  def compress():
+    compressor = compression.compressor(codec, level, threads)
+    return compressor.compress(data) + compressor.flush()
+
+  def decompress():
+    decompressor = compression.decompressor(codec)
+    result = decompressor.decompress(encoded)
+    assert decompressor.finish()
+    return result
+
+  compress_seconds, encoded = _best_of(samples, compress)
+  decompress_seconds, decoded = _best_of(samples, decompress)
+  assert decoded == data
+  megabytes = len(data) / (1024 * 1024)
+  return (len(data) / len(encoded), megabytes / max(compress_seconds, 1e-6),
+          megabytes / max(decompress_seconds, 1e-6))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('artifacts', nargs='*',
+                      help='Artifacts to compress. Defaults to synthetic zinc and bundle ones.')
+  parser.add_argument('--samples', type=int, default=3,
+                      help='Time each operation this many times and report the fastest.')
+  parser.add_argument('--codecs', default=','.join(compression.CODECS))
+  parser.add_argument('--threads', type=int, default=1,
+                      help='Compress on this many threads, as --cache-s3-compression-threads does.')
+  args = parser.parse_args()
+
+  if args.artifacts:
+    artifacts = [(os.path.basename(path), _read_artifact(path)) for path in args.artifacts]
+  else:
+    rng = random.Random(0)
+    artifacts = [('zinc', zinc_artifact(rng)), ('bundle', bundle_artifact(rng))]
+
+  codecs = args.codecs.split(',')
+  for codec in codecs:
+    compression.check_available(codec)
+  print('{0:<24} {1:>5} {2:>6} {3:>6} {4:>14} {5:>16}'.format(
+    'artifact', 'codec', 'level', 'ratio', 'compress MB/s', 'decompress MB/s'))
+  for name, data in artifacts:
+    for codec in codecs:
+      for level in _LEVELS[codec]:
+        ratio, compress_rate, decompress_rate = measure(data, codec, level, args.samples,
+                                                            args.threads)
+        print('{0:<24} {1:>5} {2:>6} {3:>6.2f} {4:>14.1f} {5:>16.1f}'.format(
+          name[:24], codec, level, ratio, compress_rate, decompress_rate))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+# coding=utf-8
+
+"""Measures how much the s3cache plugin adds to pants startup.
+
+Each sample is a fresh interpreter that first imports the pants modules the plugin builds on, and
+pkg_resources, which pants uses to load plugins (a pants run loads those regardless), then times
+importing the plugin's registration module, which is what pants does when the plugin is enabled.
+Run it with:
+
+  ./pants run tests/python/verst_test/pants/s3cache/benchmarks:startup -- --samples=20
+"""
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import argparse
+import json
+import subprocess
+import sys
+
+_SAMPLE = """
+import json, sys, time
+import pkg_resources
+import pants.build_graph.build_file_aliases, pants.cache.cache_setup
+start = time.time()
+import verst.pants.s3cache.register
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'boto3_imported': 'boto3' in sys.modules}))
+"""
+
+
+def sample():
+  """Returns (seconds to import the plugin, whether that imported boto3) in a fresh process."""
+  result = json.loads(subprocess.check_output([sys.executable, '-c', _SAMPLE]).decode('utf-8'))
+  return result['seconds'], result['boto3_imported']
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--samples', type=int, default=10)
+  args = parser.parse_args()
+
+  samples = [sample() for _ in range(args.samples)]
+  timings = sorted(seconds for seconds, _ in samples)
+  print('plugin import: median {0:.1f}ms, min {1:.1f}ms, max {2:.1f}ms over {3} runs'.format(
+    1000 * timings[len(timings) // 2], 1000 * timings[0], 1000 * timings[-1], len(timings)))
+  print('boto3 imported at startup: {0}'.format(any(imported for _, imported in samples)))
+
+
+if __name__ == '__main__':
+  main()
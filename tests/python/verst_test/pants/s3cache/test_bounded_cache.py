@@ -0,0 +1,144 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+import sqlite3
+from multiprocessing import Pool
+
+import pytest
+from pants.cache.artifact_cache import UnreadableArtifact
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache.bounded_cache import BoundedLocalArtifactCache
+
+# Random content doesn't compress, so each artifact is a little over this size.
+_ARTIFACT_BYTES = 10 * 1024
+
+
+@pytest.yield_fixture(scope="function")
+def artifact_root():
+  with temporary_dir() as root:
+    yield root
+
+
+@pytest.yield_fixture(scope="function")
+def index_root():
+  with temporary_dir() as root:
+    yield root
+
+
+def _cache(artifact_root, index_root, name='task', max_bytes=int(2.5 * _ARTIFACT_BYTES),
+           max_entries_per_target=None):
+  return BoundedLocalArtifactCache(artifact_root, os.path.join(index_root, name), index_root,
+                                   compression=1, max_bytes=max_bytes,
+                                   max_entries_per_target=max_entries_per_target)
+
+
+def _insert(cache, target, key_hash='some_hash'):
+  cache_key = CacheKey(target, key_hash)
+  path = os.path.join(cache.artifact_root, target)
+  with open(path, 'wb') as outfile:
+    outfile.write(os.urandom(_ARTIFACT_BYTES))
+  cache.insert(cache_key, [path])
+  return cache_key
+
+
+def _indexed_bytes(index_root):
+  index = sqlite3.connect(os.path.join(index_root, 'index.sqlite'))
+  try:
+    return index.execute('SELECT SUM(size) FROM artifacts').fetchone()[0]
+  finally:
+    index.close()
+
+
+def test_evicts_least_recently_used(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root)
+  first = _insert(cache, 'first')
+  second = _insert(cache, 'second')
+  assert cache.use_cached_files(first)
+
+  third = _insert(cache, 'third')
+  assert cache.has(first)
+  assert not cache.has(second)
+  assert cache.has(third)
+
+
+def test_budget_is_shared_between_caches(artifact_root, index_root):
+  one = _cache(artifact_root, index_root, name='one')
+  two = _cache(artifact_root, index_root, name='two')
+  first = _insert(one, 'first')
+  _insert(two, 'second')
+  _insert(two, 'third')
+  assert not one.has(first)
+
+
+def test_keeps_an_artifact_larger_than_the_budget(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root, max_bytes=1)
+  first = _insert(cache, 'first')
+  assert cache.use_cached_files(first)
+
+
+def test_delete(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root)
+  first = _insert(cache, 'first')
+  cache.delete(first)
+  assert not cache.has(first)
+  assert not _indexed_bytes(index_root)
+
+
+def test_pruned_artifacts_leave_the_budget(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root, max_bytes=int(3.5 * _ARTIFACT_BYTES),
+                 max_entries_per_target=1)
+  first = _insert(cache, 'first')
+  _insert(cache, 'second', 'old_hash')
+  second = _insert(cache, 'second')
+  third = _insert(cache, 'third')
+  assert all(cache.has(key) for key in (first, second, third))
+  assert _indexed_bytes(index_root) == sum(os.path.getsize(cache._cache_file_for_key(key))
+                                           for key in (first, second, third))
+
+
+def test_artifacts_deleted_elsewhere_leave_the_budget(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root)
+  first = _insert(cache, 'first')
+  deleted = _insert(cache, 'deleted')
+  os.remove(cache._cache_file_for_key(deleted))
+  second = _insert(cache, 'second')
+  assert cache.has(first)
+  assert cache.has(second)
+
+
+def test_unreadable_artifacts_leave_the_budget(artifact_root, index_root):
+  cache = _cache(artifact_root, index_root)
+  first = _insert(cache, 'first')
+  with open(cache._cache_file_for_key(first), 'wb') as outfile:
+    outfile.write(b'not a tarball')
+  assert isinstance(cache.use_cached_files(first), UnreadableArtifact)
+  assert not _indexed_bytes(index_root)
+
+
+def _insert_many(args):
+  artifact_root, index_root, worker = args
+  cache = _cache(artifact_root, index_root)
+  for i in range(5):
+    _insert(cache, 'target_{0}_{1}'.format(worker, i))
+
+
+def test_concurrent_processes_stay_within_budget(artifact_root, index_root):
+  pool = Pool(4)
+  try:
+    pool.map(_insert_many, [(artifact_root, index_root, worker) for worker in range(8)])
+  finally:
+    pool.close()
+    pool.join()
+
+  # While processes race, each may hold on to the artifact it just stored; once they are done,
+  # the next insert brings everything back within budget.
+  cache = _cache(artifact_root, index_root)
+  _insert(cache, 'last')
+  cached = [os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(os.path.join(index_root, 'task')) for name in names]
+  assert 0 < sum(os.path.getsize(path) for path in cached) <= cache._max_bytes
+  assert _indexed_bytes(index_root) == sum(os.path.getsize(path) for path in cached)
@@ -12,13 +12,15 @@ from pants.cache.cache_setup import (CacheSetup, CacheSpecFormatError,
                                      LocalCacheSpecRequiredError,
                                      RemoteCacheSpecRequiredError,
                                      TooManyCacheSpecsError)
-from pants.cache.local_artifact_cache import LocalArtifactCache
+from pants.cache.local_artifact_cache import LocalArtifactCache, TempLocalArtifactCache
 from pants.cache.restful_artifact_cache import RESTfulArtifactCache
 from pants.subsystem.subsystem import Subsystem
 from pants.task.task import Task
 from pants.util.contextutil import temporary_dir
 from pants_test.base_test import BaseTest
+from verst.pants.s3cache.bounded_cache import BoundedLocalArtifactCache
 from verst.pants.s3cache.cache_setup import patch
+from verst.pants.s3cache.daemon import DaemonArtifactCache
 from verst.pants.s3cache.s3cache import S3ArtifactCache
 
 
@@ -97,3 +99,39 @@ class TestCacheSetup(BaseTest):
         mk_cache([tmpdir, self.REMOTE_URI_1, self.REMOTE_URI_2])
 
       check(S3ArtifactCache, ['s3://some-bucket/bar'])
+
+  def test_s3_local_cache_tier(self):
+    def mk_cache(spec, **options):
+      Subsystem.reset()
+      self.set_options_for_scope(CacheSetup.subscope(DummyTask.options_scope),
+                                 read_from=spec, compression=1, **options)
+      self.context(for_task_types=[DummyTask])  # Force option initialization.
+      return CacheSetup.create_cache_factory_for_task(DummyTask).get_read_cache()
+
+    with temporary_dir() as tmpdir:
+      cache = mk_cache(['s3://some-bucket/bar'])
+      self.assertIsInstance(cache._localcache, TempLocalArtifactCache)
+
+      cache = mk_cache(['s3://some-bucket/bar'], s3_local_cache_max_bytes=1024,
+                       s3_local_cache_dir=tmpdir)
+      self.assertIsInstance(cache._localcache, BoundedLocalArtifactCache)
+
+      cachedir = os.path.join(tmpdir, 'cachedir')
+      cache = mk_cache([cachedir, 's3://some-bucket/bar'], s3_local_cache_max_bytes=1024,
+                       s3_local_cache_dir=tmpdir)
+      self.assertNotIsInstance(cache._localcache, BoundedLocalArtifactCache)
+
+  def test_s3_daemon(self):
+    def mk_cache(spec, **options):
+      Subsystem.reset()
+      self.set_options_for_scope(CacheSetup.subscope(DummyTask.options_scope),
+                                 read_from=spec, compression=1, **options)
+      self.context(for_task_types=[DummyTask])  # Force option initialization.
+      return CacheSetup.create_cache_factory_for_task(DummyTask).get_read_cache()
+
+    with temporary_dir() as tmpdir:
+      socket_path = os.path.join(tmpdir, 'daemon.sock')
+      cache = mk_cache(['s3://some-bucket/bar'], s3_daemon_socket=socket_path)
+      self.assertIsInstance(cache, DaemonArtifactCache)
+      self.assertIsInstance(cache._remote, S3ArtifactCache)
+      self.assertEquals(cache._socket_path, socket_path)
@@ -0,0 +1,110 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+import threading
+import time
+
+import pytest
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache.circuit_breaker import CircuitBreaker
+
+
+@pytest.yield_fixture(scope="function")
+def marker_path():
+  with temporary_dir() as root:
+    yield os.path.join(root, 'circuit-open')
+
+
+def _breaker(marker_path):
+  return CircuitBreaker('test cache', marker_path, threshold=3, window=60, cooldown=120)
+
+
+def _age_marker(marker_path, seconds):
+  opened = time.time() - seconds
+  os.utime(marker_path, (opened, opened))
+
+
+def test_opens_after_threshold(marker_path):
+  breaker = _breaker(marker_path)
+  breaker.record_failure()
+  breaker.record_failure()
+  assert breaker.allow()
+  breaker.record_failure()
+  assert not breaker.allow()
+
+  # Other processes sharing the workdir see the open circuit too.
+  assert not _breaker(marker_path).allow()
+
+
+def test_success_resets_failure_count(marker_path):
+  breaker = _breaker(marker_path)
+  breaker.record_failure()
+  breaker.record_failure()
+  breaker.record_success()
+  breaker.record_failure()
+  assert breaker.allow()
+
+
+def test_probe_success_closes(marker_path):
+  breaker = _breaker(marker_path)
+  for _ in range(3):
+    breaker.record_failure()
+  _age_marker(marker_path, 121)
+
+  assert breaker.allow()
+  breaker.record_success()
+  assert not os.path.exists(marker_path)
+  assert breaker.allow()
+
+
+def test_probe_failure_reopens(marker_path):
+  breaker = _breaker(marker_path)
+  for _ in range(3):
+    breaker.record_failure()
+  _age_marker(marker_path, 121)
+
+  assert breaker.allow()
+  breaker.record_failure()
+  assert not breaker.allow()
+
+
+def test_single_probe_when_cooled_down(marker_path):
+  breaker = _breaker(marker_path)
+  for _ in range(3):
+    breaker.record_failure()
+  _age_marker(marker_path, 121)
+
+  assert breaker.allow(claim=False)
+  assert breaker.allow()
+  # The probe's thread is let through until it reports back; nobody else is.
+  assert breaker.allow()
+  others = []
+  thread = threading.Thread(target=lambda: others.append((_breaker(marker_path).allow(),
+                                                          breaker.allow(claim=False))))
+  thread.start()
+  thread.join()
+  assert others == [(False, False)]
+
+  breaker.record_success()
+  assert _breaker(marker_path).allow()
+
+
+def test_abandoned_probe_is_reclaimed(marker_path):
+  breaker = _breaker(marker_path)
+  for _ in range(3):
+    breaker.record_failure()
+  _age_marker(marker_path, 121)
+  assert breaker.allow()
+
+  others = []
+  thread = threading.Thread(target=lambda: others.append(breaker.allow()))
+  thread.start()
+  thread.join()
+  _age_marker(marker_path + '.probe', 121)
+  thread = threading.Thread(target=lambda: others.append(breaker.allow()))
+  thread.start()
+  thread.join()
+  assert others == [False, True]
@@ -0,0 +1,100 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+from pants.cache.artifact import ArtifactError
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache import compression
+from verst.pants.s3cache.compression import (CODECS,
+                                             GZIP,
+                                             ParallelGzipCompressor,
+                                             ZSTD)
+
+
+def _tarball(mode='w'):
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode=mode) as tarout:
+    content = os.urandom(5000) * 4
+    info = tarfile.TarInfo('one.class')
+    info.size = len(content)
+    tarout.addfile(info, io.BytesIO(content))
+  return buf.getvalue()
+
+
+def _compress(codec, data):
+  compressor = compression.compressor(codec)
+  return compressor.compress(data) + compressor.flush()
+
+
+def _chunks(data, size=100):
+  return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_decode(codec):
+  data = _tarball()
+  encoded = _compress(codec, data)
+  assert compression.sniff(encoded) == codec
+  decoded = b''.join(compression.decode(_chunks(encoded)))
+  # Gzip is left for the local cache to decompress.
+  assert decoded == (encoded if codec == GZIP else data)
+
+
+def test_decode_passes_plain_tarballs_through():
+  data = _tarball()
+  assert compression.sniff(data) is None
+  assert b''.join(compression.decode(_chunks(data))) == data
+
+
+@pytest.mark.parametrize('codec', [codec for codec in CODECS if codec != GZIP])
+@pytest.mark.parametrize('corrupt', [
+  lambda data: data[:len(data) // 2],
+  lambda data: data[:-3],
+  lambda data: data[:len(data) // 2] + b'\xff' * 64 + data[len(data) // 2 + 64:],
+], ids=['truncated-content', 'truncated-trailer', 'garbled'])
+def test_decode_detects_corruption(codec, corrupt):
+  encoded = _compress(codec, _tarball())
+  with pytest.raises(ArtifactError):
+    b''.join(compression.decode(_chunks(corrupt(encoded))))
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_transcode(codec):
+  data = _tarball()
+  with temporary_dir() as tmpdir:
+    src = os.path.join(tmpdir, 'artifact.tgz')
+    dest = os.path.join(tmpdir, 'artifact.' + codec)
+    with open(src, 'wb') as outfile:
+      outfile.write(_compress(GZIP, data))
+    compression.transcode(src, dest, codec, level=1)
+    with open(dest, 'rb') as infile:
+      encoded = infile.read()
+  assert compression.sniff(encoded) == codec
+  decoded = compression.decompressor(codec)
+  assert decoded.decompress(encoded) == data
+  assert decoded.finish()
+
+
+def test_parallel_gzip():
+  data = os.urandom(1000) * 300
+  compressor = ParallelGzipCompressor(level=6, threads=4, block_size=4096)
+  encoded = b''.join(compressor.compress(chunk) for chunk in _chunks(data, size=1000))
+  encoded += compressor.flush()
+  # A single member, which incremental gzip readers and the gzip module both accept.
+  decompressor = compression.decompressor(GZIP)
+  assert decompressor.decompress(encoded) == data
+  assert decompressor.finish()
+  assert gzip.GzipFile(fileobj=io.BytesIO(encoded)).read() == data
+
+
+def test_check_available():
+  compression.check_available(ZSTD)
+  with pytest.raises(ValueError):
+    compression.check_available('brotli')
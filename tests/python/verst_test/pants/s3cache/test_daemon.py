@@ -0,0 +1,164 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+from multiprocessing import Pool
+
+import boto3
+import mock
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_s3
+from pants.cache.local_artifact_cache import TempLocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import temporary_dir
+from pants.util.dirutil import safe_file_dump
+from verst.pants.s3cache.daemon import ArtifactDaemon, DaemonArtifactCache
+from verst.pants.s3cache.listings import heads, listings
+from verst.pants.s3cache.s3cache import S3ArtifactCache
+
+_TEST_BUCKET = 'verst-test-bucket'
+_S3_URL = 's3://{0}/path'.format(_TEST_BUCKET)
+_CACHE_KEY = CacheKey('some_target', 'some_hash')
+_RELPATH = os.path.join('some_target', 'output')
+_CONTENT = b'fraggle'
+
+
+@pytest.yield_fixture(autouse=True)
+def s3_fixture():
+  mock_s3().start()
+  try:
+    boto3.resource('s3').create_bucket(Bucket=_TEST_BUCKET)
+    yield
+  finally:
+    listings.clear()
+    heads.clear()
+    mock_s3().stop()
+
+
+@pytest.fixture()
+def artifact():
+  with temporary_dir() as artifact_root:
+    path = os.path.join(artifact_root, _RELPATH)
+    safe_file_dump(path, _CONTENT)
+    writer = S3ArtifactCache(artifact_root, _S3_URL, TempLocalArtifactCache(artifact_root, 0))
+    assert writer.insert(_CACHE_KEY, [path])
+
+
+@pytest.yield_fixture()
+def daemon():
+  with temporary_dir() as store:
+    yield ArtifactDaemon(store)
+
+
+@pytest.yield_fixture()
+def socket_path(daemon):
+  with temporary_dir() as tmpdir:
+    path = os.path.join(tmpdir, 'daemon.sock')
+    server = daemon.server(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+      yield path
+    finally:
+      server.shutdown()
+      server.server_close()
+
+
+def _use_through_daemon(socket_path):
+  """Reads the artifact through the daemon in a new artifact root, returning what it extracted."""
+  with temporary_dir() as artifact_root:
+    local = TempLocalArtifactCache(artifact_root, 0)
+    cache = DaemonArtifactCache(artifact_root, socket_path, _S3_URL,
+                                S3ArtifactCache(artifact_root, _S3_URL, local), local)
+    if cache.use_cached_files(_CACHE_KEY) is not True:
+      return None
+    with open(os.path.join(artifact_root, _RELPATH), 'rb') as infile:
+      return infile.read()
+
+
+def test_concurrent_fetches_share_one_download(artifact, daemon):
+  original_prefetch = S3ArtifactCache.prefetch
+
+  def slow_prefetch(cache, cache_key):
+    time.sleep(0.2)
+    return original_prefetch(cache, cache_key)
+
+  with mock.patch.object(S3ArtifactCache, 'prefetch', autospec=True,
+                         side_effect=slow_prefetch) as prefetch:
+    with ThreadPoolExecutor(max_workers=8) as pool:
+      paths = list(pool.map(lambda _: daemon.fetch(_S3_URL, _CACHE_KEY), range(8)))
+    assert prefetch.call_count == 1
+  assert len(set(paths)) == 1 and os.path.exists(paths[0])
+  assert daemon.stats() == {'fetches': 8, 'downloads': 1}
+
+  # Misses aren't stored, but are collapsed the same way.
+  assert daemon.fetch(_S3_URL, CacheKey('some_target', 'missing')) is None
+
+
+def test_store_hits_count_as_uses(artifact):
+  with temporary_dir() as store:
+    daemon = ArtifactDaemon(store, max_bytes=1024 * 1024)
+    path = daemon.fetch(_S3_URL, _CACHE_KEY)
+
+    def last_used():
+      index = sqlite3.connect(os.path.join(store, 'index.sqlite'))
+      try:
+        return index.execute('SELECT last_used FROM artifacts WHERE path = ?',
+                             (path,)).fetchone()[0]
+      finally:
+        index.close()
+
+    downloaded = last_used()
+    time.sleep(0.01)
+    assert daemon.fetch(_S3_URL, _CACHE_KEY) == path
+    assert last_used() > downloaded
+  assert daemon.stats() == {'fetches': 2, 'downloads': 1}
+
+
+def test_client_processes_share_the_store(artifact, daemon, socket_path):
+  pool = Pool(4)
+  try:
+    extracted = pool.map(_use_through_daemon, [socket_path] * 8)
+  finally:
+    pool.close()
+    pool.join()
+  assert extracted == [_CONTENT] * 8
+  assert daemon.stats() == {'fetches': 8, 'downloads': 1}
+
+
+def test_client_answers_has_through_daemon(artifact, daemon, socket_path):
+  with temporary_dir() as artifact_root:
+    local = TempLocalArtifactCache(artifact_root, 0)
+    remote = S3ArtifactCache(artifact_root, _S3_URL, local)
+    cache = DaemonArtifactCache(artifact_root, socket_path, _S3_URL, remote, local)
+    with mock.patch.object(remote, 'has') as remote_has:
+      assert cache.has(_CACHE_KEY)
+      assert not cache.has(CacheKey('some_target', 'missing'))
+      assert not remote_has.called
+
+
+def test_client_looks_up_in_bulk_through_remote(artifact, daemon, socket_path):
+  with temporary_dir() as artifact_root:
+    local = TempLocalArtifactCache(artifact_root, 0)
+    remote = S3ArtifactCache(artifact_root, _S3_URL, local, bulk_lookup=True)
+    cache = DaemonArtifactCache(artifact_root, socket_path, _S3_URL, remote, local)
+    missing = CacheKey('some_target', 'missing')
+    assert cache.bulk_lookup
+    assert cache.has_all([_CACHE_KEY, missing]) == {_CACHE_KEY: True, missing: False}
+
+
+def test_socket_only_reachable_by_owner(socket_path):
+  assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+
+def test_client_falls_back_to_s3_without_daemon(artifact):
+  with temporary_dir() as tmpdir:
+    assert _use_through_daemon(os.path.join(tmpdir, 'missing.sock')) == _CONTENT
@@ -0,0 +1,116 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+import time
+
+import boto3
+import mock
+import pytest
+from botocore.vendored.requests import ConnectionError
+from moto import mock_s3
+from pants.cache.local_artifact_cache import TempLocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import temporary_dir, temporary_file
+from verst.pants.s3cache import s3cache
+from verst.pants.s3cache.failover import FailoverArtifactCache, rank_s3_urls
+from verst.pants.s3cache.listings import listings
+from verst.pants.s3cache.s3cache import S3ArtifactCache
+
+_PRIMARY = 'verst-test-primary'
+_SECONDARY = 'verst-test-secondary'
+
+
+@pytest.yield_fixture(scope="function", autouse=True)
+def s3_fixture():
+  mock_s3().start()
+
+  try:
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=_PRIMARY)
+    s3.create_bucket(Bucket=_SECONDARY)
+    yield s3
+  finally:
+    listings.clear()
+    mock_s3().stop()
+
+
+@pytest.yield_fixture(scope="function")
+def artifact_root():
+  with temporary_dir() as root:
+    yield root
+
+
+def _s3_cache(artifact_root, bucket):
+  return S3ArtifactCache(artifact_root, 's3://{0}/path'.format(bucket),
+                         TempLocalArtifactCache(artifact_root, 0), circuit_breaker_threshold=2)
+
+
+def _slow(method, bucket, delay):
+  def call(**kwargs):
+    if kwargs['Bucket'] == bucket:
+      time.sleep(delay)
+    return method(**kwargs)
+  return call
+
+
+def _unreachable(method, bucket):
+  def call(**kwargs):
+    if kwargs['Bucket'] == bucket:
+      raise ConnectionError('down')
+    return method(**kwargs)
+  return call
+
+
+def test_rank_s3_urls():
+  client = s3cache.get_s3_client(region_name='us-east-1')
+  urls = ['s3://{0}/path'.format(bucket) for bucket in (_PRIMARY, 'no-such-bucket', _SECONDARY)]
+  with mock.patch.object(client, 'head_bucket', _slow(client.head_bucket, _PRIMARY, 0.2)):
+    ranked = rank_s3_urls(urls)
+  assert [url for url, _ in ranked] == [urls[2], urls[0]]
+
+
+def test_buckets_probed_in_their_region():
+  client = s3cache.get_s3_client()
+  regional = s3cache.get_s3_client(region_name='eu-west-1')
+
+  def get_bucket_location(Bucket):
+    return {'LocationConstraint': 'EU' if Bucket == _SECONDARY else None}
+
+  with mock.patch.object(client, 'get_bucket_location', side_effect=get_bucket_location):
+    with mock.patch.object(regional, 'head_bucket') as head_bucket:
+      ranked = rank_s3_urls(['s3://{0}/path'.format(bucket) for bucket in (_PRIMARY, _SECONDARY)])
+  assert len(ranked) == 2
+  head_bucket.assert_called_once_with(Bucket=_SECONDARY)
+
+
+def test_fails_over_to_next_bucket(artifact_root):
+  primary = _s3_cache(artifact_root, _PRIMARY)
+  secondary = _s3_cache(artifact_root, _SECONDARY)
+  cache = FailoverArtifactCache(artifact_root, [primary, secondary])
+  cache_key = CacheKey('some_target', 'some_hash')
+  with temporary_file(artifact_root) as f:
+    f.write(b'fraggle')
+    f.close()
+    # The buckets are replicas.
+    assert primary.insert(cache_key, [f.name])
+    assert secondary.insert(cache_key, [f.name])
+
+    client = s3cache.get_s3_client()
+    with mock.patch.object(client, 'get_object', _unreachable(client.get_object, _PRIMARY)):
+      # Network errors look like misses until the primary's circuit opens ...
+      assert not cache.use_cached_files(cache_key)
+      assert not cache.use_cached_files(cache_key)
+      # ... then requests go to the secondary.
+      os.unlink(f.name)
+      assert cache.use_cached_files(cache_key)
+      assert os.path.exists(f.name)
+      assert not primary.available()
+
+    # Once the primary answers a probe again, it is preferred again.
+    with mock.patch('verst.pants.s3cache.circuit_breaker.time.time',
+                    return_value=time.time() + 3600):
+      assert cache.use_cached_files(cache_key)
+    assert primary.available()
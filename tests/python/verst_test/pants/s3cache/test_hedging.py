@@ -0,0 +1,97 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import threading
+import time
+
+import pytest
+from verst.pants.s3cache.hedging import (hedge_stats,
+                                         hedged,
+                                         LatencyTracker)
+
+
+@pytest.fixture()
+def latencies():
+  tracker = LatencyTracker()
+  for i in range(1, 101):
+    tracker.record(i / 1000.0)
+  return tracker
+
+
+def _stats_delta(before):
+  after = hedge_stats()
+  return {name: after[name] - before[name] for name in after}
+
+
+def test_percentile():
+  tracker = LatencyTracker()
+  tracker.record(1)
+  assert tracker.percentile(50) is None
+  for i in range(2, 101):
+    tracker.record(i)
+  assert tracker.percentile(50) == 50
+  assert tracker.percentile(95) == 95
+  assert tracker.percentile(100) == 100
+
+
+def test_fast_request_is_not_hedged(latencies):
+  before = hedge_stats()
+  calls = []
+  assert hedged(lambda: calls.append(1) or 'result', latencies, 95, discard=None) == 'result'
+  assert len(calls) == 1
+  assert _stats_delta(before) == {'hedged': 0, 'won': 0, 'lost': 0}
+
+
+def test_slow_request_is_hedged(latencies):
+  before = hedge_stats()
+  first_call = threading.Event()
+  release = threading.Event()
+  discarded = []
+
+  def request():
+    if not first_call.is_set():
+      first_call.set()
+      release.wait()
+      return 'slow'
+    return 'fast'
+
+  assert hedged(request, latencies, 50, discard=discarded.append) == 'fast'
+  release.set()
+  for _ in range(100):
+    if discarded:
+      break
+    time.sleep(0.01)
+  assert discarded == ['slow']
+  assert _stats_delta(before) == {'hedged': 1, 'won': 1, 'lost': 0}
+
+
+def test_failed_hedge_falls_back_to_the_first_request(latencies):
+  before = hedge_stats()
+  calls = []
+
+  def request():
+    calls.append(1)
+    if len(calls) == 1:
+      time.sleep(0.2)
+      return 'slow'
+    raise IOError('hedge failed')
+
+  assert hedged(request, latencies, 50, discard=None) == 'slow'
+  assert _stats_delta(before) == {'hedged': 1, 'won': 0, 'lost': 1}
+
+
+def test_only_successful_requests_are_recorded():
+  tracker = LatencyTracker()
+  for i in range(1, 20):
+    tracker.record(i)
+
+  def request():
+    raise IOError('not found')
+
+  with pytest.raises(IOError):
+    hedged(request, tracker, 50, discard=None)
+  assert tracker.percentile(50) is None
+  hedged(lambda: 'result', tracker, 50, discard=None)
+  assert tracker.percentile(50) is not None
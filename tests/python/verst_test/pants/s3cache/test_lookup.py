@@ -0,0 +1,89 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+
+import boto3
+import mock
+from moto import mock_s3
+from pants.backend.python.targets.python_library import PythonLibrary
+from pants.base.fingerprint_strategy import TaskIdentityFingerprintStrategy
+from pants.cache.cache_setup import CacheSetup
+from pants.task.task import Task
+from pants.util.dirutil import safe_file_dump
+from pants_test.tasks.task_test_base import TaskTestBase
+from verst.pants.s3cache.cache_setup import patch
+from verst.pants.s3cache.listings import heads, listings
+
+_TEST_BUCKET = 'verst-test-bucket'
+
+
+class CachingTask(Task):
+  cache_target_dirs = True
+
+  def execute(self):
+    with self.invalidated(self.context.targets()) as invalidation_check:
+      self.invalid = [vt.target for vt in invalidation_check.invalid_vts]
+
+
+class BulkLookupTest(TaskTestBase):
+
+  @classmethod
+  def task_type(cls):
+    return CachingTask
+
+  def setUp(self):
+    super(BulkLookupTest, self).setUp()
+    patch()
+    self._mock_s3 = mock_s3()
+    self._mock_s3.start()
+    boto3.resource('s3').create_bucket(Bucket=_TEST_BUCKET)
+
+  def tearDown(self):
+    listings.clear()
+    heads.clear()
+    self._mock_s3.stop()
+    super(BulkLookupTest, self).tearDown()
+
+  def _create_task(self, bulk_lookup):
+    targets = []
+    for name in ('a', 'b'):
+      self.create_file('src/{0}.py'.format(name))
+      targets.append(self.make_target('src:{0}'.format(name), PythonLibrary,
+                                      sources=['{0}.py'.format(name)]))
+    self.set_options_for_scope(CacheSetup.subscope(self.options_scope),
+                               read_from=['s3://{0}/path'.format(_TEST_BUCKET)],
+                               s3_bulk_lookup=bulk_lookup)
+    task = self.create_task(self.context(target_roots=targets))
+
+    # Only a was built and cached elsewhere.
+    cache_manager = task.create_cache_manager(False, TaskIdentityFingerprintStrategy(task))
+    vt = cache_manager.check(targets[:1]).invalid_vts[0]
+    results_dir = os.path.join(self.build_root, 'built')
+    safe_file_dump(os.path.join(results_dir, 'output'), 'output')
+    assert task._cache_factory.get_read_cache().insert(vt.cache_key, [results_dir])
+    return task, targets
+
+  def _execute(self, task):
+    looked_up = []
+    subproc_map = task.context.subproc_map
+
+    def record(f, items):
+      looked_up.extend(cache_key.id for _, cache_key, _ in items)
+      return subproc_map(f, items)
+
+    with mock.patch.object(task.context, 'subproc_map', side_effect=record):
+      task.execute()
+    return looked_up
+
+  def test_bulk_lookup_only_fetches_hits(self):
+    task, (a, b) = self._create_task(bulk_lookup=True)
+    assert self._execute(task) == [a.id]
+    assert task.invalid == [b]
+
+  def test_lookup_without_bulk_lookup(self):
+    task, (a, b) = self._create_task(bulk_lookup=False)
+    assert sorted(self._execute(task)) == sorted([a.id, b.id])
+    assert task.invalid == [b]
@@ -0,0 +1,100 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import json
+import multiprocessing
+import os
+
+import mock
+import pytest
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache import metrics
+from verst.pants.s3cache.metrics import OperationMetrics
+
+
+def test_summary_percentiles():
+  collector = OperationMetrics()
+  for millis in range(1, 101):
+    collector.record(metrics.GET, metrics.HIT if millis % 4 else metrics.MISS, millis / 1000.0,
+                     size=10)
+  summary = collector.summary()[metrics.GET]
+  assert (summary['count'], summary['hit'], summary['miss'], summary['bytes']) == (100, 75, 25,
+                                                                                   1000)
+  assert summary['hit_rate'] == 0.75
+  # Percentiles are the bounds of their latency buckets, which are about 19% wide.
+  latency = summary['latency_ms']
+  assert 50 <= latency['p50'] < 50 * 1.2
+  assert 90 <= latency['p90'] < 90 * 1.2
+  assert 99 <= latency['p99'] <= latency['max'] == pytest.approx(100)
+
+
+def test_measure_notes_failures_over_misses():
+  with temporary_dir() as spool_dir:
+    with metrics.measure(metrics.HAS, spool_dir) as measurement:
+      metrics.note(metrics.MISS)
+      metrics.note(metrics.NETWORK)
+      measurement.found(False)
+    with metrics.measure(metrics.GET, spool_dir) as measurement:
+      metrics.add_bytes(3)
+      assert list(metrics.counted([b'ab', b'c'])) == [b'ab', b'c']
+      measurement.found(True)
+    with pytest.raises(ValueError):
+      with metrics.measure(metrics.PUT, spool_dir):
+        raise ValueError('boom')
+    # Outside of a measurement nothing is noted.
+    metrics.note(metrics.UNKNOWN)
+
+    summary = metrics.collect(spool_dir).summary()
+  assert (summary['has']['network'], summary['has']['miss']) == (1, 0)
+  assert (summary['GET']['hit'], summary['GET']['bytes']) == (1, 6)
+  assert summary['PUT']['unknown'] == 1
+
+
+def test_spooled_on_flush_rather_than_per_operation():
+  with temporary_dir() as spool_dir:
+    for _ in range(3):
+      metrics.record(metrics.GET, metrics.HIT, 0.01, spool_dir=spool_dir)
+    assert os.listdir(spool_dir) == []
+    metrics.flush(spool_dir)
+    assert os.listdir(spool_dir) == ['{0}.json'.format(os.getpid())]
+
+
+def _record_gets(spool_dir):
+  for _ in range(10):
+    metrics.record(metrics.GET, metrics.HIT, 0.01, size=100, spool_dir=spool_dir)
+
+
+def test_collect_merges_processes():
+  with temporary_dir() as spool_dir:
+    # Recorded before the pool forks, and so not spooled again by its workers.
+    metrics.record(metrics.GET, metrics.MISS, 0.01, spool_dir=spool_dir)
+    pool = multiprocessing.Pool(4)
+    try:
+      pool.map(_record_gets, [spool_dir] * 4)
+    finally:
+      pool.close()
+      pool.join()
+    summary = metrics.collect(spool_dir).summary()[metrics.GET]
+  assert (summary['count'], summary['hit'], summary['miss']) == (41, 40, 1)
+  assert summary['bytes'] == 4000
+
+
+def test_report():
+  with temporary_dir() as run_info_dir:
+    run_tracker = mock.Mock(run_info_dir=run_info_dir)
+    assert metrics.report(run_tracker) is None
+
+    spool_dir = os.path.join(run_info_dir, metrics.SPOOL_DIR)
+    metrics.record(metrics.PUT, metrics.HIT, 0.5, size=100, spool_dir=spool_dir)
+    metrics.record(metrics.PUT, metrics.NETWORK, 1.5, spool_dir=spool_dir)
+    summary = metrics.report(run_tracker)
+
+    path = os.path.join(run_info_dir, metrics.METRICS_FILE)
+    with open(path, 'r') as infile:
+      assert json.load(infile) == summary
+  assert (summary['PUT']['count'], summary['PUT']['network']) == (2, 1)
+  run_tracker.cumulative_timings.add_timing.assert_called_once_with('s3cache:PUT',
+                                                                    pytest.approx(2.0))
+  run_tracker.run_info.add_info.assert_called_once_with('s3cache_metrics', path)
@@ -0,0 +1,54 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+import time
+
+import pytest
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache import negative_cache
+from verst.pants.s3cache.negative_cache import NegativeLookupCache
+
+
+@pytest.yield_fixture(scope="function")
+def cache_root():
+  with temporary_dir() as root:
+    yield root
+
+
+def test_records_and_clears_misses(cache_root):
+  cache = NegativeLookupCache(cache_root, ttl=60, max_entries=1000)
+  assert not cache.is_missing('bucket', 'path/id/hash.tgz')
+
+  cache.record_missing('bucket', 'path/id/hash.tgz')
+  assert cache.is_missing('bucket', 'path/id/hash.tgz')
+  assert not cache.is_missing('other-bucket', 'path/id/hash.tgz')
+
+  cache.clear('bucket', 'path/id/hash.tgz')
+  assert not cache.is_missing('bucket', 'path/id/hash.tgz')
+
+
+def test_misses_expire(cache_root):
+  cache = NegativeLookupCache(cache_root, ttl=60, max_entries=1000)
+  cache.record_missing('bucket', 'key')
+  path = cache._entry_path('bucket', 'key')
+  an_hour_ago = time.time() - 3600
+  os.utime(path, (an_hour_ago, an_hour_ago))
+  assert not cache.is_missing('bucket', 'key')
+
+
+def test_evicts_oldest_misses(cache_root, monkeypatch):
+  monkeypatch.setattr(negative_cache, '_SHARDS', 1)
+  cache = NegativeLookupCache(cache_root, ttl=60, max_entries=2)
+  for age, key in enumerate(['newest', 'middle', 'oldest']):
+    cache.record_missing('bucket', key)
+    recorded = time.time() - age
+    os.utime(cache._entry_path('bucket', key), (recorded, recorded))
+  cache.record_missing('bucket', 'latest')
+
+  assert cache.is_missing('bucket', 'latest')
+  assert cache.is_missing('bucket', 'newest')
+  assert not cache.is_missing('bucket', 'middle')
+  assert not cache.is_missing('bucket', 'oldest')
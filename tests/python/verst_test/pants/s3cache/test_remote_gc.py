@@ -0,0 +1,184 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import time
+
+import boto3
+import mock
+import pytest
+from moto import mock_s3
+from pants.cache.local_artifact_cache import TempLocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.util.contextutil import temporary_dir, temporary_file
+from verst.pants.s3cache import remote_gc, s3cache
+from verst.pants.s3cache.remote_gc import LayoutMigrator, RemoteCacheCollector
+from verst.pants.s3cache.s3cache import S3ArtifactCache
+
+_TEST_BUCKET = 'verst-test-bucket'
+_URL = 's3://{0}/path'.format(_TEST_BUCKET)
+_AN_HOUR_FROM_NOW = time.time() + 3600
+
+
+@pytest.yield_fixture(scope="function", autouse=True)
+def bucket():
+  mock_s3().start()
+
+  try:
+    s3 = boto3.resource('s3')
+    yield s3.create_bucket(Bucket=_TEST_BUCKET)
+  finally:
+    mock_s3().stop()
+
+
+def _sharded(target):
+  return '{0}/{1}'.format(s3cache.shard_dir(target), target)
+
+
+def _put(bucket, target, hash, body=b'artifact'):
+  bucket.put_object(Key='path/{0}/{1}.tgz'.format(target, hash), Body=body)
+  # Listings report modification times to the millisecond.
+  time.sleep(0.01)
+
+
+def _keys(bucket):
+  return sorted(entry.key for entry in bucket.objects.all())
+
+
+def test_keeps_newest_per_target(bucket):
+  for hash in ('oldest', 'older', 'newer', 'newest'):
+    _put(bucket, 'a', hash, body=b'0123456789')
+  _put(bucket, 'b', 'only')
+  collector = RemoteCacheCollector(_URL, keep_per_target=2, keep_within=60)
+
+  assert collector.collect(dry_run=True, now=_AN_HOUR_FROM_NOW) == (2, 20)
+  assert len(_keys(bucket)) == 5
+
+  assert collector.collect(now=_AN_HOUR_FROM_NOW) == (2, 20)
+  assert _keys(bucket) == ['path/a/newer.tgz', 'path/a/newest.tgz', 'path/b/only.tgz']
+
+
+def test_keeps_recent_artifacts(bucket):
+  for hash in ('oldest', 'older', 'newer', 'newest'):
+    _put(bucket, 'a', hash)
+  collector = RemoteCacheCollector(_URL, keep_per_target=1, keep_within=60)
+  assert collector.collect() == (0, 0)
+  assert len(_keys(bucket)) == 4
+
+
+def test_deletes_in_batches(bucket):
+  for hash in range(5):
+    _put(bucket, 'a', hash)
+  collector = RemoteCacheCollector(_URL, keep_per_target=0, keep_within=0)
+  client = s3cache.get_s3_client(max_pool_connections=16)
+  with mock.patch.object(remote_gc, '_DELETE_BATCH_SIZE', 2):
+    with mock.patch.object(client, 'delete_objects', wraps=client.delete_objects) as delete:
+      assert collector.collect() == (5, 40)
+  assert delete.call_count == 3
+  assert _keys(bucket) == []
+
+
+def test_deletes_unreferenced_blobs(bucket):
+  with temporary_dir() as artifact_root:
+    cache = S3ArtifactCache(artifact_root, _URL, TempLocalArtifactCache(artifact_root, 0),
+                            content_addressed=True)
+    with temporary_file(artifact_root) as f:
+      f.write(b'fraggle')
+      f.close()
+      for hash in ('old', 'new'):
+        assert cache.insert(CacheKey('a', hash), [f.name])
+        time.sleep(0.01)
+  blobs = [key for key in _keys(bucket) if '/_blobs/' in key]
+  assert len(blobs) == 1
+
+  # The newest pointer still refers to the blob.
+  RemoteCacheCollector(_URL, keep_per_target=1, keep_within=60).collect(now=_AN_HOUR_FROM_NOW)
+  assert _keys(bucket) == sorted(blobs + ['path/a/new.tgz'])
+
+  RemoteCacheCollector(_URL, keep_per_target=0, keep_within=60).collect(now=_AN_HOUR_FROM_NOW)
+  # Unreferenced, but an insert may be about to reuse it without rewriting it.
+  assert _keys(bucket) == blobs
+
+  after_refresh = time.time() + s3cache.BLOB_REFRESH_SECONDS + 60
+  RemoteCacheCollector(_URL, keep_per_target=0, keep_within=60).collect(now=after_refresh)
+  assert _keys(bucket) == []
+
+
+def test_reused_blobs_are_rewritten(bucket):
+  with temporary_dir() as artifact_root:
+    cache = S3ArtifactCache(artifact_root, _URL, TempLocalArtifactCache(artifact_root, 0),
+                            content_addressed=True)
+    client = s3cache.get_s3_client()
+    with temporary_file(artifact_root) as f:
+      f.write(b'fraggle')
+      f.close()
+      assert cache.insert(CacheKey('a', 'hash'), [f.name])
+      with mock.patch.object(client, 'copy_object', wraps=client.copy_object) as copy_object:
+        # Recently written blobs are reused as they are.
+        assert cache.insert(CacheKey('b', 'hash'), [f.name])
+        assert not copy_object.called
+
+        with mock.patch.object(s3cache, 'BLOB_REFRESH_SECONDS', 0):
+          assert cache.insert(CacheKey('c', 'hash'), [f.name])
+  blob, = [key for key in _keys(bucket) if '/_blobs/' in key]
+  assert [kwargs['Key'] for _, kwargs in copy_object.call_args_list] == [blob]
+
+
+def test_keeps_blobs_rewritten_while_collecting(bucket):
+  with temporary_dir() as artifact_root:
+    cache = S3ArtifactCache(artifact_root, _URL, TempLocalArtifactCache(artifact_root, 0),
+                            content_addressed=True)
+    with temporary_file(artifact_root) as f:
+      f.write(b'fraggle')
+      f.close()
+      assert cache.insert(CacheKey('a', 'hash'), [f.name])
+  blob, = [key for key in _keys(bucket) if '/_blobs/' in key]
+  time.sleep(0.01)
+  listed = time.time()
+  time.sleep(0.01)
+
+  collector = RemoteCacheCollector(_URL, keep_per_target=0, keep_within=0)
+  list_objects = collector._list
+
+  def list_then_reuse(prefix):
+    objects = list_objects(prefix)
+    if prefix.endswith('/_blobs/'):
+      # An insert reusing the blob rewrites it after it is listed.
+      body = bucket.Object(blob).get()['Body'].read()
+      bucket.put_object(Key=blob, Body=body)
+    return objects
+
+  with mock.patch.object(collector, '_list', side_effect=list_then_reuse):
+    collector.collect(now=listed + s3cache.BLOB_REFRESH_SECONDS)
+  assert _keys(bucket) == [blob]
+
+
+def test_collects_sharded_layout(bucket):
+  for hash in ('old', 'new'):
+    _put(bucket, _sharded('a'), hash)
+  RemoteCacheCollector(_URL, keep_per_target=1, keep_within=60).collect(now=_AN_HOUR_FROM_NOW)
+  assert _keys(bucket) == ['path/{0}/new.tgz'.format(_sharded('a'))]
+
+
+def test_migrates_to_sharded_layout(bucket):
+  for hash in ('old', 'new'):
+    _put(bucket, 'a', hash, body=b'0123456789')
+  _put(bucket, 'b', 'only')
+  _put(bucket, _sharded('b'), 'only')
+  migrator = LayoutMigrator(_URL)
+
+  assert migrator.migrate(dry_run=True) == (2, 20)
+  assert len(_keys(bucket)) == 4
+
+  client = s3cache.get_s3_client(max_pool_connections=16)
+  with mock.patch.object(client, 'copy_object', wraps=client.copy_object) as copy_object:
+    assert migrator.migrate() == (2, 20)
+  # Copies are made oldest first, keeping the order garbage collection goes by.
+  assert [call[1]['Key'] for call in copy_object.call_args_list] == [
+    'path/{0}/{1}.tgz'.format(_sharded('a'), hash) for hash in ('old', 'new')]
+  assert migrator.migrate() == (0, 0)
+  migrated = ['path/{0}/{1}.tgz'.format(_sharded('a'), hash) for hash in ('new', 'old')]
+
+  migrator.migrate(delete_unsharded=True)
+  assert _keys(bucket) == sorted(migrated + ['path/{0}/only.tgz'.format(_sharded('b'))])
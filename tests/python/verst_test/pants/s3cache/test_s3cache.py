@@ -5,11 +5,19 @@
 from __future__ import (absolute_import, division, generators, nested_scopes,
                         print_function, unicode_literals, with_statement)
 
+import hashlib
+import io
 import os
+import subprocess
+import sys
+import time
 from contextlib import contextmanager
 
 import boto3
+import mock
 import pytest
+from botocore.vendored.requests import ConnectionError
+from concurrent.futures import ThreadPoolExecutor
 from moto import mock_s3
 from pants.cache.artifact_cache import UnreadableArtifact
 from pants.cache.local_artifact_cache import (LocalArtifactCache,
@@ -17,7 +25,11 @@ from pants.cache.local_artifact_cache import (LocalArtifactCache,
 from pants.invalidation.build_invalidator import CacheKey
 from pants.util.contextutil import temporary_dir, temporary_file
 from pants.util.dirutil import safe_mkdir
-from verst.pants.s3cache.s3cache import S3ArtifactCache
+from verst.pants.s3cache import hedging, metrics, s3cache
+from verst.pants.s3cache.s3cache import (MIN_MULTIPART_PART_SIZE_BYTES,
+                                         S3ArtifactCache)
+from verst.pants.s3cache import write_behind
+from verst.pants.s3cache.listings import heads, listings
 
 TEST_CONTENT1 = b'fraggle'
 TEST_CONTENT2 = b'gobo'
@@ -59,6 +71,8 @@ def s3_fixture():
     s3.create_bucket(Bucket=_TEST_BUCKET)
     yield s3
   finally:
+    listings.clear()
+    heads.clear()
     mock_s3().stop()
 
 
@@ -94,11 +108,65 @@ def other_machine_cache():
       yield S3ArtifactCache(artifact_root, 's3://' + _TEST_BUCKET, local_cache)
 
 
+@pytest.yield_fixture(scope="function")
+def ranged_download_cache():
+  with temporary_dir() as artifact_root:
+    with temporary_dir() as cache_root:
+      local_cache = LocalArtifactCache(
+        artifact_root, cache_root, compression=1)
+
+      yield S3ArtifactCache(artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                            download_part_size=1024, download_concurrency=3)
+
+
+@pytest.fixture(scope="function")
+def multipart_cache(local_artifact_root, local_cache):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                         multipart_threshold=MIN_MULTIPART_PART_SIZE_BYTES,
+                         multipart_part_size=MIN_MULTIPART_PART_SIZE_BYTES)
+
+
+@pytest.fixture(scope="function")
+def write_behind_cache(local_artifact_root):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), write_behind=True)
+
+
+@pytest.fixture(scope="function")
+def bulk_lookup_cache(local_artifact_root):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), bulk_lookup=True)
+
+
+@pytest.fixture(scope="function")
+def negative_cache_instance(local_artifact_root):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), negative_cache_ttl=60)
+
+
+@pytest.fixture(scope="function")
+def content_addressed_cache(local_artifact_root):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), content_addressed=True)
+
+
+@pytest.fixture(scope="function")
+def streaming_cache(local_artifact_root, local_cache):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                         stream_extract=True)
+
+
+@pytest.fixture(scope="function")
+def sharded_cache(local_artifact_root):
+  return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), sharded_keys=True)
+
+
 @contextmanager
-def setup_test_file(parent):
+def setup_test_file(parent, content=TEST_CONTENT1):
   with temporary_file(parent) as f:
     # Write the file.
-    f.write(TEST_CONTENT1)
+    f.write(content)
     path = f.name
     f.close()
     yield path
@@ -186,3 +254,514 @@ def test_delete_non_existant_key(s3_cache_instance):
 
 def test_use_cached_files_non_existant_key(s3_cache_instance):
   assert not s3_cache_instance.use_cached_files(CacheKey('foo', 'bar'))
+
+
+def test_ranged_download(
+    s3_cache_instance, ranged_download_cache, cache_key):
+  # Random bytes don't compress, so the artifact spans many download parts.
+  content = os.urandom(10 * 1024)
+  with setup_test_file(s3_cache_instance.artifact_root, content) as path:
+    s3_cache_instance.insert(cache_key, [path])
+    relpath = os.path.relpath(path, s3_cache_instance.artifact_root)
+
+  assert ranged_download_cache.use_cached_files(cache_key)
+
+  with open(os.path.join(ranged_download_cache.artifact_root, relpath), 'rb') as infile:
+    assert infile.read() == content
+
+
+def test_ranged_download_non_existant_key(ranged_download_cache):
+  assert not ranged_download_cache.use_cached_files(CacheKey('foo', 'bar'))
+
+
+def _check_round_trip(instance, other_machine_cache, cache_key, content):
+  with setup_test_file(instance.artifact_root, content) as path:
+    assert instance.insert(cache_key, [path])
+    relpath = os.path.relpath(path, instance.artifact_root)
+
+  assert other_machine_cache.use_cached_files(cache_key)
+  with open(os.path.join(other_machine_cache.artifact_root, relpath), 'rb') as infile:
+    assert infile.read() == content
+
+
+def test_small_artifact_uses_single_put(
+    multipart_cache, other_machine_cache, cache_key):
+  with mock.patch.object(multipart_cache, '_create_multipart_upload') as multipart_upload:
+    _check_round_trip(multipart_cache, other_machine_cache, cache_key, TEST_CONTENT1)
+    assert not multipart_upload.called
+
+
+def test_multipart_upload(
+    s3_fixture, multipart_cache, other_machine_cache, cache_key):
+  # Random bytes don't compress, so this is spread over three parts.
+  content = os.urandom(2 * MIN_MULTIPART_PART_SIZE_BYTES + 1024)
+  client = s3cache.get_s3_client()
+  with mock.patch.object(client, 'copy_object', wraps=client.copy_object) as copy_object:
+    _check_round_trip(multipart_cache, other_machine_cache, cache_key, content)
+
+  object = s3_fixture.Object(_TEST_BUCKET, multipart_cache._path_for_key(cache_key))
+  assert object.e_tag.strip('"').endswith('-3')
+  # The tarball's digest is recorded when the upload is created, like a single PUT's, rather than
+  # by copying the object once it is complete.
+  assert not copy_object.called
+  body = object.get()['Body'].read()
+  assert object.metadata == {'codec': 'gzip', 'sha256': hashlib.sha256(body).hexdigest()}
+
+
+def test_multipart_upload_retries_failed_part(
+    multipart_cache, other_machine_cache, cache_key):
+  upload_part = s3cache.get_s3_client().upload_part
+  failures = [ConnectionError('flaky')]
+
+  def flaky_upload_part(**kwargs):
+    if kwargs['PartNumber'] == 2 and failures:
+      raise failures.pop()
+    return upload_part(**kwargs)
+
+  content = os.urandom(2 * MIN_MULTIPART_PART_SIZE_BYTES + 1024)
+  with mock.patch.object(s3cache.get_s3_client(), 'upload_part', side_effect=flaky_upload_part):
+    _check_round_trip(multipart_cache, other_machine_cache, cache_key, content)
+  assert not failures
+
+
+def test_multipart_upload_gives_up_after_retries(s3_fixture, multipart_cache, cache_key):
+  content = os.urandom(MIN_MULTIPART_PART_SIZE_BYTES + 1024)
+  with mock.patch.object(s3cache.get_s3_client(), 'upload_part',
+                         side_effect=ConnectionError('down')) as upload_part:
+    with setup_test_file(multipart_cache.artifact_root, content) as path:
+      assert not multipart_cache.insert(cache_key, [path])
+  # Each part that is tried is retried twice. Parts that haven't started when one gives up are
+  # cancelled.
+  attempts = {}
+  for _, kwargs in upload_part.call_args_list:
+    attempts[kwargs['PartNumber']] = attempts.get(kwargs['PartNumber'], 0) + 1
+  assert attempts and set(attempts.values()) == {3}
+  assert not list(s3_fixture.Bucket(_TEST_BUCKET).objects.all())
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+def test_parallel_compression(
+    s3_fixture, local_artifact_root, tmp_and_local_cache, other_machine_cache, cache_key, codec):
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, tmp_and_local_cache,
+                             multipart_threshold=MIN_MULTIPART_PART_SIZE_BYTES,
+                             multipart_part_size=MIN_MULTIPART_PART_SIZE_BYTES,
+                             codec=codec, compression_threads=4)
+  small = CacheKey('small', 'hash')
+  _check_round_trip(instance, other_machine_cache, small, TEST_CONTENT1)
+  client = s3cache.get_s3_client()
+  with mock.patch.object(instance._localcache, 'insert_paths') as insert_paths:
+    with mock.patch.object(client, 'copy_object', wraps=client.copy_object) as copy_object:
+      _check_round_trip(instance, other_machine_cache, cache_key,
+                        os.urandom(2 * MIN_MULTIPART_PART_SIZE_BYTES + 1024))
+  # Nothing was tarred up on disk before uploading.
+  assert not insert_paths.called
+  object = s3_fixture.Object(_TEST_BUCKET, instance._path_for_key(cache_key))
+  assert object.e_tag.strip('"').endswith('-3')
+  # The digest of streamed bytes is only known once they are all uploaded.
+  assert copy_object.call_count == 1
+  assert object.metadata['sha256'] == hashlib.sha256(object.get()['Body'].read()).hexdigest()
+
+  # A persistent local cache kept a copy it can read.
+  if not isinstance(tmp_and_local_cache, TempLocalArtifactCache):
+    for key in (small, cache_key):
+      assert tmp_and_local_cache.use_cached_files(key)
+
+
+def test_parallel_compression_aborts_failed_upload(
+    s3_fixture, local_artifact_root, local_cache, cache_key):
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                             multipart_threshold=MIN_MULTIPART_PART_SIZE_BYTES,
+                             multipart_part_size=MIN_MULTIPART_PART_SIZE_BYTES,
+                             upload_retries=0, compression_threads=4)
+  content = os.urandom(3 * MIN_MULTIPART_PART_SIZE_BYTES)
+  with mock.patch.object(s3cache.get_s3_client(), 'upload_part',
+                         side_effect=ConnectionError('down')):
+    with setup_test_file(instance.artifact_root, content) as path:
+      assert not instance.insert(cache_key, [path])
+  assert not list(s3_fixture.Bucket(_TEST_BUCKET).objects.all())
+  assert not list(s3_fixture.Bucket(_TEST_BUCKET).multipart_uploads.all())
+  assert not local_cache.has(cache_key)
+
+
+def test_write_behind_insert(write_behind_cache, other_machine_cache, cache_key):
+  with setup_test_file(write_behind_cache.artifact_root) as path:
+    assert write_behind_cache.insert(cache_key, [path])
+
+  assert not write_behind.flush()
+  assert other_machine_cache.has(cache_key)
+  # The spooled copy is removed once it has been uploaded.
+  spool_dir = os.path.join(write_behind_cache.artifact_root, 's3cache', 'write-behind')
+  assert not os.listdir(spool_dir)
+
+
+def test_write_behind_removes_stale_spool_files(write_behind_cache, cache_key):
+  spool_dir = os.path.join(write_behind_cache.artifact_root, 's3cache', 'write-behind')
+  safe_mkdir(spool_dir)
+  stale, recent = os.path.join(spool_dir, 'stale.tgz'), os.path.join(spool_dir, 'recent.tgz')
+  for path in (stale, recent):
+    with open(path, 'wb') as outfile:
+      outfile.write(TEST_CONTENT1)
+  crashed = time.time() - write_behind.STALE_SPOOL_SECONDS - 60
+  os.utime(stale, (crashed, crashed))
+
+  with setup_test_file(write_behind_cache.artifact_root) as path:
+    assert write_behind_cache.insert(cache_key, [path])
+  assert not write_behind.flush()
+  # A recent file may still be on its way up from another process.
+  assert os.listdir(spool_dir) == ['recent.tgz']
+
+
+def test_write_behind_failures_reported_on_flush(write_behind_cache, cache_key):
+  with mock.patch.object(write_behind_cache, '_upload', side_effect=ConnectionError('down')):
+    with setup_test_file(write_behind_cache.artifact_root) as path:
+      # The insert itself succeeds, the failure shows up when flushing.
+      assert write_behind_cache.insert(cache_key, [path])
+    failures = write_behind.flush()
+
+  assert [description for description, _ in failures] == [cache_key]
+  assert not write_behind_cache.has(cache_key)
+
+
+def test_bulk_lookup(bulk_lookup_cache, other_machine_cache, artifact_path):
+  present = [CacheKey('target_a', 'hash1'), CacheKey('target_b', 'hash1')]
+  absent = [CacheKey('target_a', 'hash2'), CacheKey('target_c', 'hash1')]
+  for cache_key in present:
+    other_machine_cache.insert(cache_key, [artifact_path])
+
+  results = bulk_lookup_cache.has_all(present + absent)
+  assert results == {cache_key: cache_key in present for cache_key in present + absent}
+
+  # Every prefix is listed now, so nothing needs another LIST or HEAD.
+  with mock.patch.object(s3cache.get_s3_client(), 'list_objects_v2') as list_objects:
+    for cache_key in present:
+      assert bulk_lookup_cache.has(cache_key)
+    for cache_key in absent:
+      assert not bulk_lookup_cache.has(cache_key)
+      assert not bulk_lookup_cache.use_cached_files(cache_key)
+    assert not list_objects.called
+
+
+def test_bulk_lookup_sees_own_writes(bulk_lookup_cache, cache_key, artifact_path):
+  assert not bulk_lookup_cache.has(cache_key)
+  bulk_lookup_cache.insert(cache_key, [artifact_path])
+  assert bulk_lookup_cache.has(cache_key)
+  bulk_lookup_cache.delete(cache_key)
+  assert not bulk_lookup_cache.has(cache_key)
+
+
+def test_negative_cache(
+    local_artifact_root, negative_cache_instance, other_machine_cache, cache_key, artifact_path):
+  assert not negative_cache_instance.has(cache_key)
+  other_machine_cache.insert(cache_key, [artifact_path])
+
+  # A later run on this machine trusts the recorded miss rather than asking S3.
+  later_run = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                              TempLocalArtifactCache(local_artifact_root, 0),
+                              negative_cache_ttl=60)
+  assert not later_run.has(cache_key)
+  assert not later_run.use_cached_files(cache_key)
+
+  # Inserting the key forgets the miss.
+  later_run.insert(cache_key, [artifact_path], overwrite=True)
+  assert negative_cache_instance.has(cache_key)
+
+
+def test_circuit_breaker_skips_unreachable_s3(s3_cache_instance, cache_key):
+  with mock.patch.object(s3cache.get_s3_client(), 'head_object',
+                         side_effect=ConnectionError('down')) as head_object:
+    for _ in range(5):
+      assert not s3_cache_instance.has(cache_key)
+  # The first three failures open the circuit, and the rest never reach S3.
+  assert head_object.call_count == 3
+  assert not s3_cache_instance.use_cached_files(cache_key)
+
+
+def test_registering_plugin_does_not_import_boto():
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.check_output([
+    sys.executable, '-c',
+    'import sys, verst.pants.s3cache.register; print("boto3" in sys.modules)'
+  ], env=env)
+  assert output.strip() == b'False'
+
+
+def test_content_addressed_insert_dedupes_blobs(
+    s3_fixture, content_addressed_cache, other_machine_cache, ranged_download_cache,
+    artifact_path):
+  first_key = CacheKey('some_target', 'first_hash')
+  second_key = CacheKey('other_target', 'second_hash')
+  assert content_addressed_cache.insert(first_key, [artifact_path])
+  with mock.patch.object(content_addressed_cache, '_put_file') as put_file:
+    assert content_addressed_cache.insert(second_key, [artifact_path])
+    assert not put_file.called
+
+  keys = sorted(o.key for o in s3_fixture.Bucket(_TEST_BUCKET).objects.all())
+  blobs = [key for key in keys if '/_blobs/sha256/' in key]
+  assert len(blobs) == 1
+  assert (sorted(set(keys) - set(blobs)) ==
+          sorted([content_addressed_cache._path_for_key(first_key),
+                  content_addressed_cache._path_for_key(second_key)]))
+
+  # Pointers are followed by caches that don't write them, ranged downloads included.
+  relpath = os.path.relpath(artifact_path, content_addressed_cache.artifact_root)
+  for instance in (other_machine_cache, ranged_download_cache):
+    assert instance.has(second_key)
+    assert instance.use_cached_files(second_key)
+    with open(os.path.join(instance.artifact_root, relpath), 'rb') as infile:
+      assert infile.read() == TEST_CONTENT1
+
+
+def test_content_addressed_blobs_named_by_codec(
+    s3_fixture, local_artifact_root, other_machine_cache, artifact_path):
+  zstd_cache = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                               TempLocalArtifactCache(local_artifact_root, 0),
+                               content_addressed=True, codec='zstd')
+  cache_key = CacheKey('some_target', 'some_hash')
+  assert zstd_cache.insert(cache_key, [artifact_path])
+  keys = [o.key for o in s3_fixture.Bucket(_TEST_BUCKET).objects.all()]
+  blob, = [key for key in keys if '/_blobs/sha256/' in key]
+  assert blob.endswith('.tar.zst')
+  assert other_machine_cache.use_cached_files(cache_key)
+
+
+def test_content_addressed_reads_digest_only_pointers(
+    s3_fixture, content_addressed_cache, other_machine_cache, artifact_path):
+  cache_key = CacheKey('some_target', 'some_hash')
+  assert content_addressed_cache.insert(cache_key, [artifact_path])
+  pointer = s3_fixture.Object(_TEST_BUCKET, content_addressed_cache._path_for_key(cache_key))
+  body = pointer.get()['Body'].read()
+  assert body.endswith(b'.tgz')
+  # As written before blobs were named by their codec.
+  pointer.put(Body=body[:-len(b'.tgz')])
+  assert other_machine_cache.use_cached_files(cache_key)
+
+
+def test_stream_extract(
+    streaming_cache, other_machine_cache, cache_key, local_cache):
+  _check_round_trip(other_machine_cache, streaming_cache, cache_key, os.urandom(10 * 1024))
+  # The download was teed into the local cache.
+  assert local_cache.has(cache_key)
+  assert local_cache.use_cached_files(cache_key)
+
+
+def test_stream_extract_corrupted_artifact(
+    s3_fixture, streaming_cache, other_machine_cache, cache_key, local_cache):
+  results_dir = os.path.join(streaming_cache.artifact_root, 'a/sub/dir')
+  with setup_test_file(other_machine_cache.artifact_root) as path:
+    other_machine_cache.insert(cache_key, [path])
+  object = s3_fixture.Object(_TEST_BUCKET, streaming_cache._path_for_key(cache_key))
+  object.put(Body=object.get()['Body'].read()[:-4])
+
+  result = streaming_cache.use_cached_files(cache_key, results_dir=results_dir)
+  assert isinstance(result, UnreadableArtifact)
+  assert os.listdir(results_dir) == []
+  assert not local_cache.has(cache_key)
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4'])
+def test_codec(s3_fixture, local_artifact_root, local_cache, other_machine_cache, cache_key, codec):
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                             TempLocalArtifactCache(local_artifact_root, 0), codec=codec)
+  content = os.urandom(10 * 1024)
+  # A gzip cache reads it.
+  _check_round_trip(instance, other_machine_cache, cache_key, content)
+  object = s3_fixture.Object(_TEST_BUCKET, instance._path_for_key(cache_key))
+  assert object.metadata['codec'] == codec
+
+  # So does a streaming one, leaving a tarball the local cache can read.
+  streaming = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                              stream_extract=True)
+  assert streaming.use_cached_files(cache_key)
+  assert local_cache.use_cached_files(cache_key)
+
+  # And it reads gzip artifacts.
+  _check_round_trip(other_machine_cache, instance, CacheKey('gzipped', 'hash'), content)
+
+
+def _corrupted(get_result):
+  body = bytearray(get_result['Body'].read())
+  body[len(body) // 2] ^= 0xff
+  return dict(get_result, Body=io.BytesIO(bytes(body)))
+
+
+@pytest.mark.parametrize('stream_extract', [False, True], ids=['store', 'stream'])
+def test_corrupted_transfer_is_retried(
+    local_artifact_root, local_cache, other_machine_cache, cache_key, stream_extract):
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET, local_cache,
+                             stream_extract=stream_extract)
+  with setup_test_file(other_machine_cache.artifact_root) as path:
+    other_machine_cache.insert(cache_key, [path])
+
+  client = s3cache.get_s3_client()
+  get_object = client.get_object
+  responses = [lambda **kwargs: _corrupted(get_object(**kwargs)), get_object]
+  with mock.patch.object(client, 'get_object',
+                         side_effect=lambda **kwargs: responses.pop(0)(**kwargs)):
+    assert instance.use_cached_files(cache_key) is True
+  assert not responses
+  assert local_cache.has(cache_key)
+
+
+def test_corrupted_object_is_unreadable(
+    s3_fixture, s3_cache_instance, other_machine_cache, cache_key, local_cache):
+  with setup_test_file(other_machine_cache.artifact_root) as path:
+    other_machine_cache.insert(cache_key, [path])
+  object = s3_fixture.Object(_TEST_BUCKET, s3_cache_instance._path_for_key(cache_key))
+  body = object.get()['Body'].read()
+  assert object.metadata['sha256'] == hashlib.sha256(body).hexdigest()
+  object.put(Body=body + b'\0', Metadata=object.metadata)
+
+  result = s3_cache_instance.use_cached_files(cache_key)
+  assert isinstance(result, UnreadableArtifact)
+  assert isinstance(result.err, s3cache.DigestMismatchError)
+  assert not local_cache.has(cache_key)
+
+
+def test_hedged_get(s3_cache_instance, cache_key):
+  hedging.latencies.clear()
+  instance = S3ArtifactCache(s3_cache_instance.artifact_root, 's3://' + _TEST_BUCKET,
+                             TempLocalArtifactCache(s3_cache_instance.artifact_root, 0),
+                             hedge_percentile=50)
+  with setup_test_file(instance.artifact_root) as path:
+    assert instance.insert(cache_key, [path])
+    for _ in range(20):
+      assert instance.use_cached_files(cache_key)
+
+    client = s3cache.get_s3_client()
+    get_object = client.get_object
+    calls = []
+
+    def slow_first_get(**kwargs):
+      calls.append(kwargs)
+      if len(calls) == 1:
+        time.sleep(1)
+      return get_object(**kwargs)
+
+    before = hedging.hedge_stats()
+    with mock.patch.object(client, 'get_object', side_effect=slow_first_get):
+      assert instance.use_cached_files(cache_key)
+    assert len(calls) == 2
+    assert hedging.hedge_stats()['won'] == before['won'] + 1
+  hedging.latencies.clear()
+
+
+def test_sharded_keys(s3_fixture, sharded_cache, other_machine_cache, cache_key, artifact_path):
+  sharded_cache.insert(cache_key, [artifact_path])
+  keys = [o.key for o in s3_fixture.Bucket(_TEST_BUCKET).objects.all()]
+  assert keys == ['/{0}/{1}/{2}.tgz'.format(s3cache.shard_dir(cache_key.id), cache_key.id,
+                                            cache_key.hash)]
+  assert sharded_cache.has(cache_key)
+  assert not other_machine_cache.has(cache_key)
+
+
+def test_sharded_keys_fall_back_to_unsharded(
+    local_artifact_root, sharded_cache, other_machine_cache, cache_key, artifact_path):
+  other_machine_cache.insert(cache_key, [artifact_path])
+  assert sharded_cache.has(cache_key)
+  assert sharded_cache.use_cached_files(cache_key)
+  bulk = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                         TempLocalArtifactCache(local_artifact_root, 0), sharded_keys=True,
+                         bulk_lookup=True)
+  assert bulk.has_all([cache_key]) == {cache_key: True}
+
+  migrated = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                             TempLocalArtifactCache(local_artifact_root, 0), sharded_keys=True,
+                             legacy_key_fallback=False)
+  assert not migrated.has(cache_key)
+  assert not migrated.use_cached_files(cache_key)
+
+
+def test_lookups_memoized(s3_cache_instance, other_machine_cache, cache_key, artifact_path):
+  client = s3cache.get_s3_client()
+  with mock.patch.object(client, 'head_object', wraps=client.head_object) as head_object:
+    with mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+      # A miss isn't asked about again, by a HEAD or a GET.
+      assert not s3_cache_instance.has(cache_key)
+      assert not s3_cache_instance.has(cache_key)
+      assert not s3_cache_instance.use_cached_files(cache_key)
+      assert head_object.call_count == 1
+      assert not get_object.called
+
+      # Writing the key forgets the miss.
+      other_machine_cache.insert(cache_key, [artifact_path])
+      assert s3_cache_instance.has(cache_key)
+      assert s3_cache_instance.has(cache_key)
+      assert head_object.call_count == 2
+
+
+def test_seed_key(local_artifact_root, s3_cache_instance, artifact_path):
+  def task_cache(task_name):
+    return S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                           TempLocalArtifactCache(local_artifact_root, 0),
+                           seed_incremental=True, task_name=task_name)
+
+  seeding_cache = task_cache('compile.zinc')
+  other_task_cache = task_cache('bundle.jvm')
+  cache_key = CacheKey('some_target', 'current')
+  assert seeding_cache.seed_key(cache_key) is None
+
+  for cache, inserted in ((seeding_cache, CacheKey('some_target', 'older')),
+                          (seeding_cache, CacheKey('some_target', 'newer')),
+                          (seeding_cache, CacheKey('some_target_too', 'newest')),
+                          (other_task_cache, CacheKey('some_target', 'other_task')),
+                          (seeding_cache, cache_key)):
+    cache.insert(inserted, [artifact_path])
+    time.sleep(0.01)
+  # The newest artifact of the same target other than cache_key's own, cached by the same task.
+  assert seeding_cache.seed_key(cache_key) == CacheKey('some_target', 'newer')
+  assert other_task_cache.seed_key(cache_key) == CacheKey('some_target', 'other_task')
+  assert s3_cache_instance.seed_key(cache_key) is None
+
+
+def test_operation_metrics(local_artifact_root, s3_fixture, cache_key, artifact_path):
+  metrics_dir = os.path.join(local_artifact_root, 'metrics')
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                             TempLocalArtifactCache(local_artifact_root, 0),
+                             circuit_breaker_threshold=0, metrics_dir=metrics_dir)
+  missing = CacheKey('some_other_key', 'missing')
+
+  assert instance.insert(cache_key, [artifact_path])
+  size = s3_fixture.Object(_TEST_BUCKET, instance._path_for_key(cache_key)).content_length
+  assert instance.has(cache_key)
+  assert instance.use_cached_files(cache_key)
+  assert not instance.use_cached_files(missing)
+  with mock.patch.object(s3cache.get_s3_client(), 'head_object',
+                         side_effect=ConnectionError('down')):
+    assert not instance.has(CacheKey('some_other_key', 'unreachable'))
+  instance.delete(cache_key)
+
+  summary = metrics.collect(metrics_dir).summary()
+  # The insert checked for the artifact first.
+  assert summary['has']['count'] == 3
+  assert (summary['has']['hit'], summary['has']['miss'], summary['has']['network']) == (1, 1, 1)
+  assert summary['has']['hit_rate'] == pytest.approx(1 / 3)
+  assert (summary['PUT']['count'], summary['PUT']['hit'], summary['PUT']['bytes']) == (1, 1, size)
+  assert (summary['GET']['hit'], summary['GET']['miss'], summary['GET']['bytes']) == (1, 1, size)
+  assert (summary['DELETE']['count'], summary['DELETE']['hit']) == (1, 1)
+  latency = summary['GET']['latency_ms']
+  assert 0 < latency['p50'] <= latency['p99'] <= latency['max']
+
+
+def test_concurrent_use_from_many_threads(local_artifact_root):
+  # A small pool makes the threads contend for connections.
+  instance = S3ArtifactCache(local_artifact_root, 's3://' + _TEST_BUCKET,
+                             TempLocalArtifactCache(local_artifact_root, 0),
+                             max_pool_connections=4)
+
+  def round_trip(worker):
+    for iteration in range(5):
+      cache_key = CacheKey('target_{0}'.format(worker), 'hash_{0}'.format(iteration))
+      content = os.urandom(1024)
+      with setup_test_file(local_artifact_root, content) as path:
+        assert instance.insert(cache_key, [path])
+      assert instance.has(cache_key)
+      assert instance.use_cached_files(cache_key)
+      with open(path, 'rb') as infile:
+        assert infile.read() == content
+      os.unlink(path)
+      instance.delete(cache_key)
+      assert not instance.has(cache_key)
+
+  with ThreadPoolExecutor(max_workers=16) as pool:
+    for result in [pool.submit(round_trip, worker) for worker in range(32)]:
+      result.result()
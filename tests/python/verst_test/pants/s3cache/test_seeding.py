@@ -0,0 +1,114 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+
+import boto3
+from moto import mock_s3
+from pants.backend.python.targets.python_library import PythonLibrary
+from pants.cache.cache_setup import CacheSetup
+from pants.cache.local_artifact_cache import TempLocalArtifactCache
+from pants.invalidation.build_invalidator import CacheKey
+from pants.task.task import Task
+from pants.util.dirutil import safe_file_dump, safe_rmtree
+from pants_test.tasks.task_test_base import TaskTestBase
+from verst.pants.s3cache.cache_setup import patch
+from verst.pants.s3cache.listings import heads, listings
+from verst.pants.s3cache.s3cache import S3ArtifactCache
+
+_TEST_BUCKET = 'verst-test-bucket'
+
+
+class IncrementalTask(Task):
+  incremental = True
+  cache_incremental = True
+  cache_target_dirs = True
+
+  def execute(self):
+    self.built = []
+    self.cacheable = []
+    self.outputs = []
+    with self.invalidated(self.context.targets()) as invalidation_check:
+      for vt in invalidation_check.invalid_vts:
+        self.built.append((vt.target, vt.is_incremental, os.listdir(vt.results_dir)))
+        output = os.path.join(vt.results_dir, 'output')
+        if os.path.exists(output):
+          with open(output) as f:
+            self.outputs.append(f.read())
+        self.cacheable.append(bool(self._should_cache_target_dir(vt)))
+
+
+class SeedingTest(TaskTestBase):
+
+  @classmethod
+  def task_type(cls):
+    return IncrementalTask
+
+  def setUp(self):
+    super(SeedingTest, self).setUp()
+    patch()
+    self._mock_s3 = mock_s3()
+    self._mock_s3.start()
+    boto3.resource('s3').create_bucket(Bucket=_TEST_BUCKET)
+
+  def tearDown(self):
+    listings.clear()
+    heads.clear()
+    self._mock_s3.stop()
+    super(SeedingTest, self).tearDown()
+
+  def _create_task(self, seed_incremental):
+    self.create_file('src/a.py')
+    target = self.make_target('src:a', PythonLibrary, sources=['a.py'])
+    self.set_options_for_scope(CacheSetup.subscope(self.options_scope),
+                               read_from=['s3://{0}/path'.format(_TEST_BUCKET)],
+                               write_to=['s3://{0}/path'.format(_TEST_BUCKET)],
+                               s3_seed_incremental=seed_incremental)
+    task = self.create_task(self.context(target_roots=[target]))
+
+    # An earlier version of the target was built and cached elsewhere.
+    self._insert(task, task._cache_factory.get_read_cache(), target, 'earlier')
+    return task, target
+
+  def _insert(self, task, cache, target, key_hash):
+    vt, = task.create_cache_manager(False).check([target]).invalid_vts
+    cache_key = CacheKey(vt.cache_key.id, key_hash)
+    results_dir = vt._results_dir_path(task.workdir, cache_key, stable=False)
+    safe_file_dump(os.path.join(results_dir, 'output'), '{0} output'.format(key_hash))
+    assert cache.insert(cache_key, [results_dir])
+    safe_rmtree(results_dir)
+
+  def test_miss_built_incrementally_from_earlier_artifact(self):
+    task, target = self._create_task(seed_incremental=True)
+    task.execute()
+    # Still built, rather than used as a hit, but starting from the earlier results.
+    assert task.built == [(target, True, ['output'])]
+    assert task.outputs == ['earlier output']
+
+  def test_not_seeded_from_other_tasks_artifacts(self):
+    task, target = self._create_task(seed_incremental=True)
+    # Another task caches its results for the same target under the same prefix, more recently.
+    other_task_cache = S3ArtifactCache(self.pants_workdir, 's3://{0}/path'.format(_TEST_BUCKET),
+                                       TempLocalArtifactCache(self.pants_workdir, 0),
+                                       task_name='other.task')
+    self._insert(task, other_task_cache, target, 'other_task')
+    task.execute()
+    assert task.outputs == ['earlier output']
+
+  def test_seeded_build_is_cached(self):
+    task, target = self._create_task(seed_incremental=True)
+    task.execute()
+    assert task.cacheable == [True]
+
+  def test_not_seeded_unless_task_caches_incremental_builds(self):
+    task, target = self._create_task(seed_incremental=True)
+    task.cache_incremental = False
+    task.execute()
+    assert task.built == [(target, False, [])]
+
+  def test_seeding_is_opt_in(self):
+    task, target = self._create_task(seed_incremental=False)
+    task.execute()
+    assert task.built == [(target, False, [])]
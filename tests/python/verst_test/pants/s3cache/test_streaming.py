@@ -0,0 +1,57 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import io
+import os
+import tarfile
+
+import pytest
+from pants.cache.artifact import ArtifactError
+from pants.util.contextutil import temporary_dir
+from verst.pants.s3cache.streaming import extract_stream
+
+
+def _tarball(files):
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode='w:gz') as tarout:
+    for name, content in sorted(files.items()):
+      info = tarfile.TarInfo(name)
+      info.size = len(content)
+      tarout.addfile(info, io.BytesIO(content))
+  return buf.getvalue()
+
+
+def _chunks(data, size=100):
+  return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.yield_fixture(scope="function")
+def artifact_root():
+  with temporary_dir() as root:
+    yield root
+
+
+def test_extracts_and_tees(artifact_root):
+  files = {'a/b/one.class': os.urandom(5000), 'two.txt': b'two'}
+  data = _tarball(files)
+  tee = io.BytesIO()
+  extract_stream(artifact_root, _chunks(data), tee=tee)
+
+  assert tee.getvalue() == data
+  for name, content in files.items():
+    with open(os.path.join(artifact_root, name), 'rb') as infile:
+      assert infile.read() == content
+
+
+@pytest.mark.parametrize('corrupt', [
+  lambda data: data[:len(data) // 2],
+  lambda data: data[:-4],
+  lambda data: data[:-8] + b'\0' * 8,
+  lambda data: b'not a valid tgz any more',
+], ids=['truncated-content', 'truncated-trailer', 'bad-crc', 'garbage'])
+def test_detects_corruption(artifact_root, corrupt):
+  data = _tarball({'one.class': os.urandom(5000)})
+  with pytest.raises(ArtifactError):
+    extract_stream(artifact_root, _chunks(corrupt(data)))
@@ -0,0 +1,92 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import threading
+
+import mock
+import pytest
+from botocore.vendored.requests.adapters import HTTPAdapter
+from verst.pants.s3cache import timeouts
+from verst.pants.s3cache.s3cache import get_s3_client
+from verst.pants.s3cache.timeouts import TimeoutPolicy
+
+
+@pytest.yield_fixture(autouse=True)
+def clear_measurements():
+  timeouts.latencies.clear()
+  timeouts.throughput.clear()
+  yield
+  timeouts.latencies.clear()
+  timeouts.throughput.clear()
+
+
+def _record_latencies(seconds):
+  for _ in range(50):
+    timeouts.record(seconds)
+
+
+def test_defaults_are_fixed():
+  _record_latencies(0.01)
+  timeouts.record(1, size=1024 * 1024)
+  assert TimeoutPolicy().timeouts() == (4, 4)
+  assert TimeoutPolicy().timeouts(size=1024 * 1024 * 1024) == (4, 4)
+
+
+def test_ceilings_until_measured():
+  policy = TimeoutPolicy(0.5, 4, 2, 120)
+  assert policy.timeouts() == (4, 120)
+
+
+def test_adapts_to_latency():
+  policy = TimeoutPolicy(0.5, 4, 2, 120)
+  _record_latencies(0.01)
+  assert policy.timeouts() == (0.5, 2)
+
+  _record_latencies(0.3)
+  # 4 times 0.3s, rounded up to a power of two.
+  assert policy.timeouts() == (2, 2)
+
+
+def test_adapts_to_size_and_throughput():
+  policy = TimeoutPolicy(0.5, 4, 2, 120)
+  _record_latencies(0.01)
+  # Until throughput is measured, transfers get the ceiling.
+  assert policy.timeouts(size=10 * 1024 * 1024)[1] == 120
+
+  timeouts.record(1, size=1024 * 1024)
+  # 10MB at 1MB/s: 4 times 10s, rounded up to a power of two.
+  assert policy.timeouts(size=10 * 1024 * 1024)[1] == 64
+  assert policy.timeouts(size=100 * 1024 * 1024)[1] == 120
+  assert policy.timeouts(size=1024)[1] == 2
+
+
+def test_timeouts_share_a_client():
+  assert get_s3_client(8, 0.5, 64) is get_s3_client(8, 1, 2)
+  assert get_s3_client(8, 0.5, 64) is not get_s3_client(16, 0.5, 64)
+
+
+def test_requests_are_sent_with_the_threads_timeouts():
+  client = get_s3_client(8, 0.5, 64)
+  sent = []
+
+  def send(adapter, request, **kwargs):
+    sent.append(kwargs['timeout'])
+    raise _Sent()
+
+  with mock.patch.object(HTTPAdapter, 'send', autospec=True, side_effect=send):
+    with pytest.raises(_Sent):
+      client.head_bucket(Bucket='verst-test-bucket')
+    thread = threading.Thread(target=lambda: get_s3_client(8, 1, 2))
+    thread.start()
+    thread.join()
+    with pytest.raises(_Sent):
+      client.head_bucket(Bucket='verst-test-bucket')
+    with pytest.raises(_Sent):
+      get_s3_client(8, 4, 8).head_bucket(Bucket='verst-test-bucket')
+  assert sent == [(0.5, 64), (0.5, 64), (4, 8)]
+
+
+class _Sent(Exception):
+  pass
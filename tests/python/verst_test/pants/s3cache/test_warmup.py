@@ -0,0 +1,107 @@
+# coding=utf-8
+
+from __future__ import (absolute_import, division, generators, nested_scopes,
+                        print_function, unicode_literals, with_statement)
+
+import os
+
+import boto3
+from moto import mock_s3
+from pants.backend.python.targets.python_library import PythonLibrary
+from pants.base.fingerprint_strategy import TaskIdentityFingerprintStrategy
+from pants.cache.cache_setup import CacheSetup
+from pants.goal.goal import Goal
+from pants.goal.task_registrar import TaskRegistrar
+from pants.task.task import Task
+from pants.util.contextutil import temporary_file
+from pants_test.tasks.task_test_base import TaskTestBase
+from verst.pants.s3cache.cache_setup import patch
+from verst.pants.s3cache.listings import listings
+from verst.pants.s3cache.warmup import DEFAULT_TASKS, S3CacheWarmup
+
+_TEST_BUCKET = 'verst-test-bucket'
+
+
+class DummyCachingTask(Task):
+  def execute(self):
+    pass
+
+
+class S3CacheWarmupTest(TaskTestBase):
+
+  @classmethod
+  def task_type(cls):
+    return S3CacheWarmup
+
+  def setUp(self):
+    super(S3CacheWarmupTest, self).setUp()
+    patch()
+    self._mock_s3 = mock_s3()
+    self._mock_s3.start()
+    boto3.resource('s3').create_bucket(Bucket=_TEST_BUCKET)
+    TaskRegistrar(name='cached', action=DummyCachingTask).install('warmup-test')
+    self.caching_task_type = Goal.by_name('warmup-test').task_type_by_name('cached')
+
+  def tearDown(self):
+    Goal.clear()
+    listings.clear()
+    self._mock_s3.stop()
+    super(S3CacheWarmupTest, self).tearDown()
+
+  def test_fetches_artifacts_of_invalid_targets(self):
+    self.create_file('src/a.py')
+    self.create_file('src/b.py')
+    b = self.make_target('src:b', PythonLibrary, sources=['b.py'])
+    a = self.make_target('src:a', PythonLibrary, sources=['a.py'], dependencies=[b])
+    self.set_options(tasks=['warmup-test.cached'])
+    self.set_options_for_scope(CacheSetup.subscope('warmup-test.cached'),
+                               read_from=[os.path.join(self.build_root, 'local-cache'),
+                                          's3://{0}/path'.format(_TEST_BUCKET)])
+    context = self.context(target_roots=[a], for_task_types=[self.caching_task_type])
+    warmup = self.create_task(context)
+    caching_task = warmup._create_task('warmup-test.cached')
+    cache_keys = warmup._invalid_cache_keys(caching_task)
+    assert sorted(key.id for key in cache_keys) == ['src.a', 'src.b']
+
+    # Only a's artifact is in S3.
+    read_cache = caching_task._cache_factory.get_read_cache()
+    with temporary_file(self.pants_workdir) as f:
+      f.write(b'fraggle')
+      f.close()
+      a_key = [key for key in cache_keys if key.id == 'src.a'][0]
+      read_cache.try_insert(a_key, [f.name])
+    for key in cache_keys:
+      read_cache._localcache.delete(key)
+
+    warmup.execute()
+    assert read_cache._localcache.has(a_key)
+    assert not any(read_cache._localcache.has(key) for key in cache_keys if key != a_key)
+
+  def test_fetches_bundle_artifacts_by_default(self):
+    task_types = []
+    for scope in DEFAULT_TASKS:
+      goal_name, _, task_name = scope.partition('.')
+      TaskRegistrar(name=task_name, action=DummyCachingTask).install(goal_name)
+      task_types.append(Goal.by_name(goal_name).task_type_by_name(task_name))
+      self.set_options_for_scope(CacheSetup.subscope(scope),
+                                 read_from=[os.path.join(self.build_root, 'local-cache'),
+                                            's3://{0}/path'.format(_TEST_BUCKET)])
+    self.create_file('src/a.py')
+    a = self.make_target('src:a', PythonLibrary, sources=['a.py'])
+    context = self.context(target_roots=[a], for_task_types=task_types)
+    warmup = self.create_task(context)
+
+    # The bundle was built elsewhere, keyed as the task's own invalidation would key it.
+    bundle_task = warmup._create_task('bundle.jvm')
+    cache_manager = bundle_task.create_cache_manager(
+      True, TaskIdentityFingerprintStrategy(bundle_task))
+    cache_key = cache_manager.check([a]).invalid_vts[0].cache_key
+    read_cache = bundle_task._cache_factory.get_read_cache()
+    with temporary_file(self.pants_workdir) as f:
+      f.write(b'fraggle')
+      f.close()
+      read_cache.try_insert(cache_key, [f.name])
+    read_cache._localcache.delete(cache_key)
+
+    warmup.execute()
+    assert read_cache._localcache.has(cache_key)